@@ -3,18 +3,30 @@
 # python-telegram-bot==20.3, fastapi, uvicorn
 # Python 3.13 compatible (no JobQueue)
 
-import os, json, re, asyncio
+import os, sys, json, re, asyncio, zlib, lzma, base64, heapq, time, bisect, logging, functools, hmac, signal, marshal, itertools
+from collections import deque
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
 from telegram import Update, InlineKeyboardButton as B, InlineKeyboardMarkup as MK, ReplyKeyboardMarkup, KeyboardButton, Chat
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter, NetworkError, Conflict
+from telegram.request import HTTPXRequest
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+try:
+    import orjson                        # اختیاری: decode سریع‌تر بدنه‌ی وبهوک
+except ImportError:
+    orjson = None
 
 # =========================
 #          CONFIG
 # =========================
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "")   # مثلاً http://127.0.0.1:8081/bot برای fakebot.py یا Bot API محلی؛ خالی = api.telegram.org
+RUN_MODE = os.environ.get("RUN_MODE", "webhook").lower()   # webhook (uvicorn CBot:app) | polling (python -m CBot)
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")     # به set_webhook(secret_token=...) داده و در هر درخواست بررسی می‌شود
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(256 * 1024)))   # بایت
 
 GROUP_CHAT_ID = int(os.environ.get("GROUP_CHAT_ID", "0"))   # گروه ادمین/دیتاسنتر تاییدها
 DATACENTER_CHAT_ID = int(os.environ.get("DATACENTER_CHAT_ID", str(GROUP_CHAT_ID or 0)))   # DC1 (ROSTER)
@@ -36,8 +48,45 @@ SHOW_JSON_IN_PINNED = os.environ.get("SHOW_JSON_IN_PINNED", "1") == "1"
 # حداکثر محتوای JSON برای هر صفحه (برای کدبلوک) — اگر طولانی است truncate می‌کنیم
 PINNED_JSON_MAX_CHARS = int(os.environ.get("PINNED_JSON_MAX_CHARS", "1500"))
 
+# قالب بخش ماشین‌خوان DC1/DC2: snapshot (فشرده + base85) یا json (قالب قدیمی، خوانا)
+PINNED_FORMAT = os.environ.get("PINNED_FORMAT", "snapshot").lower()
+SNAPSHOT_CODEC = os.environ.get("SNAPSHOT_CODEC", "zlib").lower()        # zlib | lzma
+SNAPSHOT_PAGE_CHARS = int(os.environ.get("SNAPSHOT_PAGE_CHARS", "3600"))
+
 MALE_LIMIT_PER_EVENT = int(os.environ.get("MALE_LIMIT_PER_EVENT", "5"))
 
+# پنجره‌ی تجمیع ذخیره‌ی DC2 (ثانیه) — همه‌ی تغییرات این بازه با یک save اعمال می‌شوند
+USERS_SAVE_DELAY = float(os.environ.get("USERS_SAVE_DELAY", "3"))
+ROSTER_SAVE_DELAY = float(os.environ.get("ROSTER_SAVE_DELAY", "3"))     # همین برای DC1 (تایید/لغو/درخواست‌ها)
+
+# ویرایش صفحات DC1/DC2: هم‌زمان، ولی زیر سقف هر چت (پیام/ویرایش در دقیقه، با burst)
+DC_PAGE_RATE = float(os.environ.get("DC_PAGE_RATE", "20"))
+DC_PAGE_BURST = float(os.environ.get("DC_PAGE_BURST", "20"))
+DC_PAGE_CONCURRENCY = int(os.environ.get("DC_PAGE_CONCURRENCY", "8"))
+DC_SPARE_PAGES = int(os.environ.get("DC_SPARE_PAGES", "2"))   # صفحات اضافه‌ی خالی‌شده که برای رشد بعدی نگه داشته می‌شوند
+
+# ارسال همگانی (/dmall, /dmevent): سقف سراسری پیام در ثانیه، هم‌زمانی و تعداد تلاش مجدد
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_RETRIES = int(os.environ.get("BROADCAST_RETRIES", "3"))
+
+# وبهوک: آپدیت‌ها در صف هر چت (ترتیب‌دار) می‌روند و پاسخ فوری 200 برمی‌گردد؛ حداکثر WEBHOOK_WORKERS هندلر هم‌زمان
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "2000"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_ENQUEUE_TIMEOUT", "2"))   # صف پر → 503 تا تلگرام بعداً دوباره بفرستد
+UPDATE_DEDUPE_SIZE = int(os.environ.get("UPDATE_DEDUPE_SIZE", "10000"))   # آخرین update_idهای دیده‌شده (تحویل تکراری تلگرام نادیده گرفته می‌شود)
+
+# حالت polling: long-poll روی getUpdates به جای وبهوک (همان هندلرها، همان صف و همان ذخیره‌سازی)
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "30"))     # ثانیه‌ی انتظار هر getUpdates وقتی آپدیتی نیست
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", "100"))        # حداکثر آپدیت در هر دسته (سقف تلگرام 100)
+POLL_RETRY_MAX = float(os.environ.get("POLL_RETRY_MAX", "30"))   # سقف backoff پس از خطای شبکه
+POLL_TAKEOVER = os.environ.get("POLL_TAKEOVER", "0") == "1"   # 1 → وبهوک فعلی حذف شود؛ وگرنه (standby) تا حذف آن روی Conflict منتظر می‌ماند
+
+# لاگ: LOG_FORMAT=json → یک شیء JSON در هر خط. TRACE=1 → زمان‌سنجی هندلرها/saveها و شمارش فراخوانی‌های Bot API
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+TRACE = os.environ.get("TRACE", "").lower() in ("1", "true", "yes", "on")
+
 # ---- Default & Preset events
 DEFAULT_EVENTS = [
     {
@@ -84,25 +133,309 @@ try:
     MEETUP_LINKS = json.loads(os.environ.get("MEETUP_LINKS_JSON", "{}"))
 except: MEETUP_LINKS = {}
 
+# =========================
+#     LOGGING & TRACING
+# =========================
+def _log_value(v):
+    return f"{type(v).__name__}: {v}" if isinstance(v, BaseException) else str(v)
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, r):
+        d = {"ts": round(r.created, 3), "level": r.levelname.lower(), "event": r.getMessage(), **getattr(r, "fields", {})}
+        if r.exc_info: d["exc"] = self.formatException(r.exc_info)
+        return json.dumps(d, ensure_ascii=False, default=_log_value)
+
+class _TextFormatter(logging.Formatter):
+    def format(self, r):
+        s = f"{r.levelname} {r.getMessage()} " + " ".join(f"{k}={_log_value(v)}" for k, v in getattr(r, "fields", {}).items())
+        return s + ("\n" + self.formatException(r.exc_info) if r.exc_info else "")
+
+log = logging.getLogger("cbot")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+log.handlers[:] = [_log_handler]; log.propagate = False; log.setLevel(LOG_LEVEL)
+
+def log_event(event: str, level: int = logging.WARNING, **fields):
+    """One structured log line: `event` plus key/value fields (exceptions are rendered as "Type: msg")."""
+    if log.isEnabledFor(level): log.log(level, event, extra={"fields": fields})
+
+SPANS = {}       # span name -> [calls, errors, total_s, max_s, bucket counts]
+API_CALLS = {}   # (Bot API method, outcome = HTTP status / exception name) -> همان ساختار
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # ثانیه (هیستوگرام /metrics)
+
+def _observe(table: dict, key, dt: float, err: bool = False):
+    s = table.get(key)
+    if s is None: s = table[key] = [0, 0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+    s[0] += 1; s[1] += err; s[2] += dt; s[3] = max(s[3], dt)
+    s[4][bisect.bisect_left(LATENCY_BUCKETS, dt)] += 1
+
+def traced(name: str):
+    """Time an async function as span `name` into SPANS (debug log per call).
+    Without TRACE the function is returned untouched, so there is no overhead."""
+    def deco(fn):
+        if not TRACE: return fn
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter(); err = False
+            try: return await fn(*args, **kwargs)
+            except Exception: err = True; raise
+            finally:
+                dt = time.perf_counter() - t0
+                _observe(SPANS, name, dt, err)
+                log_event("span", logging.DEBUG, span=name, ms=round(dt * 1000, 2), ok=not err)
+        return wrapper
+    return deco
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest that counts every Bot API call by method and outcome and logs failures."""
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api = url.rsplit("/", 1)[-1]; t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            _observe(API_CALLS, (api, type(e).__name__), time.perf_counter() - t0, True)
+            log_event("api_error", api=api, error=e)
+            raise
+        _observe(API_CALLS, (api, str(code)), time.perf_counter() - t0, code >= 400)
+        if code >= 400: log_event("api_error", api=api, status=code, body=payload[:200].decode("utf-8", "replace"))
+        return code, payload
+
+def trace_stats() -> dict:
+    """Snapshot of SPANS and API_CALLS (ms) for /stats and tests."""
+    row = lambda s: {"calls": s[0], "errors": s[1], "total_ms": round(s[2] * 1000, 1), "max_ms": round(s[3] * 1000, 1)}
+    return {"spans": {k: row(s) for k, s in SPANS.items()},
+            "api": {f"{m}:{o}": row(s) for (m, o), s in API_CALLS.items()}}
+
+# =========================
+#         RECORDS
+# =========================
+# رکوردهای فشرده (slots) به‌جای dict. when/event_title در ردیف‌ها کپی نمی‌شوند؛ هر جا لازم است از EVENTS_BY_ID[event_id] خوانده شوند.
+# to_dict/from_dict قالب JSON پین‌ها و STORE هستند (ردیف‌های قدیمی با when/event_title هم خوانده می‌شوند).
+def _intern(s): return sys.intern(s) if isinstance(s, str) else s
+
+@dataclass(slots=True)
+class User:
+    chat_id: int
+    id: int | None = None
+    username: str | None = None
+    name: str | None = None
+
+    def to_dict(self) -> dict: return {"id": self.id, "chat_id": self.chat_id, "username": self.username, "name": self.name}
+
+    @classmethod
+    def from_dict(cls, d: dict, chat_id: int | None = None) -> "User":
+        return cls(d.get("chat_id") if chat_id is None else chat_id, d.get("id"), d.get("username"), d.get("name"))
+
+@dataclass(slots=True)
+class RosterEntry:
+    chat_id: int
+    event_id: str
+    name: str = "—"
+    username: str | None = None
+    phone: str = "—"
+    gender: str | None = None
+    age: int | None = None
+
+    def to_dict(self) -> dict:
+        return {"chat_id": self.chat_id, "name": self.name, "username": self.username,
+                "phone": self.phone, "gender": self.gender, "age": self.age}
+
+    @classmethod
+    def from_dict(cls, d: dict, event_id: str) -> "RosterEntry":
+        return cls(d.get("chat_id"), _intern(event_id), d.get("name", "—"), d.get("username"),
+                   d.get("phone", "—"), _intern(d.get("gender")), d.get("age"))
+
+@dataclass(slots=True)
+class PendingRegistration:
+    chat_id: int
+    event_id: str | None
+    name: str = "—"
+    phone: str = "—"
+    level: str = "—"
+    note: str = "—"
+    gender: str | None = None
+    age: int | None = None
+    username: str | None = None
+    admin_msg_id: int | None = None
+    due: float | None = None       # زمان auto-approve (epoch ثانیه)
+
+    def to_dict(self) -> dict:
+        return {"event_id": self.event_id, "name": self.name, "phone": self.phone, "level": self.level, "note": self.note,
+                "gender": self.gender, "age": self.age, "username": self.username,
+                "admin_msg_id": self.admin_msg_id, "due": self.due}
+
+    @classmethod
+    def from_dict(cls, d: dict, chat_id: int) -> "PendingRegistration":
+        return cls(chat_id, _intern(d.get("event_id")), d.get("name", "—"), d.get("phone", "—"), d.get("level", "—"),
+                   d.get("note", "—"), _intern(d.get("gender")), d.get("age"), d.get("username"),
+                   d.get("admin_msg_id"), d.get("due"))
+
+    def entry(self, event_id: str) -> RosterEntry:
+        return RosterEntry(self.chat_id, event_id, self.name, self.username, self.phone, self.gender, self.age)
+
+def roster_to_json(roster: dict) -> dict: return {ev_id: [r.to_dict() for r in rows] for ev_id, rows in roster.items()}
+def roster_from_json(d: dict) -> dict:
+    return {ev_id: [RosterEntry.from_dict(r, ev_id) for r in rows if isinstance(r, dict)] for ev_id, rows in d.items()}
+def pending_to_json(pending: dict) -> dict: return {str(cid): info.to_dict() for cid, info in pending.items()}
+def pending_from_json(d: dict) -> dict:
+    out = {}
+    for k, v in d.items():
+        try: out[int(k)] = PendingRegistration.from_dict(v, int(k))
+        except: pass
+    return out
+
 # =========================
 #     IN-MEMORY STORAGE
 # =========================
-PENDING = {}          # user_chat_id -> info
-ROSTER = {}           # event_id -> list[ {chat_id,name,username,phone,gender,age,when,event_title} ]
-ALL_USERS = {}        # chat_id -> { id, chat_id, username, name }
+PENDING = {}          # user_chat_id -> PendingRegistration
+HOLDS = {}            # event_id -> {user_chat_id: gender}؛ هر PENDING یک صندلی رزرو‌شده است
+ROSTER = {}           # event_id -> list[RosterEntry]
+ALL_USERS = {}        # chat_id -> User
+
+# ---- indexes (همه از روی داده‌های بالا ساخته می‌شوند؛ rebuild_indexes بعد از هر restore)
+EVENTS_BY_ID = {e["id"]: e for e in EVENTS}
+MALES = {}            # event_id -> تعداد آقایانِ تاییدشده
+MEMBERSHIP = {}       # chat_id -> set(event_id) که در ROSTERشان هست
+USERNAMES = {}        # username.lower() -> chat_id
 
 # DC1 (Roster) paging
 ROSTER_MESSAGE_ID = None                # صفحه اول (پین)
 ROSTER_PAGE_MESSAGE_IDS = []            # صفحات بعدی
 ROSTER_PAGE_TEXTS = []                  # کش متن صفحات DC1
+ROSTER_DIRTY = asyncio.Event()          # DC1 نیاز به save دارد (write-behind)
 
 # DC2 (All Users) paging
 USERS_MESSAGE_ID = None                 # صفحه اول (پین)
 USERS_PAGE_MESSAGE_IDS = []             # صفحات بعدی
 USERS_PAGE_TEXTS = []                   # کش متن صفحات DC2
+USERS_DIRTY = asyncio.Event()           # DC2 نیاز به save دارد (write-behind)
+USERS_VERSION = 0                       # با هر تغییر واقعی ALL_USERS یکی زیاد می‌شود
+USERS_SAVED_VERSION = -1                # نسخه‌ای که آخرین بار در DC2 نوشته شد
 
 TELEGRAM_HARD_LIMIT = 4096
 TELEGRAM_TEXT_LIMIT = 3900  # حاشیه امن برای متن ساده
+BLANK_PAGE = "▫️ (صفحه‌ی خالی — برای ادامه‌ی فهرست رزرو شده)"
+
+# =========================
+#     DURABLE STATE STORE
+# =========================
+# دیکشنری‌های بالا کش خواندن هستند؛ هر نوشتن از طریق STORE هم ثبت می‌شود.
+# پیام‌های پین‌شده‌ی DC1/DC2 فقط آینه‌ی انسانی‌اند و وقتی STORE خالی است برای بازیابی استفاده می‌شوند.
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cbot_state.db"))   # خالی = بدون ذخیره‌ی محلی
+
+class MemoryStore:
+    """No local persistence: the pinned DC messages stay the only durable copy."""
+    durable = False
+    def load(self): return None
+    def seed(self, all_users: dict, roster: dict, pending: dict): pass
+    def upsert_user(self, rec: User): pass
+    def delete_users(self, chat_ids): pass
+    def chat_id_for_username(self, username: str): return USERNAMES.get(username.lower())
+    def roster_add(self, ev_id: str, row: RosterEntry): pass
+    def roster_remove(self, ev_id: str, chat_id: int): pass
+    def put_pending(self, chat_id: int, info: PendingRegistration): pass
+    def pop_pending(self, chat_id: int): pass
+    def get_meta(self, key: str, default=None): return default
+    def set_meta(self, key: str, value): pass
+    def del_meta(self, key: str): pass
+    def meta_items(self, prefix: str): return []
+    def close(self): pass
+
+class SqliteStore(MemoryStore):
+    """SQLite (WAL) backend, indexed by chat_id, username and event_id."""
+    durable = True
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users(chat_id INTEGER PRIMARY KEY, id INTEGER, username TEXT, name TEXT, seq INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS users_username ON users(username COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS users_seq ON users(seq);
+    CREATE TABLE IF NOT EXISTS roster(seq INTEGER PRIMARY KEY AUTOINCREMENT, event_id TEXT NOT NULL, chat_id INTEGER, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS roster_event ON roster(event_id, seq);
+    CREATE INDEX IF NOT EXISTS roster_chat ON roster(chat_id);
+    CREATE TABLE IF NOT EXISTS pending(chat_id INTEGER PRIMARY KEY, event_id TEXT, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS pending_event ON pending(event_id);
+    CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def load(self):
+        """(all_users, roster, pending) or None when the DB has never been seeded."""
+        if not self.get_meta("seeded"): return None
+        q = self.db.execute
+        users = {cid: User(cid, uid, un, n) for cid, uid, un, n in q("SELECT chat_id, id, username, name FROM users ORDER BY seq")}
+        roster = {}
+        for ev_id, data in q("SELECT event_id, data FROM roster ORDER BY seq"):
+            roster.setdefault(ev_id, []).append(RosterEntry.from_dict(json.loads(data), ev_id))
+        pending = {cid: PendingRegistration.from_dict(json.loads(data), cid) for cid, data in q("SELECT chat_id, data FROM pending")}
+        return users, roster, pending
+
+    def seed(self, all_users, roster, pending):
+        with self.db:
+            self.db.execute("BEGIN")
+            for t in ("users", "roster", "pending"): self.db.execute(f"DELETE FROM {t}")
+            for rec in all_users.values(): self.upsert_user(rec)
+            for ev_id, rows in roster.items():
+                for row in rows: self.roster_add(ev_id, row)
+            for cid, info in pending.items(): self.put_pending(cid, info)
+            self.set_meta("seeded", 1)
+
+    def upsert_user(self, rec):
+        self.db.execute(
+            "INSERT INTO users(chat_id, id, username, name, seq) VALUES(?,?,?,?,(SELECT IFNULL(MAX(seq),0)+1 FROM users)) "
+            "ON CONFLICT(chat_id) DO UPDATE SET id=excluded.id, username=excluded.username, name=excluded.name",
+            (rec.chat_id, rec.id, rec.username, rec.name))
+
+    def delete_users(self, chat_ids):
+        self.db.executemany("DELETE FROM users WHERE chat_id = ?", [(c,) for c in chat_ids])
+
+    def chat_id_for_username(self, username):
+        row = self.db.execute("SELECT chat_id FROM users WHERE username = ? COLLATE NOCASE LIMIT 1", (username,)).fetchone()
+        return row[0] if row else None
+
+    def roster_add(self, ev_id, row):
+        self.db.execute("INSERT INTO roster(event_id, chat_id, data) VALUES(?,?,?)",
+                        (ev_id, row.chat_id, json.dumps(row.to_dict(), ensure_ascii=False)))
+
+    def roster_remove(self, ev_id, chat_id):
+        self.db.execute("DELETE FROM roster WHERE event_id = ? AND chat_id = ?", (ev_id, chat_id))
+
+    def put_pending(self, chat_id, info):
+        self.db.execute("INSERT OR REPLACE INTO pending(chat_id, event_id, data) VALUES(?,?,?)",
+                        (chat_id, info.event_id, json.dumps(info.to_dict(), ensure_ascii=False)))
+
+    def pop_pending(self, chat_id):
+        self.db.execute("DELETE FROM pending WHERE chat_id = ?", (chat_id,))
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?,?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def del_meta(self, key):
+        self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    def meta_items(self, prefix):
+        rows = self.db.execute("SELECT key, value FROM meta WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def close(self): self.db.close()
+
+def open_store(path: str = STATE_DB_PATH) -> MemoryStore:
+    if not path: return MemoryStore()
+    try:
+        return SqliteStore(path)
+    except Exception as e:
+        log_event("state_db_unavailable", path=path, error=e)
+        return MemoryStore()
+
+STORE = MemoryStore()   # startup() فایل STATE_DB_PATH را باز می‌کند؛ import به تنهایی چیزی روی دیسک نمی‌سازد
 
 # =========================
 #          TEXTS
@@ -149,13 +482,17 @@ async def _safe_edit(bot, chat_id: int, message_id: int, new_text: str, old_text
     try:
         await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=new_text)
         return True
+    except RetryAfter as e:
+        LIMITER.pause(chat_id, e.retry_after)
+        log_event("edit_throttled", chat_id=chat_id, retry_after=e.retry_after)
+        return False
     except BadRequest as e:
         if "message is not modified" in str(e).lower():
             return False
-        print("edit failed:", e)
+        log_event("edit_failed", chat_id=chat_id, message_id=message_id, error=e)
         return False
     except Exception as e:
-        print("edit failed (generic):", e)
+        log_event("edit_failed", chat_id=chat_id, message_id=message_id, error=e)
         return False
 
 # =========================
@@ -165,21 +502,139 @@ def is_admin_user(user) -> bool:
     u = (user.username or "").lower()
     return bool(u and u in ADMIN_SET)
 
-def add_user(user, chat_id: int):
-    if not chat_id: return
-    ALL_USERS[chat_id] = {
-        "id": getattr(user, "id", None),
-        "chat_id": chat_id,
-        "username": getattr(user, "username", None),
-        "name": getattr(user, "full_name", None),
-    }
-
-def get_event(eid): return next((e for e in EVENTS if e.get("id") == eid), None)
+def add_user(user, chat_id: int) -> bool:
+    """Upsert into ALL_USERS; True only if the record is new or changed."""
+    global USERS_VERSION
+    if not chat_id: return False
+    rec = User(chat_id, getattr(user, "id", None), getattr(user, "username", None), getattr(user, "full_name", None))
+    old = ALL_USERS.get(chat_id)
+    if old == rec: return False
+    if old and old.username and USERNAMES.get(old.username.lower()) == chat_id: del USERNAMES[old.username.lower()]
+    if rec.username: USERNAMES[rec.username.lower()] = chat_id
+    ALL_USERS[chat_id] = rec
+    STORE.upsert_user(rec)
+    _book_user(chat_id)
+    USERS_VERSION += 1
+    USERS_DIRTY.set()
+    return True
+
+def remove_users(chat_ids) -> int:
+    """Drop users (e.g. blocked the bot) from ALL_USERS; DC2 is re-numbered on the next save."""
+    global USERS_VERSION
+    gone = []
+    for c in chat_ids:
+        info = ALL_USERS.pop(c, None)
+        if info is None: continue
+        gone.append(c)
+        u = (info.username or "").lower()
+        if u and USERNAMES.get(u) == c: del USERNAMES[u]
+    if not gone: return 0
+    STORE.delete_users(gone)
+    _rebuild_users_book()
+    USERS_VERSION += 1
+    USERS_DIRTY.set()
+    return len(gone)
+
+# ---- write-through: هر تغییر ROSTER/PENDING از این‌ها می‌گذرد تا در STORE هم ثبت شود
+def roster_add(ev_id: str, row: RosterEntry):
+    ROSTER.setdefault(ev_id, []).append(row)
+    _index_row(ev_id, row, +1)
+    STORE.roster_add(ev_id, row)
+    ROSTER_DIRTY.set()
+
+def roster_remove(ev_id: str, chat_id: int) -> int:
+    if ev_id not in MEMBERSHIP.get(chat_id, ()): return 0
+    lst = ROSTER.get(ev_id, []); n = len(lst)
+    for r in [r for r in lst if r.chat_id == chat_id]: _index_row(ev_id, r, -1)
+    lst[:] = [r for r in lst if r.chat_id != chat_id]
+    STORE.roster_remove(ev_id, chat_id)
+    ROSTER_DIRTY.set()
+    return n - len(lst)
+
+def _index_row(ev_id: str, row: RosterEntry, sign: int):
+    if row.gender == "male": MALES[ev_id] = MALES.get(ev_id, 0) + sign
+    cid = row.chat_id
+    if sign > 0:
+        MEMBERSHIP.setdefault(cid, set()).add(ev_id)
+        u = (row.username or "").lower()
+        if u: USERNAMES.setdefault(u, cid)
+    elif cid in MEMBERSHIP:
+        MEMBERSHIP[cid].discard(ev_id)
+        if not MEMBERSHIP[cid]: del MEMBERSHIP[cid]
+
+def rebuild_indexes():
+    """Recompute every derived index (and the seat ledger) after ROSTER/ALL_USERS/PENDING were replaced."""
+    MALES.clear(); MEMBERSHIP.clear(); USERNAMES.clear()
+    for cid, info in ALL_USERS.items():
+        if info.username: USERNAMES[info.username.lower()] = cid
+    for ev_id, rows in ROSTER.items():
+        for r in rows: _index_row(ev_id, r, +1)
+    rebuild_holds()
+
+def pending_put(chat_id: int, info: PendingRegistration):
+    _unhold(chat_id, PENDING.get(chat_id))
+    PENDING[chat_id] = info
+    HOLDS.setdefault(info.event_id, {})[chat_id] = info.gender
+    STORE.put_pending(chat_id, info)
+    ROSTER_DIRTY.set()                      # PENDING در snapshot DC1 هم آینه می‌شود
+
+def pending_pop(chat_id: int):
+    STORE.pop_pending(chat_id)
+    info = PENDING.pop(chat_id, None)
+    _unhold(chat_id, info)
+    if info: ROSTER_DIRTY.set()
+    return info
+
+def _unhold(chat_id: int, info):
+    if info: HOLDS.get(info.event_id, {}).pop(chat_id, None)
+
+def rebuild_holds():
+    """Derive the seat ledger from PENDING (after a restore replaced it wholesale)."""
+    HOLDS.clear()
+    for cid, info in PENDING.items(): HOLDS.setdefault(info.event_id, {})[cid] = info.gender
+
+def get_event(eid): return EVENTS_BY_ID.get(eid)
 def approved_count(eid): return len(ROSTER.get(eid, []))
-def male_count(eid): return sum(1 for r in ROSTER.get(eid, []) if r.get("gender") == "male")
+def male_count(eid): return MALES.get(eid, 0)
 def remaining_capacity(ev):
+    """Free seats: capacity minus approved minus seats held by pending registrations."""
     c = int(ev.get("capacity") or 0)
-    return max(0, c - approved_count(ev["id"])) if c else 10**9
+    return max(0, c - approved_count(ev["id"]) - len(HOLDS.get(ev["id"], ()))) if c else 10**9
+
+# ---- seat ledger: بررسی ظرفیت و رزرو/تبدیل صندلی بدون هیچ await بین بررسی و ثبت،
+#      پس در event loop اتمیک است و approve/auto-approve/ثبت‌نام هم‌زمان overbook نمی‌کنند.
+def seat_refusal(ev, chat_id: int, gender) -> str | None:
+    """None if chat_id may take a seat in ev, else "capacity" / "male". Its own hold doesn't count."""
+    if not ev: return None
+    held = HOLDS.get(ev["id"], {}); mine = chat_id in held
+    c = int(ev.get("capacity") or 0)
+    if c and approved_count(ev["id"]) + len(held) - mine >= c: return "capacity"
+    if gender == "male":
+        males = male_count(ev["id"]) + sum(1 for g in held.values() if g == "male") - (mine and held[chat_id] == "male")
+        if males >= MALE_LIMIT_PER_EVENT: return "male"
+    return None
+
+def reserve_seat(ev, chat_id: int, info: PendingRegistration) -> str | None:
+    """Check and hold a seat (as a PENDING entry) in one step; returns the refusal reason, if any."""
+    reason = seat_refusal(ev, chat_id, info.gender)
+    if not reason: pending_put(chat_id, info)
+    return reason
+
+def confirm_seat(chat_id: int, ev_id: str):
+    """Convert a held seat into a roster row.
+
+    Returns (info, None) on success, (info, reason) if the seat could not be
+    honoured (legacy over-limit data; the hold is released either way) and
+    (None, None) if the registration was already approved/rejected/expired.
+    """
+    info = PENDING.get(chat_id)
+    if not info or (info.event_id or "NA") != ev_id: return None, None
+    pending_pop(chat_id)
+    ev = get_event(ev_id)
+    if ev and ev.get("capacity") and approved_count(ev_id) >= int(ev["capacity"]): return info, "capacity"
+    if info.gender == "male" and male_count(ev_id) >= MALE_LIMIT_PER_EVENT: return info, "male"
+    roster_add(ev_id, info.entry(ev_id))
+    return info, None
 
 def event_text_user(ev):
     parts = [f"**{ev.get('title','')}**", f"🕒 {ev.get('when','')}", f"📍 {ev.get('place','—')}", f"💶 {ev.get('price','') or 'Free'}"]
@@ -199,218 +654,747 @@ def _extract_json(text):
     except: return None
 
 # ---- paging utils
-def _paginate_lines(header: str, lines: list[str], limit: int = TELEGRAM_TEXT_LIMIT) -> list[str]:
-    pages = []
-    cur = header
+def _iter_pages(header: str, lines, limit: int = TELEGRAM_TEXT_LIMIT):
+    """Lazily yield pages of `header` + lines, each ≤ limit (a single oversized
+    line still gets its own page). Tracks the running length and joins every
+    page once, so callers that only need the first page can stop early."""
+    buf = [header]; size = len(header)
     for ln in lines:
-        cand = cur + "\n" + ln
-        if len(cand) > limit:
-            pages.append(cur)
-            cur = header + "\n" + ln
+        add = len(ln) + 1
+        if size + add > limit and len(buf) > 1:
+            yield "\n".join(buf)
+            buf = [header, ln]; size = len(header) + add
         else:
-            cur = cand
-    if cur:
-        pages.append(cur)
-    return pages or [header]
+            buf.append(ln); size += add
+    yield "\n".join(buf)
 
 def _json_pages(title: str, obj: dict | list, limit: int = TELEGRAM_TEXT_LIMIT, chunk_chars: int = PINNED_JSON_MAX_CHARS) -> list[str]:
-    """Break JSON to multiple pages with code-fence, each page ≤ limit."""
+    """Break JSON to multiple pages with code-fence, each page ≤ limit.
+    Each page carries the crc32 of its own chunk, so an unchanged chunk keeps an
+    identical page; the whole-document crc lives in the page-id line."""
     s = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
-    # chunk long json
-    chunks = [s[i:i+chunk_chars] for i in range(0, len(s), chunk_chars)] or [""]
-    pages = []
-    for i, ch in enumerate(chunks, 1):
-        body = f"{title} (p{i}/{len(chunks)})\n\n```json\n{ch}\n```"
-        if len(body) > limit:
-            # last resort: shrink chunk to fit
-            room = max(200, limit - len(title) - 20)
-            ch2 = ch[:room]
-            body = f"{title} (p{i}/{len(chunks)})\n\n```json\n{ch2}\n```"
-        pages.append(body)
-    return pages
+    room = max(200, min(chunk_chars, limit - len(title) - 30))   # هدر + code-fence باید در limit جا شوند
+    chunks = [s[i:i+room] for i in range(0, len(s), room)] or [""]
+    return [f"{title} crc={zlib.crc32(ch.encode()):08x}\n\n```json\n{ch}\n```" for ch in chunks]
+
+# (pI/N) فقط در قالب قدیمی بود؛ آنجا crc مال کل سند است، در قالب جدید مال همان صفحه
+_JSON_PAGE_RE = re.compile(r"(?:\(p(\d+)/(\d+)\))? ?(?:crc=([0-9a-f]{8}))?\s*```json\n(.*)\n```\s*$", re.DOTALL)
+
+def _join_json_pages(texts: list, crc: str | None = None) -> dict | None:
+    """Reassemble _json_pages output, in page-id order (old (pI/N) pages: any order);
+    None if a page is missing or a crc fails."""
+    parts, seq, total = {}, [], None
+    for t in texts:
+        m = _JSON_PAGE_RE.search(t or "")
+        if not m: return None
+        if m.group(1):
+            parts[int(m.group(1))] = m.group(4); total = int(m.group(2)); crc = m.group(3) or crc
+        elif m.group(3) and f"{zlib.crc32(m.group(4).encode()):08x}" != m.group(3): return None
+        else: seq.append(m.group(4))
+    if parts and seq: return None
+    if parts and sorted(parts) != list(range(1, total + 1)): return None
+    s = "".join(parts[i] for i in range(1, total + 1)) if parts else "".join(seq)
+    if crc and f"{zlib.crc32(s.encode()):08x}" != crc: return None
+    try: return json.loads(s)
+    except: return None
+
+# ---- snapshot: JSON → zlib/lzma → base85, با هدر نسخه‌دار؛ همان داده در کسری از صفحات
+SNAPSHOT_VERSION = 2
+_SNAP_CODECS = {   # id -> (name, compress, decompress) ؛ بایت اول payload شناسه‌ی codec است
+    1: ("zlib", lambda b: zlib.compress(b, 6), zlib.decompress),
+    2: ("lzma", lambda b: lzma.compress(b, format=lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA2, "preset": 9, "dict_size": 1 << 20}]),
+                lambda b: lzma.decompress(b, format=lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA2}])),
+}
+
+def snapshot_encode(obj, codec: str = SNAPSHOT_CODEC) -> str:
+    cid = next((k for k, (name, _, _) in _SNAP_CODECS.items() if name == codec), 1)
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    return base64.b85encode(bytes([cid]) + _SNAP_CODECS[cid][1](raw)).decode()
+
+def snapshot_decode(payload: str):
+    b = base64.b85decode(payload)
+    return json.loads(_SNAP_CODECS[b[0]][2](b[1:]))
+
+_ROW_JSON = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), check_circular=False).encode   # json.dumps هر بار encoder تازه می‌سازد
+_SNAP_CACHE = {}    # (title, codec id) -> (ردیف‌ها، بلوک‌ها) ی save قبلی؛ فقط ردیف/بلوک عوض‌شده دوباره کد و فشرده می‌شود
+
+def _snapshot_rows(obj: dict, cache: dict | None = None) -> list[bytes]:
+    """{key: [row, ...], key2: value} → one JSON line per row ([key, row]); non-list values as [key, value, 1], empty lists as [key].
+    `cache` keeps each list's rows (marshalled, so 1 / 1.0 / True differ) and lines from the
+    previous call: rows in the common prefix/suffix reuse their line (like _PageBook.set_lines),
+    only the rest are encoded."""
+    out = []
+    for k, v in obj.items():
+        if not isinstance(v, list): out.append(_ROW_JSON([k, v, 1]).encode()); continue
+        if not v: out.append(_ROW_JSON([k]).encode()); continue
+        pv, pl = cache.get(k, ((), ())) if cache is not None else ((), ())
+        mv = list(map(marshal.dumps, v, itertools.repeat(2))) if cache is not None else []
+        n = min(len(pv), len(mv)); i = s = 0
+        while i < n and pv[i] == mv[i]: i += 1
+        while s < n - i and pv[-1-s] == mv[-1-s]: s += 1
+        lines = [*pl[:i], *(_ROW_JSON([k, r]).encode() for r in v[i:len(v)-s]), *pl[len(pl)-s:]]
+        if cache is not None: cache[k] = (mv, lines)
+        out += lines
+    if cache is not None:
+        for k in [k for k in cache if k not in obj]: del cache[k]
+    return out
+
+def _snapshot_blocks(rows: list[bytes], target: int, chunk_chars: int, cid: int, cache: dict | None = None) -> list[str]:
+    """Content-defined blocks: a row ends a block with probability len(row)/target
+    (decided by its own crc), so an insert or delete moves at most one boundary and
+    every other block — hence every other page — stays byte-identical. Each block is
+    compressed on its own; one that would not fit a page is split again at a
+    content-defined row near its middle. `cache` maps a block's raw bytes to its
+    encoding from the previous call and is replaced by this call's blocks."""
+    blocks, cur, size = [], [], 0
+    for r in rows:
+        cur.append(r); size += len(r) + 1
+        if size >= 3 * target or (size >= target // 4 and zlib.crc32(r) % target < len(r)):
+            blocks.append(cur); cur, size = [], 0
+    if cur or not blocks: blocks.append(cur)
+    out, old = [], dict(cache or {})
+    if cache is not None: cache.clear()
+    while blocks:
+        blk = blocks.pop(0); raw = b"\n".join(blk)
+        enc = old.get(raw) or base64.b85encode(bytes([cid]) + _SNAP_CODECS[cid][1](raw)).decode()
+        if cache is not None: cache[raw] = enc
+        if len(enc) > chunk_chars and len(blk) > 1:
+            # مرز ریزتر، باز وابسته به محتوا: یک درج فقط همان نیمه را عوض می‌کند
+            cuts = [i for i in range(1, len(blk)) if zlib.crc32(blk[i-1]) % (target // 8) < len(blk[i-1])]
+            h = min(cuts, key=lambda i: abs(2 * i - len(blk))) if cuts else len(blk) // 2
+            blocks[:0] = [blk[:h], blk[h:]]; continue
+        out.append(enc)
+    return out
+
+def _snapshot_pages(title: str, obj, chunk_chars: int = SNAPSHOT_PAGE_CHARS, codec: str = SNAPSHOT_CODEC) -> list[str]:
+    """v2: one independently compressed block of rows per page (see _snapshot_blocks)."""
+    cid = next((k for k, (name, _, _) in _SNAP_CODECS.items() if name == codec), 1)
+    rows_cache, blocks_cache = _SNAP_CACHE.setdefault((title, cid), ({}, {}))
+    chunks = _snapshot_blocks(_snapshot_rows(obj, rows_cache), 2 * chunk_chars, chunk_chars, cid, blocks_cache)
+    return [f"{title} v{SNAPSHOT_VERSION} crc={zlib.crc32(ch.encode()):08x}\n{ch}" for ch in chunks]
+
+def _snapshot_unblock(chunks: list[str]) -> dict:
+    obj = {}
+    for ch in chunks:
+        b = base64.b85decode(ch); raw = _SNAP_CODECS[b[0]][2](b[1:])
+        for ln in raw.split(b"\n") if raw else ():
+            r = json.loads(ln)
+            if len(r) == 3: obj[r[0]] = r[1]
+            elif len(r) == 1: obj.setdefault(r[0], [])
+            else: obj.setdefault(r[0], []).append(r[1])
+    return obj
+
+# v1 = یک blob فشرده‌ی واحد (در (pI/N) یا بدون آن)، v2 = هر صفحه یک بلوک مستقل
+# (pI/N) + crc کل سند = قالب قدیمی؛ بدون آن crc مال همان صفحه است
+_SNAP_PAGE_RE = re.compile(r"\bv(\d+) (?:\(p(\d+)/(\d+)\) )?crc=([0-9a-f]{8})\n(\S*)\s*$")
+
+def _join_snapshot_pages(texts: list, crc: str | None = None):
+    parts, seq, total, ver = {}, [], None, set()
+    for t in texts:
+        m = _SNAP_PAGE_RE.search(t or "")
+        if not m or int(m.group(1)) not in (1, 2): return None
+        ver.add(int(m.group(1)))
+        if m.group(2):
+            parts[int(m.group(2))] = m.group(5); total = int(m.group(3)); crc = m.group(4)
+        elif f"{zlib.crc32(m.group(5).encode()):08x}" != m.group(4): return None
+        else: seq.append(m.group(5))
+    if parts and seq or not (parts or seq) or len(ver) != 1: return None
+    if parts and sorted(parts) != list(range(1, total + 1)): return None
+    s = "".join(parts[i] for i in range(1, total + 1)) if parts else "".join(seq)
+    if crc and f"{zlib.crc32(s.encode()):08x}" != crc: return None
+    try: return _snapshot_unblock(seq) if ver == {2} else snapshot_decode(s)
+    except Exception: return None
+
+def _data_pages(title: str, obj) -> list[str]:
+    """Machine-readable part of a DC chat, in PINNED_FORMAT."""
+    if PINNED_FORMAT == "json":
+        return _json_pages(f"{title} JSON", obj, TELEGRAM_TEXT_LIMIT, PINNED_JSON_MAX_CHARS)
+    return _snapshot_pages(f"{title} snapshot", obj)
+
+def _join_data_pages(texts: list, crc: str | None = None):
+    """`crc` = crc32 of the reassembled payload, from the page-id line."""
+    return _join_snapshot_pages(texts, crc) or _join_json_pages(texts, crc)
+
+def _data_crc(pages: list[str]) -> str:
+    """crc32 of the payload _join_data_pages would reassemble from `pages`."""
+    bodies = []
+    for t in pages:
+        m = _SNAP_PAGE_RE.search(t)
+        bodies.append(m.group(5) if m else _JSON_PAGE_RE.search(t).group(4))
+    return f"{zlib.crc32(''.join(bodies).encode()):08x}"
+
+# ---- خط شناسه‌ی صفحات در سرتیتر صفحه‌ی اول (برای بازیابی همه‌ی صفحات بعد از ری‌استارت)
+# شناسه‌های پشت‌سرهم به صورت بازه نوشته می‌شوند (10000-10816)، وگرنه در ده‌ها هزار کاربر صفحه‌ی اول از سقف تلگرام می‌گذرد
+_IDS_RE = re.compile(r"🧷 pages: ([\d,-]*) · (?:data|json): ([\d,-]*)(?: · crc=([0-9a-f]{8}))?")
+
+def _id_ranges(ids: list) -> str:
+    out, i = [], 0
+    while i < len(ids):
+        j = i
+        while j + 1 < len(ids) and ids[j + 1] == ids[j] + 1: j += 1
+        out.append(str(ids[i]) if j == i else f"{ids[i]}-{ids[j]}"); i = j + 1
+    return ",".join(out)
+
+def _parse_id_ranges(s: str) -> list:
+    ids = []
+    for x in s.split(","):
+        a, _, z = x.partition("-")
+        if a: ids.extend(range(int(a), int(z or a) + 1))
+    return ids
+
+def _ids_line(h: list, j: list, crc: str | None = None) -> str:
+    return f"🧷 pages: {_id_ranges(h)} · data: {_id_ranges(j)}" + (f" · crc={crc}" if crc else "")
+
+def _parse_ids_line(text: str) -> tuple[list, list, str | None]:
+    m = _IDS_RE.search(text or "")
+    if not m: return [], [], None
+    return _parse_id_ranges(m.group(1)), _parse_id_ranges(m.group(2)), m.group(3)
+
+class _PageBook:
+    """Incremental pager for DC pages.
+
+    Keeps keyed lines plus the line index each page starts at, and on
+    render() re-paginates only the pages whose lines were touched; a page is
+    re-flowed further down only while its start index differs from before.
+    Pages are filled against fixed header reserves (page 0 gets a larger one
+    for the page-id line), so a header change dirties page 0 only. Indexes of pages whose text
+    changed accumulate in `dirty` until take_dirty().
+    """
+    def __init__(self, header: str, limit: int = TELEGRAM_TEXT_LIMIT):
+        self.limit = limit
+        self.header = header                 # سرتیتر صفحات بعدی
+        self.first_header = header           # سرتیتر صفحه اول (پین)
+        self.reserve = len(header) + 64
+        self.first_reserve = len(header) + 256
+        self.reset()
+
+    def reset(self, lines: list[str] | None = None):
+        self.lines = list(lines or []); self.keys = list(range(len(self.lines)))
+        self.pos = {k: k for k in self.keys}
+        self.starts, self.pages = [], []
+        self.dirty = set()
+        self._touched, self._tail, self._old_n = set(), 0, 0
+        self._hdr_first = self._hdr_rest = True
+
+    def __len__(self): return len(self.lines)
+    def index(self, key): return self.pos.get(key)
+
+    def put(self, key, line: str):
+        i = self.pos.get(key)
+        if i is None:
+            self.pos[key] = i = len(self.lines)
+            self.keys.append(key); self.lines.append(line)
+        elif self.lines[i] == line:
+            return
+        else:
+            self.lines[i] = line
+        self._touched.add(i)
+
+    def set_lines(self, lines: list[str]):
+        """Replace unkeyed lines; everything after the first differing line is re-flowed."""
+        old = self.lines; n = min(len(old), len(lines)); i = 0
+        while i < n and old[i] == lines[i]: i += 1
+        if i == len(old) == len(lines): return
+        self.lines = list(lines); self.keys = list(range(len(lines)))
+        self.pos = {k: k for k in self.keys}
+        self._tail = i if self._tail is None else min(self._tail, i)
+
+    def set_header(self, first: str, rest: str | None = None):
+        if rest is not None and rest != self.header:
+            self.header = rest; self._hdr_rest = True
+        if first != self.first_header:
+            self.first_header = first; self._hdr_first = True
+        # سرتیتر از رزرو بزرگ‌تر شد → re-flow کامل
+        if len(self.header) > self.reserve:
+            self.reserve = len(self.header) + 64; self._tail = 0
+        if len(self.first_header) > self.first_reserve:
+            self.first_reserve = len(self.first_header) + 256; self._tail = 0
+
+    def _page_text(self, k, i, j):
+        return "\n".join([self.first_header if k == 0 else self.header] + self.lines[i:j])
+
+    def render(self) -> list[str]:
+        if not (self._touched or self._hdr_first or self._hdr_rest) and self._tail is None:
+            return self.pages
+        lines, n, limit = self.lines, len(self.lines), self.limit
+        old_starts, old_pages = self.starts, self.pages
+        touched = sorted(self._touched); tail = self._tail; t = 0
+        starts, pages = [], []
+        i = k = 0
+        while i < n or k == 0:
+            # صفحه‌ی قبلی دست‌نخورده از همان نقطه شروع می‌شود → بدون رندر کپی کن
+            if k < len(old_starts) and old_starts[k] == i and (k + 1 < len(old_starts) or self._old_n == n):
+                end = old_starts[k + 1] if k + 1 < len(old_starts) else n
+                while t < len(touched) and touched[t] < i: t += 1
+                clean = (t == len(touched) or touched[t] > end) and (tail is None or tail > end)
+                if clean and not (self._hdr_first if k == 0 else self._hdr_rest):
+                    starts.append(i); pages.append(old_pages[k]); i = end; k += 1
+                    continue
+            size, j = (self.first_reserve if k == 0 else self.reserve), i
+            while j < n and (size + len(lines[j]) + 1 <= limit or j == i):
+                size += len(lines[j]) + 1; j += 1
+            text = self._page_text(k, i, j)
+            if k >= len(old_pages) or old_pages[k] != text: self.dirty.add(k)
+            starts.append(i); pages.append(text); i = j; k += 1
+        self.starts, self.pages, self._old_n = starts, pages, n
+        self.dirty = {d for d in self.dirty if d < len(pages)}
+        self._touched, self._tail = set(), None
+        self._hdr_first = self._hdr_rest = False
+        return pages
+
+    def take_dirty(self) -> set:
+        d, self.dirty = self.dirty, set()
+        return d
 
 # =========================
 #    PINNED — DC1 (Roster)  [paged + JSON pages]
 # =========================
-def _human_roster_lines() -> list[str]:
+def _iter_roster_lines():
     if not ROSTER:
-        return ["— هنوز کسی تایید نشده."]
-    L = []
+        yield "— هنوز کسی تایید نشده."; return
     for e in EVENTS:
         eid = e["id"]; ppl = ROSTER.get(eid, [])
-        L.append(f"\n🗓 {e['title']} — {e['when']} | تاییدشده‌ها: {len(ppl)} (آقایان: {male_count(eid)})")
+        yield f"\n🗓 {e['title']} — {e['when']} | تاییدشده‌ها: {len(ppl)} (آقایان: {male_count(eid)})"
         if not ppl:
-            L.append("  — هنوز تاییدی نداریم")
+            yield "  — هنوز تاییدی نداریم"
         else:
             for i, r in enumerate(ppl, 1):
-                uname = f"@{r['username']}" if r.get("username") else "—"
-                L.append(f"  {i}. {r['name']} | {uname} | {r.get('phone','—')}")
-    return L
+                uname = f"@{r.username}" if r.username else "—"
+                yield f"  {i}. {r.name} | {uname} | {r.phone}"
 
-def _roster_pages() -> list[str]:
-    header = "📋 لیست تاییدشده‌ها (DataCenter #1)"
-    pages = _paginate_lines(header, _human_roster_lines(), TELEGRAM_TEXT_LIMIT)
+def _human_roster_lines() -> list[str]:
+    return list(_iter_roster_lines())
+
+ROSTER_HEADER = "📋 لیست تاییدشده‌ها (DataCenter #1)"
+ROSTER_BOOK = _PageBook(ROSTER_HEADER)
+
+def _place_data_pages(page_ids: list, texts: list, n_human: int, json_pages: list[str]) -> tuple[list[str], list]:
+    """Map data pages onto the messages after the human pages: a message that
+    already shows a page keeps it, the rest take the leftover messages, then new
+    ones. Data pages are found through the id line, not by position, so a human
+    page more or less (or a block inserted mid-payload) moves nothing else.
+    Permutes the data part of page_ids/texts in place; returns the data pages in
+    message order and the data message ids in payload order (new pages: not yet known)."""
+    h = n_human - 1
+    while len(texts) < 1 + len(page_ids): texts.append(None)
+    ids = page_ids[h:]; text_of = {mid: texts[1 + h + j] for j, mid in enumerate(ids)}
+    by_text = {}
+    for mid in ids: by_text.setdefault(text_of[mid], []).append(mid)
+    mids = [by_text[p].pop(0) if by_text.get(p) else None for p in json_pages]
+    spare = iter([mid for mid in ids if mid not in set(mids)])
+    mids = [mid if mid is not None else next(spare, None) for mid in mids]
+    used = [mid for mid in mids if mid is not None]
+    order = [k for k, mid in enumerate(mids) if mid is not None] + [k for k, mid in enumerate(mids) if mid is None]
+    page_ids[h:] = used + [mid for mid in ids if mid not in set(used)]
+    texts[1 + h:1 + h + len(ids)] = [text_of[mid] for mid in page_ids[h:]]
+    return [json_pages[k] for k in order], used
+
+def _paged_with_ids(book: _PageBook, first_header: str, page_ids: list, texts: list, json_pages: list[str]) -> tuple[list[str], set]:
+    """Human pages from `book` + JSON pages, with the page-id line (and the data crc) under page 0's header."""
+    crc = _data_crc(json_pages) if json_pages else None
+    for _ in range(3):   # اگر خط شناسه‌ها رزرو را بزرگ کند تعداد صفحات ممکن است عوض شود
+        nh = len(book.render())
+        data, data_ids = _place_data_pages(page_ids, texts, nh, json_pages)
+        book.set_header(f"{first_header}\n{_ids_line(page_ids[:nh-1], data_ids, crc)}")
+        if len(book.render()) == nh: break
+    pages = list(book.pages); dirty = book.take_dirty()
+    dirty.update(range(len(pages), len(pages) + len(data)))   # _sync_pages متن تکراری را دوباره ویرایش نمی‌کند
+    return pages + data, dirty
+
+def _pack_roster() -> dict:
+    """DC1 machine-readable payload. Snapshot: one row per event / approved seat / pending registration."""
+    if PINNED_FORMAT == "json":
+        return {"events":[{"id":e["id"],"capacity":e.get("capacity"),"title":e["title"],"when":e["when"]} for e in EVENTS],
+                "roster": roster_to_json(ROSTER), "pending": pending_to_json(PENDING)}
+    return {"e": [[e["id"], e.get("capacity"), e["title"], e["when"]] for e in EVENTS],
+            "r": [[r.event_id, r.chat_id, r.name, r.username, r.phone, r.gender, r.age] for rows in ROSTER.values() for r in rows],
+            "p": [[cid, p.event_id, p.name, p.phone, p.level, p.note, p.gender, p.age, p.username, p.admin_msg_id, p.due]
+                  for cid, p in PENDING.items()]}
+
+def _unpack_roster(data) -> tuple[dict, dict] | None:
+    """(roster, pending) from either payload shape; None if `data` holds neither."""
+    if not isinstance(data, dict): return None
+    if isinstance(data.get("r"), list):
+        roster = {}
+        for r in data["r"]: roster.setdefault(r[0], []).append(RosterEntry(r[1], _intern(r[0]), r[2], r[3], r[4], _intern(r[5]), r[6]))
+        pending = {int(p[0]): PendingRegistration(int(p[0]), _intern(p[1]), *p[2:6], _intern(p[6]), *p[7:]) for p in data.get("p") or []}
+        return roster, pending
+    ro, pe = data.get("roster"), data.get("pending")
+    if not isinstance(ro, dict) and not isinstance(pe, dict): return None
+    return (roster_from_json(ro) if isinstance(ro, dict) else {}), (pending_from_json(pe) if isinstance(pe, dict) else {})
+
+def _roster_pages() -> tuple[list[str], set]:
+    """DC1 pages + indexes of pages that changed since the last call."""
+    ROSTER_BOOK.set_lines(_human_roster_lines())
+    json_pages = []
     if SHOW_JSON_IN_PINNED:
-        meta = {"events":[{"id":e["id"],"capacity":e.get("capacity"),"title":e["title"],"when":e["when"]} for e in EVENTS],
-                "roster": ROSTER}
-        pages += _json_pages("📦 Roster JSON", meta, TELEGRAM_TEXT_LIMIT, PINNED_JSON_MAX_CHARS)
-    return pages
-
-async def save_roster_pinned(app):
-    global ROSTER_MESSAGE_ID, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS
-    if not DATACENTER_CHAT_ID: return
-    pages = _roster_pages()
-
-    # ensure cache size
-    while len(ROSTER_PAGE_TEXTS) < len(pages):
-        ROSTER_PAGE_TEXTS.append(None)
+        json_pages = _data_pages("📦 Roster", _pack_roster())
+    return _paged_with_ids(ROSTER_BOOK, ROSTER_HEADER, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS, json_pages)
+
+_OWN_PAGES = set()     # (chat_id, message_id) صفحاتی که بات خودش فرستاده (در meta ی dc1/dc2 هم ذخیره می‌شود)؛ فقط این‌ها حذف می‌شوند
+
+async def _sync_pages(app, chat_id: int, first_id, page_ids: list, texts: list, pages: list[str], dirty: set):
+    """Push `pages` into a DC chat: page 0 is the pinned message, the rest live in
+    page_ids. Only pages in `dirty` (or never sent) are edited. page_ids/texts are
+    updated in place; returns (first_id, indexes whose edit failed).
+
+    Edits run concurrently (at most DC_PAGE_CONCURRENCY in flight, paced by the
+    chat's LIMITER bucket); new pages are sent one by one so message order
+    matches page order. When there are fewer pages than before, up to
+    DC_SPARE_PAGES surplus messages are blanked and kept for reuse, the rest
+    are deleted, so page_ids stays bounded. Only pages the bot itself sent
+    (_OWN_PAGES, kept across restarts in the dc1/dc2 STORE meta) are ever
+    deleted; pages recovered from a pin are blanked and kept, so a bad
+    restore cannot wipe the chat.
+    """
+    failed = set()
+    while len(texts) < max(len(pages), 1 + len(page_ids)):
+        texts.append(None)
+    sem = asyncio.Semaphore(DC_PAGE_CONCURRENCY)
+
+    async def edit(i, mid):
+        if i not in dirty and texts[i] is not None: return
+        if texts[i] == pages[i]: return
+        async with sem:
+            await LIMITER.acquire(chat_id)
+            changed = await _safe_edit(app.bot, chat_id, mid, pages[i], texts[i])
+        if changed or texts[i] is None:
+            texts[i] = pages[i]
+        else:
+            failed.add(i)
+
+    async def blank(i, mid):
+        if texts[i] == BLANK_PAGE: return
+        async with sem:
+            await LIMITER.acquire(chat_id)
+            if await _safe_edit(app.bot, chat_id, mid, BLANK_PAGE, texts[i]): texts[i] = BLANK_PAGE
+
+    async def drop(mid):
+        async with sem:
+            try: await app.bot.delete_message(chat_id=chat_id, message_id=mid); _OWN_PAGES.discard((chat_id, mid)); return
+            except Exception as e: log_event("page_delete_failed", chat_id=chat_id, message_id=mid, error=e)
+            await LIMITER.acquire(chat_id)
+            await _safe_edit(app.bot, chat_id, mid, BLANK_PAGE, None)   # حذف نشد (مثلاً قدیمی) → دست‌کم خالی شود
+
+    async def create(start: int, needed: int):
+        for i in range(start, needed):
+            await LIMITER.acquire(chat_id)
+            m = await app.bot.send_message(chat_id=chat_id, text=pages[i+1])
+            page_ids.append(m.message_id); _OWN_PAGES.add((chat_id, m.message_id))
+            texts[i+1] = pages[i+1]
 
     # first page (pin)
-    if ROSTER_MESSAGE_ID:
-        changed = await _safe_edit(app.bot, DATACENTER_CHAT_ID, ROSTER_MESSAGE_ID, pages[0], ROSTER_PAGE_TEXTS[0])
-        if changed or ROSTER_PAGE_TEXTS[0] is None:
-            ROSTER_PAGE_TEXTS[0] = pages[0]
+    jobs = []
+    if first_id:
+        jobs.append(edit(0, first_id))
     else:
-        m = await app.bot.send_message(chat_id=DATACENTER_CHAT_ID, text=pages[0])
-        ROSTER_MESSAGE_ID = m.message_id
-        ROSTER_PAGE_TEXTS[0] = pages[0]
+        await LIMITER.acquire(chat_id)
+        m = await app.bot.send_message(chat_id=chat_id, text=pages[0])
+        first_id = m.message_id; _OWN_PAGES.add((chat_id, first_id))
+        texts[0] = pages[0]
         try:
-            await app.bot.pin_chat_message(chat_id=DATACENTER_CHAT_ID, message_id=ROSTER_MESSAGE_ID, disable_notification=True)
+            await app.bot.pin_chat_message(chat_id=chat_id, message_id=first_id, disable_notification=True)
         except Exception as e:
-            print("pin roster first page failed:", e)
+            log_event("pin_failed", chat_id=chat_id, message_id=first_id, error=e)
 
-    # subsequent pages
+    # subsequent pages: edit existing, create new ones in order
     needed = max(0, len(pages) - 1)
+    jobs += [edit(i+1, page_ids[i]) for i in range(min(needed, len(page_ids)))]
+    jobs.append(create(len(page_ids), needed))
+    # surplus pages: blank a few spares (and every page we did not send) for reuse, delete the rest
+    spare = page_ids[needed:]
+    keep = [j for j, mid in enumerate(spare) if j < DC_SPARE_PAGES or (chat_id, mid) not in _OWN_PAGES]
+    jobs += [blank(needed + 1 + j, spare[j]) for j in keep]
+    jobs += [drop(mid) for j, mid in enumerate(spare) if j >= DC_SPARE_PAGES and (chat_id, mid) in _OWN_PAGES]
+    errors = [r for r in await asyncio.gather(*jobs, return_exceptions=True) if isinstance(r, BaseException)]
+    if errors: raise errors[0]
+
+    kept = [(spare[j], texts[needed + 1 + j]) for j in keep]
+    del page_ids[needed:]; del texts[1 + needed:]
+    page_ids += [mid for mid, _ in kept]; texts += [t for _, t in kept]
+    return first_id, failed
+
+def _dc_meta(chat_id: int, first_id, page_ids: list, texts: list) -> dict:
+    """STORE meta of one DC chat: page ids/texts plus which of them the bot sent itself."""
+    own = [mid for mid in [first_id, *page_ids] if (chat_id, mid) in _OWN_PAGES]
+    return {"first": first_id, "pages": page_ids, "texts": texts, "own": own}
+
+def _adopt_dc_meta(chat_id: int, meta: dict):
+    _OWN_PAGES.update((chat_id, mid) for mid in meta.get("own") or [])
+    return meta.get("first"), meta.get("pages") or [], meta.get("texts") or []
+
+class SingleFlight:
+    """At most one run of an async save at a time; calls made while it runs
+    collapse into a single trailing run, which starts afterwards and so sees
+    the newest state. Every caller waits for a run that began after its call."""
+    def __init__(self, fn):
+        self.fn = fn; self.current = None; self.trailing = None
+        self.calls = 0; self.runs = 0
+
+    async def _go(self, *args):
+        self.runs += 1
+        return await self.fn(*args)
+
+    async def _after(self, prev, *args):
+        await asyncio.wait([prev])
+        self.current, self.trailing = self.trailing, None
+        return await self._go(*args)
+
+    async def run(self, *args):
+        self.calls += 1
+        if self.trailing is not None:        # run بعدی هنوز شروع نشده (حتی اگر current تازه تمام شده باشد) → به آن بپیوند
+            task = self.trailing
+        elif self.current is None or self.current.done():
+            task = self.current = asyncio.ensure_future(self._go(*args))
+        else:
+            task = self.trailing = asyncio.ensure_future(self._after(self.current, *args))
+        return await asyncio.shield(task)   # لغو شدن یک صدا‌زننده، save مشترک را لغو نکند
+
+# ---- write-behind: تغییرات فقط رویداد dirty را ست می‌کنند؛ این حلقه آن‌ها را تجمیع و ذخیره می‌کند
+async def _flusher(app, dirty: asyncio.Event, save, delay: float, name: str):
+    while True:
+        await dirty.wait()
+        await asyncio.sleep(delay)          # coalesce window
+        dirty.clear()                       # تغییرات حین save، دور بعدی را فعال می‌کنند
+        try:
+            await save(app)
+        except asyncio.CancelledError:
+            dirty.set(); raise
+        except Exception as e:
+            log_event(f"{name}_flush_failed", logging.ERROR, error=e)
+            dirty.set()
 
-    # edit existing pages
-    for i in range(min(needed, len(ROSTER_PAGE_MESSAGE_IDS))):
-        mid = ROSTER_PAGE_MESSAGE_IDS[i]
-        changed = await _safe_edit(app.bot, DATACENTER_CHAT_ID, mid, pages[i+1], ROSTER_PAGE_TEXTS[i+1])
-        if changed or ROSTER_PAGE_TEXTS[i+1] is None:
-            ROSTER_PAGE_TEXTS[i+1] = pages[i+1]
-
-    # create new pages if needed
-    if needed > len(ROSTER_PAGE_MESSAGE_IDS):
-        for i in range(len(ROSTER_PAGE_MESSAGE_IDS), needed):
-            m = await app.bot.send_message(chat_id=DATACENTER_CHAT_ID, text=pages[i+1])
-            ROSTER_PAGE_MESSAGE_IDS.append(m.message_id)
-            if len(ROSTER_PAGE_TEXTS) <= i+1:
-                ROSTER_PAGE_TEXTS.append(None)
-            ROSTER_PAGE_TEXTS[i+1] = pages[i+1]
-
-    # shrink cache if fewer pages now (do not delete extra messages)
-    if len(ROSTER_PAGE_TEXTS) > len(pages):
-        ROSTER_PAGE_TEXTS = ROSTER_PAGE_TEXTS[:len(pages)]
+async def _flush(app, dirty: asyncio.Event, save):
+    if not dirty.is_set(): return
+    dirty.clear()
+    await save(app)
 
-async def restore_roster_from_pinned(app):
-    global ROSTER_MESSAGE_ID, ROSTER
+async def save_roster_pinned(app): return await ROSTER_SAVES.run(app)
+
+@traced("save_roster_pinned")
+async def _save_roster_pinned(app):
+    global ROSTER_MESSAGE_ID
     if not DATACENTER_CHAT_ID: return
-    try:
-        chat: Chat = await app.bot.get_chat(DATACENTER_CHAT_ID)
-    except Exception as e:
-        print("restore roster get_chat:", e); return
+    for _ in range(4):   # صفحه‌ی جدید ساخته شد → خط شناسه‌های صفحه‌ی اول را هم به‌روز کن
+        n_ids = len(ROSTER_PAGE_MESSAGE_IDS)
+        pages, dirty = _roster_pages()
+        ROSTER_MESSAGE_ID, failed = await _sync_pages(app, DATACENTER_CHAT_ID, ROSTER_MESSAGE_ID,
+                                                      ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS, pages, dirty)
+        ROSTER_BOOK.dirty.update(i for i in failed if i < len(ROSTER_BOOK.pages))
+        if len(ROSTER_PAGE_MESSAGE_IDS) == n_ids: break
+    STORE.set_meta("dc1", _dc_meta(DATACENTER_CHAT_ID, ROSTER_MESSAGE_ID, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS))
+    if failed: ROSTER_DIRTY.set()           # صفحات ناموفق → flusher دوباره تلاش کند
+
+ROSTER_SAVES = SingleFlight(_save_roster_pinned)
+
+# تایید/رد/لغو/درخواست‌ها فقط ROSTER_DIRTY را ست می‌کنند (سقف ویرایش چت DC1 ~۲۰ در دقیقه است)
+async def roster_flusher(app, delay: float = ROSTER_SAVE_DELAY):
+    await _flusher(app, ROSTER_DIRTY, save_roster_pinned, delay, "roster")
+
+async def flush_roster_pinned(app): await _flush(app, ROSTER_DIRTY, save_roster_pinned)
+
+class RestoreError(RuntimeError):
+    """Pinned DC pages point at data that could not be read back; starting anyway would overwrite it."""
+
+async def _fetch_page_text(app, chat_id: int, message_id: int, attempts: int = 5):
+    """Bot API has no getMessage: forward the page into the same chat, read it, delete the copy.
+
+    Forwards count against the group's message limit, so each one goes
+    through LIMITER; RetryAfter is waited out (not counted as an attempt),
+    other network errors are retried with backoff. None = unreadable.
+    """
+    tries = 0
+    while True:
+        await LIMITER.acquire(chat_id)
+        try:
+            fm = await app.bot.forward_message(chat_id=chat_id, from_chat_id=chat_id, message_id=message_id, disable_notification=True)
+            break
+        except RetryAfter as e:
+            LIMITER.pause(chat_id, e.retry_after)
+        except BadRequest as e:                  # پیام حذف شده/قابل forward نیست → تلاش دوباره بی‌فایده است
+            log_event("page_read_failed", chat_id=chat_id, message_id=message_id, error=e); return None
+        except Exception as e:
+            tries += 1
+            if tries >= attempts:
+                log_event("page_read_failed", chat_id=chat_id, message_id=message_id, error=e); return None
+            await asyncio.sleep(min(2 ** tries, 30))
+    try: await app.bot.delete_message(chat_id=chat_id, message_id=fm.message_id)
+    except Exception as e: log_event("page_copy_delete_failed", chat_id=chat_id, message_id=fm.message_id, error=e)
+    return fm.text or fm.caption
+
+async def _read_pinned(app, chat_id: int):
+    """Pinned page + every page listed in its page-id line. Data pages are fetched
+    (paced by LIMITER) and reassembled with their crc checked. Returns
+    (first_id, page_ids, texts, data). Raises RestoreError if the id line lists
+    data pages that cannot all be read and verified — never "no data"."""
+    for tries in range(1, 6):
+        try:
+            chat: Chat = await app.bot.get_chat(chat_id); break
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            log_event("restore_get_chat_failed", chat_id=chat_id, error=e)
+            if tries == 5: raise RestoreError(f"DC chat {chat_id}: cannot read the pinned message ({e})")   # «پین نداریم» فرض نکن
+            await asyncio.sleep(min(2 ** tries, 30))
     pm = getattr(chat, "pinned_message", None)
-    if not pm: return
-    data = _extract_json(getattr(pm, "text", None) or getattr(pm, "caption", None))
-    if data and isinstance(data.get("roster"), dict):
-        ROSTER = data["roster"]
-    ROSTER_MESSAGE_ID = pm.message_id
-    # سایر صفحات پس از اولین save ساخته/ادیت می‌شوند
+    if not pm: return None
+    text = getattr(pm, "text", None) or getattr(pm, "caption", None)
+    human_ids, json_ids, crc = _parse_ids_line(text)
+    if not json_ids:
+        data = _extract_json(text)            # قالب قدیمی: JSON داخل خود پیام پین
+        if data is None and _IDS_RE.search(text or ""):
+            raise RestoreError(f"DC chat {chat_id}: pinned pages carry no data pages (SHOW_JSON_IN_PINNED was off?); "
+                               "unpin the page to start empty")
+        return pm.message_id, human_ids, [text] + [None] * len(human_ids), data
+    json_texts = list(await asyncio.gather(*(_fetch_page_text(app, chat_id, mid) for mid in json_ids)))
+    unread = sum(t is None for t in json_texts)
+    if unread: raise RestoreError(f"DC chat {chat_id}: {unread}/{len(json_ids)} data pages could not be read")
+    data = _join_data_pages(json_texts, crc)
+    if data is None: raise RestoreError(f"DC chat {chat_id}: data pages failed verification ({len(json_ids)} pages)")
+    return pm.message_id, human_ids + json_ids, [text] + [None] * len(human_ids) + json_texts, data
+
+async def restore_roster_from_pinned(app):
+    global ROSTER_MESSAGE_ID, ROSTER, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS
+    if not DATACENTER_CHAT_ID: return
+    r = await _read_pinned(app, DATACENTER_CHAT_ID)
+    if not r: return
+    ROSTER_MESSAGE_ID, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS, data = r
+    rp = _unpack_roster(data)
+    if rp is None and data is not None: raise RestoreError("DC1: pinned data holds no roster")
+    if rp is not None:
+        ROSTER = rp[0]
+        PENDING.clear(); PENDING.update(rp[1])
 
 # =========================
 #    PINNED — DC2 (All Users)  [paged + JSON pages]
 # =========================
-def _lines_for_users():
-    lines = []
-    for idx, (cid, info) in enumerate(ALL_USERS.items(), 1):
-        u = (info.get("username") or "")
-        n = info.get("name") or "—"
-        uid = info.get("id")
-        if u and u.lower() in ADMIN_SET:
-            uname_disp = u                 # بدون @ برای ادمین‌ها
-        else:
-            uname_disp = ("@" + u) if u else ""
-        lines.append(f"{idx}. {n} {uname_disp} | chat_id={cid} | id={uid}")
-    return lines
-
-def _human_users_pages():
-    header = f"👥 همهٔ کاربران (DataCenter #2) — {len(ALL_USERS)} نفر"
-    pages = _paginate_lines(header, _lines_for_users(), TELEGRAM_TEXT_LIMIT)
-    if SHOW_JSON_IN_PINNED:
-        pages += _json_pages("📦 All Users JSON", {"all_users": {str(cid): ALL_USERS[cid] for cid in ALL_USERS}},
-                             TELEGRAM_TEXT_LIMIT, PINNED_JSON_MAX_CHARS)
-    return pages or [header]
-
-async def save_users_pinned(app):
-    global USERS_MESSAGE_ID, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS
-    if not DATACENTER2_CHAT_ID: return
-
-    pages = _human_users_pages()
-    if not pages:
-        pages = ["👥 همهٔ کاربران (DataCenter #2)\n— هنوز کسی بات را استارت نکرده."]
-
-    while len(USERS_PAGE_TEXTS) < len(pages):
-        USERS_PAGE_TEXTS.append(None)
-
-    # first page (pin)
-    if USERS_MESSAGE_ID:
-        changed = await _safe_edit(app.bot, DATACENTER2_CHAT_ID, USERS_MESSAGE_ID, pages[0], USERS_PAGE_TEXTS[0])
-        if changed or USERS_PAGE_TEXTS[0] is None:
-            USERS_PAGE_TEXTS[0] = pages[0]
+USERS_HEADER = "👥 همهٔ کاربران (DataCenter #2)"
+USERS_BOOK = _PageBook(USERS_HEADER)     # key = chat_id، به ترتیب ALL_USERS
+
+def _user_line(idx: int, cid: int, info: User) -> str:
+    u = (info.username or "")
+    n = info.name or "—"
+    uid = info.id
+    if u and u.lower() in ADMIN_SET:
+        uname_disp = u                 # بدون @ برای ادمین‌ها
     else:
-        m = await app.bot.send_message(chat_id=DATACENTER2_CHAT_ID, text=pages[0])
-        USERS_MESSAGE_ID = m.message_id
-        USERS_PAGE_TEXTS[0] = pages[0]
-        try:
-            await app.bot.pin_chat_message(chat_id=DATACENTER2_CHAT_ID, message_id=USERS_MESSAGE_ID, disable_notification=True)
-        except Exception as e:
-            print("pin users first page failed:", e)
-
-    # subsequent pages
-    needed = max(0, len(pages) - 1)
-
-    for i in range(min(needed, len(USERS_PAGE_MESSAGE_IDS))):
-        mid = USERS_PAGE_MESSAGE_IDS[i]
-        changed = await _safe_edit(app.bot, DATACENTER2_CHAT_ID, mid, pages[i+1], USERS_PAGE_TEXTS[i+1])
-        if changed or USERS_PAGE_TEXTS[i+1] is None:
-            USERS_PAGE_TEXTS[i+1] = pages[i+1]
+        uname_disp = ("@" + u) if u else ""
+    return f"{idx}. {n} {uname_disp} | chat_id={cid} | id={uid}"
+
+def _book_user(cid: int):
+    """Refresh only this user's DC2 line (appends for a new user)."""
+    i = USERS_BOOK.index(cid)
+    USERS_BOOK.put(cid, _user_line((len(USERS_BOOK) if i is None else i) + 1, cid, ALL_USERS[cid]))
+
+def _rebuild_users_book():
+    USERS_BOOK.reset()
+    for cid in ALL_USERS: _book_user(cid)
+
+def _pack_users() -> dict:
+    """DC2 machine-readable payload. Snapshot: one row per user [chat_id, id (None if == chat_id), username, name]."""
+    if PINNED_FORMAT == "json":
+        return {"all_users": {str(cid): info.to_dict() for cid, info in ALL_USERS.items()}}
+    return {"u": [[cid, None if info.id == cid else info.id, info.username, info.name]
+                  for cid, info in ALL_USERS.items()]}
+
+def _unpack_users(data) -> dict | None:
+    if not isinstance(data, dict): return None
+    if isinstance(data.get("u"), list):
+        return {int(r[0]): User(int(r[0]), r[0] if r[1] is None else r[1], r[2], r[3]) for r in data["u"]}
+    au = data.get("all_users")
+    if not isinstance(au, dict): return None
+    users = {}
+    for k, v in au.items():
+        try: cid = int(k)
+        except: continue
+        users[cid] = User.from_dict(v, cid)
+    return users
+
+def _human_users_pages() -> tuple[list[str], set]:
+    """DC2 pages + indexes of pages that changed since the last call."""
+    json_pages = []
+    if SHOW_JSON_IN_PINNED:
+        json_pages = _data_pages("📦 All Users", _pack_users())
+    return _paged_with_ids(USERS_BOOK, f"{USERS_HEADER} — {len(ALL_USERS)} نفر", USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS, json_pages)
 
-    if needed > len(USERS_PAGE_MESSAGE_IDS):
-        for i in range(len(USERS_PAGE_MESSAGE_IDS), needed):
-            m = await app.bot.send_message(chat_id=DATACENTER2_CHAT_ID, text=pages[i+1])
-            USERS_PAGE_MESSAGE_IDS.append(m.message_id)
-            if len(USERS_PAGE_TEXTS) <= i+1:
-                USERS_PAGE_TEXTS.append(None)
-            USERS_PAGE_TEXTS[i+1] = pages[i+1]
+async def save_users_pinned(app): return await USERS_SAVES.run(app)
 
-    if len(USERS_PAGE_TEXTS) > len(pages):
-        USERS_PAGE_TEXTS = USERS_PAGE_TEXTS[:len(pages)]
+@traced("save_users_pinned")
+async def _save_users_pinned(app):
+    global USERS_MESSAGE_ID, USERS_SAVED_VERSION
+    if not DATACENTER2_CHAT_ID: return
+    if USERS_MESSAGE_ID and USERS_SAVED_VERSION == USERS_VERSION: return   # چیزی عوض نشده
+    version = USERS_VERSION
+
+    for _ in range(4):
+        n_ids = len(USERS_PAGE_MESSAGE_IDS)
+        pages, dirty = _human_users_pages()
+        USERS_MESSAGE_ID, failed = await _sync_pages(app, DATACENTER2_CHAT_ID, USERS_MESSAGE_ID,
+                                                     USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS, pages, dirty)
+        USERS_BOOK.dirty.update(i for i in failed if i < len(USERS_BOOK.pages))
+        if len(USERS_PAGE_MESSAGE_IDS) == n_ids: break
+    STORE.set_meta("dc2", _dc_meta(DATACENTER2_CHAT_ID, USERS_MESSAGE_ID, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS))
+    if failed: USERS_DIRTY.set()            # صفحات ناموفق → flusher دوباره تلاش کند؛ نسخه جلو نمی‌رود
+    else: USERS_SAVED_VERSION = version
+
+USERS_SAVES = SingleFlight(_save_users_pinned)
 
 async def restore_users_from_pinned(app):
-    global USERS_MESSAGE_ID, ALL_USERS, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS
+    global USERS_MESSAGE_ID, ALL_USERS, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS, USERS_VERSION
     USERS_PAGE_MESSAGE_IDS = []
     USERS_PAGE_TEXTS = []
     if not DATACENTER2_CHAT_ID: return
+    r = await _read_pinned(app, DATACENTER2_CHAT_ID)
+    if not r: return
+    USERS_MESSAGE_ID, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS, data = r
+    users = _unpack_users(data)
+    if users is None and data is not None: raise RestoreError("DC2: pinned data holds no user list")
+    if users is not None:
+        ALL_USERS = users
+        USERS_VERSION += 1
+        _rebuild_users_book()
+
+# ---- write-behind: add_user فقط USERS_DIRTY را ست می‌کند
+async def users_flusher(app, delay: float = USERS_SAVE_DELAY):
+    await _flusher(app, USERS_DIRTY, save_users_pinned, delay, "users")
+
+async def flush_users_pinned(app): await _flush(app, USERS_DIRTY, save_users_pinned)
+
+# =========================
+#     STARTUP RESTORE
+# =========================
+def load_state_from_store() -> bool:
+    """Fill the in-memory state (and DC page ids/texts) from STORE; False if it is empty."""
+    global ALL_USERS, ROSTER, PENDING, USERS_VERSION
+    global ROSTER_MESSAGE_ID, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS
+    global USERS_MESSAGE_ID, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS
+    data = STORE.load()
+    if data is None: return False
+    ALL_USERS, ROSTER, PENDING = data
+    USERS_VERSION += 1
+    _rebuild_users_book()
+    ROSTER_MESSAGE_ID, ROSTER_PAGE_MESSAGE_IDS, ROSTER_PAGE_TEXTS = _adopt_dc_meta(DATACENTER_CHAT_ID, STORE.get_meta("dc1") or {})
+    USERS_MESSAGE_ID, USERS_PAGE_MESSAGE_IDS, USERS_PAGE_TEXTS = _adopt_dc_meta(DATACENTER2_CHAT_ID, STORE.get_meta("dc2") or {})
+    return True
+
+async def restore_state(app):
+    """Local store first (no network); pinned DC messages only when the store is empty.
+
+    STORE is seeded only after the pins were decoded (or hold no page-id line,
+    i.e. there is nothing to restore). Pins that list pages we cannot read raise
+    RestoreError and startup stops, rather than seeding an empty store that the
+    next save would mirror over the DC pages."""
+    if load_state_from_store():
+        rebuild_indexes()
+        USERS_DIRTY.set(); ROSTER_DIRTY.set()              # آینه‌ها را با STORE هم‌گام کن
+        return
     try:
-        chat: Chat = await app.bot.get_chat(DATACENTER2_CHAT_ID)
-    except Exception as e:
-        print("restore users get_chat:", e); return
-    pm = getattr(chat, "pinned_message", None)
-    if not pm: return
-    data = _extract_json(getattr(pm, "text", None) or getattr(pm, "caption", None))
-    au = data.get("all_users") if data else None
-    if isinstance(au, dict):
-        ALL_USERS = {}
-        for k, v in au.items():
-            try: cid = int(k)
-            except: continue
-            ALL_USERS[cid] = {
-                "id": v.get("id"),
-                "chat_id": cid,
-                "username": v.get("username"),
-                "name": v.get("name"),
-            }
-    USERS_MESSAGE_ID = pm.message_id
+        await restore_roster_from_pinned(app)  # DC1
+        await restore_users_from_pinned(app)   # DC2
+    except RestoreError as e:
+        log_event("restore_refused", logging.CRITICAL, error=e); raise
+    rebuild_indexes()
+    STORE.seed(ALL_USERS, ROSTER, PENDING)
 
 # =========================
 #          UI
@@ -538,12 +1522,184 @@ async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif prev == "note":  return await render_note(update, context, edit=True)
     return await render_home(update, context, edit=True)
 
+# =========================
+#   RATE LIMITS & BROADCAST
+# =========================
+class TokenBucket:
+    """Async token bucket: `rate` tokens/s, bursts up to `capacity`; pause() honours RetryAfter."""
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate; self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity; self.t = time.monotonic(); self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds); self.tokens = 0
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now); continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate); self.t = now
+                if self.tokens >= 1:
+                    self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatLimiter:
+    """Global bucket + one bucket per chat (≈1 msg/s for users, ≈20 msg/min for groups)."""
+    def __init__(self, rate: float = BROADCAST_RATE):
+        self.all = TokenBucket(rate)
+        self.chats = {}
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            if len(self.chats) > 10000:    # باکت‌های پُر (بی‌کار) را دور بریز
+                now = time.monotonic()
+                self.chats = {c: x for c, x in self.chats.items() if x.tokens + (now - x.t) * x.rate < x.capacity}
+            if chat_id in (DATACENTER_CHAT_ID, DATACENTER2_CHAT_ID): b = TokenBucket(DC_PAGE_RATE / 60, DC_PAGE_BURST)
+            else: b = TokenBucket(20/60, 3) if chat_id < 0 else TokenBucket(1, 1)
+            self.chats[chat_id] = b
+        return b
+
+    async def acquire(self, chat_id: int):
+        await self._bucket(chat_id).acquire()
+        await self.all.acquire()
+
+    def pause(self, chat_id: int, seconds: float):
+        self._bucket(chat_id).pause(seconds); self.all.pause(seconds)
+
+LIMITER = ChatLimiter()
+BROADCASTS = {}       # job_id -> Broadcast
+
+class Broadcast:
+    """Background fan-out of one text to many chats with retries and progress edits.
+
+    Targets are sent in chat_id order. The job is checkpointed into STORE
+    (cursor = last chat_id below which everything is done, plus the few
+    chats finished above it), so after a restart or /bcresume it continues
+    without re-sending.
+    """
+    PROGRESS_EVERY = 3.0
+
+    def __init__(self, app, job_id: str, targets: list[int], text: str, admin_chat_id: int, progress_msg_id: int | None,
+                 label: str, state: dict | None = None):
+        self.app, self.id, self.text, self.label = app, job_id, text, label
+        self.targets = sorted(set(targets))
+        self.admin_chat_id, self.progress_msg_id = admin_chat_id, progress_msg_id
+        state = state or {}
+        self.sent, self.failed = state.get("sent", 0), state.get("failed", 0)
+        self.blocked = list(state.get("blocked", []))   # کاربرانی که بات را بلاک/حذف کرده‌اند
+        self.done = set(state.get("done", []))          # تمام‌شده‌های بالاتر از cursor
+        cursor = state.get("cursor")
+        self.pos = 0 if cursor is None else bisect.bisect_right(self.targets, cursor)
+        self.status = state.get("status", "running")
+        self._last_progress = 0.0
+
+    @classmethod
+    def from_state(cls, app, st: dict):
+        targets = STORE.get_meta(f"broadcast_targets:{st['id']}") or []
+        return cls(app, st["id"], targets, st["text"], st["admin_chat_id"], st.get("progress_msg_id"), st["label"], st)
+
+    def state(self) -> dict:
+        return {"id": self.id, "label": self.label, "text": self.text,
+                "admin_chat_id": self.admin_chat_id, "progress_msg_id": self.progress_msg_id,
+                "cursor": self.targets[self.pos-1] if self.pos else None, "done": sorted(self.done),
+                "sent": self.sent, "failed": self.failed, "blocked": self.blocked, "status": self.status}
+
+    def checkpoint(self):
+        # بعد از هر ارسال: یک ردیف کوچک در WAL؛ ری‌استارت حداکثر پیام‌های در حال ارسال را تکرار می‌کند
+        STORE.set_meta(f"broadcast:{self.id}", self.state())
+
+    def status_text(self, done: bool = False) -> str:
+        head = {"paused": "⏸ متوقف", "cancelled": "⛔ لغو شد"}.get(self.status, "✅ پایان" if done else "⏳ در حال ارسال")
+        return (f"📣 {self.label} [{self.id}] — {head}\n"
+                f"ارسال {self.sent} | ناموفق {self.failed} | از {len(self.targets)}"
+                + (f"\n🚫 بلاک/غیرفعال (حذف از لیست): {len(self.blocked)}" if self.blocked else ""))
+
+    async def _progress(self, done: bool = False):
+        now = time.monotonic()
+        if not self.progress_msg_id or (not done and now - self._last_progress < self.PROGRESS_EVERY): return
+        self._last_progress = now
+        await _safe_edit(self.app.bot, self.admin_chat_id, self.progress_msg_id, self.status_text(done), None)
+
+    async def _send(self, chat_id: int) -> bool:
+        for attempt in range(BROADCAST_RETRIES + 1):
+            await LIMITER.acquire(chat_id)
+            try:
+                await self.app.bot.send_message(chat_id=chat_id, text=self.text)
+                return True
+            except RetryAfter as e:
+                LIMITER.pause(chat_id, float(e.retry_after))
+            except Forbidden:                              # bot blocked / user deactivated
+                self.blocked.append(chat_id); return False
+            except BadRequest as e:
+                if "chat not found" in str(e).lower(): self.blocked.append(chat_id)
+                return False
+            except NetworkError:                           # TimedOut و خطاهای گذرای شبکه
+                await asyncio.sleep(min(30, 2 ** attempt))
+            except Exception as e:
+                log_event("broadcast_send_failed", job=self.id, chat_id=chat_id, error=e); return False
+        return False
+
+    def _mark_done(self, chat_id: int):
+        self.done.add(chat_id)
+        while self.pos < len(self.targets) and self.targets[self.pos] in self.done:
+            self.done.discard(self.targets[self.pos]); self.pos += 1
+
+    async def _worker(self, it):
+        for chat_id in it:
+            if self.status != "running": return
+            if await self._send(chat_id): self.sent += 1
+            else: self.failed += 1
+            self._mark_done(chat_id)
+            self.checkpoint()
+            await self._progress()
+
+    async def run(self):
+        BROADCASTS[self.id] = self
+        self.status = "running"
+        STORE.set_meta(f"broadcast_targets:{self.id}", self.targets)   # یک بار؛ checkpointها فقط پیشرفت را می‌نویسند
+        self.checkpoint()
+        try:
+            # همه‌ی workerها از یک iterator می‌خوانند
+            it = (c for c in self.targets[self.pos:] if c not in self.done)
+            await asyncio.gather(*(self._worker(it) for _ in range(max(1, BROADCAST_CONCURRENCY))))
+            if self.status == "running": self.status = "done"
+            if self.status == "paused":
+                self.checkpoint()
+            else:
+                STORE.del_meta(f"broadcast:{self.id}"); STORE.del_meta(f"broadcast_targets:{self.id}")
+                if self.blocked: remove_users(self.blocked)
+            await self._progress(done=True)
+        finally:
+            BROADCASTS.pop(self.id, None)
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, targets: list[int], text: str, label: str):
+    """Reply with a progress message and run the broadcast in the background."""
+    job_id = str(update.message.message_id)
+    m = await update.message.reply_text(f"📣 {label} [{job_id}] — صف شد ({len(set(targets))} نفر)\n"
+                                        f"/bcstatus · /bcpause {job_id} · /bccancel {job_id}")
+    job = Broadcast(context.application, job_id, targets, text, update.effective_chat.id, m.message_id, label)
+    context.application.create_task(job.run())
+    return job
+
+def _stored_broadcasts() -> dict:
+    return {st["id"]: st for _, st in STORE.meta_items("broadcast:")}
+
+def resume_broadcasts(app):
+    """Restart every job that was running when the process stopped."""
+    for st in _stored_broadcasts().values():
+        if st.get("status") == "running" and st["id"] not in BROADCASTS:
+            app.create_task(Broadcast.from_state(app, st).run())
+
 # =========================
 #         HANDLERS
 # =========================
+@traced("cmd_start")
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_user(update.effective_user, update.effective_chat.id)
-    await save_users_pinned(context.application)
     await render_home(update, context)
 
 async def cmd_testpin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -553,9 +1709,9 @@ async def cmd_testpin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_roster(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # یک برش کوتاه برای نمایش سریع
-    header = "📋 وضعیت فعلی (خلاصه):"
-    preview = "\n".join(_human_roster_lines())[:3600]
-    await update.message.reply_text(f"{header}\n\n{preview}" if preview else f"{header}\n— خالی —")
+    header = "📋 وضعیت فعلی (خلاصه):\n"
+    preview = next(_iter_pages(header, _iter_roster_lines(), 3600))   # فقط صفحه‌ی اول ساخته می‌شود
+    await update.message.reply_text(preview)
 
 def _is_dc_admin(update: Update):
     return (update.effective_chat.id in {DATACENTER_CHAT_ID, GROUP_CHAT_ID}) and is_admin_user(update.effective_user)
@@ -567,16 +1723,7 @@ async def cmd_dm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = re.match(r"^/dm\s+@?(\w+)\s+(.+)$", t, flags=re.DOTALL)
     if not m: return await update.message.reply_text("فرمت: /dm @username پیام")
     target, msg = m.group(1), m.group(2).strip()
-    chat_id = None
-    for ppl in ROSTER.values():
-        for r in ppl:
-            if (r.get("username") or "").lower() == target.lower():
-                chat_id = r.get("chat_id"); break
-        if chat_id: break
-    if not chat_id:
-        for cid, info in ALL_USERS.items():
-            if (info.get("username") or "").lower() == target.lower():
-                chat_id = cid; break
+    chat_id = USERNAMES.get(target.lower()) or STORE.chat_id_for_username(target)
     if not chat_id: return await update.message.reply_text("کاربر پیدا نشد یا chat_id نداریم.")
     try:
         await context.bot.send_message(chat_id=chat_id, text=msg)
@@ -593,14 +1740,9 @@ async def cmd_dmevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not msg and update.message.reply_to_message:
         msg = update.message.reply_to_message.text or update.message.reply_to_message.caption or ""
     if not msg: return await update.message.reply_text("متن پیام خالی است.")
-    if ev_id not in {e["id"] for e in EVENTS}: return await update.message.reply_text("event_id نامعتبر.")
-    sent=fail=0
-    for r in ROSTER.get(ev_id, []):
-        cid = r.get("chat_id")
-        if not cid: fail+=1; continue
-        try: await context.bot.send_message(chat_id=cid, text=msg); sent+=1
-        except: fail+=1
-    await update.message.reply_text(f"نتیجه: ارسال {sent} | ناموفق {fail}")
+    if ev_id not in EVENTS_BY_ID: return await update.message.reply_text("event_id نامعتبر.")
+    targets = [r.chat_id for r in ROSTER.get(ev_id, []) if r.chat_id]
+    await start_broadcast(update, context, targets, msg, f"ارسال به {ev_id}")
 
 async def cmd_dmall(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_dc_admin(update): return
@@ -611,23 +1753,46 @@ async def cmd_dmall(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not msg and update.message.reply_to_message:
         msg = update.message.reply_to_message.text or update.message.reply_to_message.caption or ""
     if not msg: return await update.message.reply_text("فرمت: /dmall پیام (یا reply کنید و فقط /dmall بفرستید)")
-    sent=fail=0
-    for cid in list(ALL_USERS.keys()):
-        try: await context.bot.send_message(chat_id=cid, text=msg); sent+=1
-        except: fail+=1
-    await update.message.reply_text(f"نتیجه: ارسال {sent} | ناموفق {fail}")
+    await start_broadcast(update, context, list(ALL_USERS.keys()), msg, "ارسال همگانی")
+
+async def cmd_bcstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_dc_admin(update): return
+    jobs = {**{i: Broadcast.from_state(context.application, st) for i, st in _stored_broadcasts().items()}, **BROADCASTS}
+    if not jobs: return await update.message.reply_text("هیچ ارسال همگانی فعال یا متوقفی نیست.")
+    await update.message.reply_text("\n\n".join(j.status_text() for j in jobs.values()))
+
+async def cmd_bccontrol(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/bcpause, /bcresume, /bccancel <job_id>"""
+    if not _is_dc_admin(update): return
+    cmd = (update.message.text or "").split()[0].lstrip("/").split("@")[0]
+    job_id = context.args[0] if context.args else None
+    job = BROADCASTS.get(job_id)
+    st = None if job else _stored_broadcasts().get(job_id)
+    if not job and not st: return await update.message.reply_text(f"فرمت: /{cmd} <job_id> (لیست: /bcstatus)")
+    if cmd == "bcresume":
+        if job: return await update.message.reply_text("این ارسال در حال اجراست.")
+        job = Broadcast.from_state(context.application, st)
+        context.application.create_task(job.run())
+        return await update.message.reply_text(f"▶️ ادامه‌ی {job_id}")
+    if cmd == "bcpause" and job:
+        job.status = "paused"
+        return await update.message.reply_text(f"⏸ {job_id} متوقف می‌شود.")
+    if cmd == "bccancel":
+        if job: job.status = "cancelled"
+        else: STORE.del_meta(f"broadcast:{job_id}"); STORE.del_meta(f"broadcast_targets:{job_id}")
+        return await update.message.reply_text(f"⛔ {job_id} لغو شد.")
+    await update.message.reply_text("این ارسال در حال اجرا نیست.")
 
 async def shortcut_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_user(update.effective_user, update.effective_chat.id)
-    await save_users_pinned(context.application)
     await render_home(update, context)
 
 # ---------- Callback flow ----------
+@traced("handle_callback")
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; data = q.data
     await q.answer()
     add_user(q.from_user, q.message.chat.id if q.message else update.effective_chat.id)
-    await save_users_pinned(context.application)
 
     if data == "back_home": return await render_home(update, context, edit=True)
     if data == "back_step": return await go_back(update, context)
@@ -659,7 +1824,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not context.user_data.get("selected_event_id"): return await render_event_list(update)
         if not target_ev and context.user_data.get("selected_event_id"):
             target_ev = get_event(context.user_data["selected_event_id"])
-        if target_ev and target_ev.get("capacity") and remaining_capacity(target_ev) <= 0:
+        if seat_refusal(target_ev, update.effective_chat.id, None) == "capacity":
             return await safe_q_edit(q, CAPACITY_FULL_PREVENT_MSG, reply_markup=MK([[B("↩️ بازگشت", callback_data="back_home")]]))
         return await render_rules(update, context)
 
@@ -678,11 +1843,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = data.split("_")
             ev_id = parts[-1]
             user_chat_id = update.effective_chat.id
-            lst = ROSTER.get(ev_id, [])
-            new_lst = [r for r in lst if r.get("chat_id") != user_chat_id]
-            removed = len(lst) - len(new_lst)
-            ROSTER[ev_id] = new_lst
-            await save_roster_pinned(context.application)
+            removed = roster_remove(ev_id, user_chat_id)
+            held = PENDING.get(user_chat_id)
+            if held and held.event_id == ev_id:      # درخواست در انتظار → صندلی رزرو آزاد شود
+                pending_pop(user_chat_id); removed += 1
+                try: await context.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=held.admin_msg_id)
+                except Exception as e: log_event("admin_msg_delete_failed", message_id=held.admin_msg_id, error=e)
             if removed:
                 await safe_q_edit(q, "✅ لغو ثبت‌نام شما انجام شد.")
             else:
@@ -705,18 +1871,24 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             action, user_chat_id, ev_id = data.split("_", 2); user_chat_id = int(user_chat_id)
             ev = get_event(ev_id)
-            if action == "approve" and ev and ev.get("capacity") and remaining_capacity(ev) <= 0:
-                await q.answer("ظرفیت تکمیل است؛ امکان تایید نیست.", show_alert=True)
-                try: await safe_q_edit(q, (q.message.text or "") + "\n\n⚠️ ظرفیت تکمیل.")
-                except: pass
+            # اول صندلی به‌صورت اتمیک تبدیل/آزاد می‌شود، بعد پیام‌ها؛ کلیک دوباره یا auto-approve هم‌زمان بی‌اثر است
+            if action == "approve": info, reason = confirm_seat(user_chat_id, ev_id)
+            else:
+                info, reason = PENDING.get(user_chat_id), None
+                if info and (info.event_id or "NA") == ev_id: pending_pop(user_chat_id)
+                else: info = None
+            if not info:
+                await q.answer("این درخواست قبلاً رسیدگی شده است.", show_alert=True)
+                try: await q.edit_message_reply_markup(reply_markup=None)
+                except Exception as e: log_event("markup_clear_failed", error=e)
                 return
-            info_preview = PENDING.get(user_chat_id, {})
-            if action == "approve" and info_preview.get("gender") == "male" and male_count(ev_id) >= MALE_LIMIT_PER_EVENT:
-                await q.answer("سقف آقایان تکمیل است؛ امکان تایید نیست.", show_alert=True)
-                try: await safe_q_edit(q, (q.message.text or "") + "\n\n⚠️ سقف آقایان تکمیل.")
-                except: pass
-                try: await context.bot.send_message(chat_id=user_chat_id, text=MALE_CAPACITY_FULL_MSG)
-                except: pass
+            if reason:
+                full = "ظرفیت تکمیل" if reason == "capacity" else "سقف آقایان تکمیل"
+                await q.answer(f"{full} است؛ امکان تایید نیست.", show_alert=True)
+                try: await safe_q_edit(q, (q.message.text or "") + f"\n\n⚠️ {full}.")
+                except Exception as e: log_event("admin_msg_edit_failed", error=e)
+                try: await context.bot.send_message(chat_id=user_chat_id, text=CAPACITY_CANCEL_MSG if reason == "capacity" else MALE_CAPACITY_FULL_MSG)
+                except Exception as e: log_event("notify_failed", chat_id=user_chat_id, action=reason, error=e)
                 return
 
             if action == "approve":
@@ -728,51 +1900,28 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                           f"📝 {ev.get('desc','—')}\n") if ev else "🎉 ثبت‌نامت تایید شد!"
                 link = MEETUP_LINKS.get(ev_id)
                 if link: detail += f"\n🔗 لینک هماهنگی:\n{link}"
-                await context.bot.send_message(chat_id=user_chat_id, text=detail)
+                try: await context.bot.send_message(chat_id=user_chat_id, text=detail)
+                except Exception as e: log_event("notify_failed", chat_id=user_chat_id, action="approve", error=e)
             else:
-                await context.bot.send_message(chat_id=user_chat_id, text=CAPACITY_CANCEL_MSG)
+                try: await context.bot.send_message(chat_id=user_chat_id, text=CAPACITY_CANCEL_MSG)
+                except Exception as e: log_event("notify_failed", chat_id=user_chat_id, action="reject", error=e)
 
             try: await safe_q_edit(q, (q.message.text or "") + "\n\n" + ("✅ تایید شد." if action=="approve" else "❌ رد شد."))
-            except:
+            except Exception as e:
+                log_event("admin_msg_edit_failed", error=e)
                 try: await q.edit_message_reply_markup(reply_markup=None)
-                except: pass
-
-            info = PENDING.get(user_chat_id)
-            if info and info.get("task"):
-                try: info["task"].cancel()
-                except: pass
+                except Exception as e: log_event("markup_clear_failed", error=e)
 
-            if action == "approve":
-                info = PENDING.pop(user_chat_id, None)
-                if info:
-                    if ev and ev.get("capacity") and remaining_capacity(ev) <= 0:
-                        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="⚠️ ظرفیت پر شد؛ تایید نهایی انجام نشد.")
-                    else:
-                        if info.get("gender") == "male" and male_count(ev_id) >= MALE_LIMIT_PER_EVENT:
-                            try: await context.bot.send_message(chat_id=user_chat_id, text=MALE_CAPACITY_FULL_MSG)
-                            except: pass
-                        else:
-                            ROSTER.setdefault(ev_id, []).append({
-                                "chat_id": user_chat_id,
-                                "name": info.get("name","—"),
-                                "username": info.get("username"),
-                                "phone": info.get("phone","—"),
-                                "gender": info.get("gender"),
-                                "age": info.get("age"),
-                                "when": info.get("when","—"),
-                                "event_title": info.get("event_title","—"),
-                            })
-                            await save_roster_pinned(context.application)
             await q.answer("انجام شد.")
-        except Exception as e:
-            print("Admin callback error:", e)
+        except Exception:
+            log.exception("admin_callback_error", extra={"fields": {"data": data}})
             await q.answer("مشکل پیش آمد.", show_alert=True)
         return
 
 # ---------- Messages ----------
+@traced("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_user(update.effective_user, update.effective_chat.id)
-    await save_users_pinned(context.application)
 
     text = (update.message.text or "").strip()
     step = context.user_data.get("step")
@@ -820,24 +1969,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return await render_home(update, context)
 
+@traced("handle_contact")
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_user(update.effective_user, update.effective_chat.id)
-    await save_users_pinned(context.application)
     if context.user_data.get("step") == "phone":
         context.user_data["phone"] = update.message.contact.phone_number
         await update.message.reply_text("شماره دریافت شد ✅", reply_markup=reply_main)
         await render_note(update, context, edit=False)
 
+@traced("finalize_and_send")
 async def finalize_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = context.user_data
     ev_id = u.get("selected_event_id") or (EVENTS[0]["id"] if EVENTS else None)
     ev = get_event(ev_id)
 
-    if ev and ev.get("capacity") and remaining_capacity(ev) <= 0:
+    user_chat_id = update.effective_chat.id
+    info = PendingRegistration(
+        user_chat_id, ev_id, name=u.get('name','—'), phone=u.get('phone','—'), level=u.get('level','—'), note=u.get('note','—'),
+        gender=u.get('gender'), age=u.get('age'),
+        username=update.effective_user.username if update.effective_user else None,
+        due=time.time() + AUTO_APPROVE_DELAY,
+    )
+    # بدون گروه ادمین تاییدی در کار نیست → فقط بررسی، بدون رزرو
+    refusal = reserve_seat(ev, user_chat_id, info) if GROUP_CHAT_ID else seat_refusal(ev, user_chat_id, u.get("gender"))
+
+    if refusal == "capacity":
         await update.effective_chat.send_message(CAPACITY_CANCEL_MSG, reply_markup=reply_main)
         clear_flow(context); return
 
-    if u.get("gender") == "male" and ev_id and male_count(ev_id) >= MALE_LIMIT_PER_EVENT:
+    if refusal == "male":
         await update.effective_chat.send_message(MALE_CAPACITY_FULL_MSG, reply_markup=reply_main)
         if CHANNEL_URL: await update.effective_chat.send_message(f"📢 از اخبار جا نمونی، عضو کانال شو:\n{CHANNEL_URL}")
         clear_flow(context); return
@@ -852,66 +2012,86 @@ async def finalize_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📝 توضیحات: {u.get('note','—')}\n"
     )
     if ev: summary += f"\n📌 رویداد: {ev.get('title','')}\n🕒 زمان: {ev.get('when','')}\n(آدرس پس از تایید ارسال می‌شود.)"
-    await update.effective_chat.send_message(summary, reply_markup=reply_main)
-    if CHANNEL_URL: await update.effective_chat.send_message(f"📢 برای اینکه از اخبار جا نمونی، عضو کانال شو:\n{CHANNEL_URL}")
-
-    if GROUP_CHAT_ID:
-        user_chat_id = update.effective_chat.id
-        approve_cb = f"approve_{user_chat_id}_{ev_id or 'NA'}"
-        reject_cb  = f"reject_{user_chat_id}_{ev_id or 'NA'}"
-        buttons = MK([[B("✅ تایید", callback_data=approve_cb), B("❌ رد", callback_data=reject_cb)]])
-        admin_txt = (
-            "🔔 ثبت‌نام جدید\n\n"
-            f"👤 نام: {u.get('name','—')}\n"
-            f"⚧ جنسیت: {({'male':'مرد','female':'زن'}).get(u.get('gender'),'—')}\n"
-            f"🎂 سن: {u.get('age','—') if u.get('age') is not None else '—'}\n"
-            f"🗣️ سطح: {u.get('level','—')}\n"
-            f"📱 تماس: {u.get('phone','—')}\n"
-            f"📝 توضیحات: {u.get('note','—')}\n\n"
-        )
-        if ev: admin_txt += event_text_admin(ev)
-        admin_msg = await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=admin_txt, reply_markup=buttons)
-
-        task = context.application.create_task(delayed_auto_approve(context.application, user_chat_id, ev_id, delay=AUTO_APPROVE_DELAY))
-        PENDING[user_chat_id] = {
-            "name": u.get('name','—'), "phone": u.get('phone','—'), "level": u.get('level','—'), "note":  u.get('note','—'),
-            "gender": u.get('gender'), "age": u.get('age'), "event_id": ev_id,
-            "event_title": ev.get('title') if ev else "—", "when": ev.get('when') if ev else "—",
-            "username": update.effective_user.username if update.effective_user else None,
-            "admin_msg_id": admin_msg.message_id if admin_msg else None, "task": task,
-        }
+    try:
+        await update.effective_chat.send_message(summary, reply_markup=reply_main)
+        if CHANNEL_URL: await update.effective_chat.send_message(f"📢 برای اینکه از اخبار جا نمونی، عضو کانال شو:\n{CHANNEL_URL}")
+
+        if GROUP_CHAT_ID:
+            approve_cb = f"approve_{user_chat_id}_{ev_id or 'NA'}"
+            reject_cb  = f"reject_{user_chat_id}_{ev_id or 'NA'}"
+            buttons = MK([[B("✅ تایید", callback_data=approve_cb), B("❌ رد", callback_data=reject_cb)]])
+            admin_txt = (
+                "🔔 ثبت‌نام جدید\n\n"
+                f"👤 نام: {u.get('name','—')}\n"
+                f"⚧ جنسیت: {({'male':'مرد','female':'زن'}).get(u.get('gender'),'—')}\n"
+                f"🎂 سن: {u.get('age','—') if u.get('age') is not None else '—'}\n"
+                f"🗣️ سطح: {u.get('level','—')}\n"
+                f"📱 تماس: {u.get('phone','—')}\n"
+                f"📝 توضیحات: {u.get('note','—')}\n\n"
+            )
+            if ev: admin_txt += event_text_admin(ev)
+            admin_msg = await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=admin_txt, reply_markup=buttons)
+    except Exception:
+        if GROUP_CHAT_ID and PENDING.get(user_chat_id) is info: pending_pop(user_chat_id)   # رزرو بی‌صاحب نماند
+        raise
+
+    if GROUP_CHAT_ID and PENDING.get(user_chat_id) is info:
+        info.admin_msg_id = admin_msg.message_id if admin_msg else None
+        pending_put(user_chat_id, info)
+        schedule_auto_approve(user_chat_id, ev_id, info.due)   # pending_put → ROSTER_DIRTY؛ STORE همین حالا PENDING را دارد
 
     clear_flow(context)
 
 # =========================
 #  AUTO-APPROVE (12h)
 # =========================
-async def delayed_auto_approve(app, user_chat_id: int, ev_id: str, delay: int = AUTO_APPROVE_DELAY):
-    try: await asyncio.sleep(delay)
-    except asyncio.CancelledError: return
-    info = PENDING.get(user_chat_id);  ev = get_event(ev_id)
-    if not info or not ev: PENDING.pop(user_chat_id, None); return
-    if ev.get("capacity") and remaining_capacity(ev) <= 0:
-        try: await app.bot.send_message(chat_id=user_chat_id, text=CAPACITY_CANCEL_MSG)
-        except: pass
-        try:
-            if info.get("admin_msg_id"): await app.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=info["admin_msg_id"])
-        except: pass
-        PENDING.pop(user_chat_id, None); return
-    if info.get("gender") == "male" and male_count(ev_id) >= MALE_LIMIT_PER_EVENT:
-        try: await app.bot.send_message(chat_id=user_chat_id, text=MALE_CAPACITY_FULL_MSG)
-        except: pass
-        try:
-            if info.get("admin_msg_id"): await app.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=info["admin_msg_id"])
-        except: pass
-        PENDING.pop(user_chat_id, None); return
+# یک heap از (due, chat_id, event_id) و یک کوروتین که تا نزدیک‌ترین موعد می‌خوابد؛
+# ورودی‌های باطل (approve/reject شده) هنگام pop نادیده گرفته می‌شوند.
+APPROVAL_HEAP = []
+APPROVAL_WAKE = asyncio.Event()
+
+def schedule_auto_approve(user_chat_id: int, ev_id: str, due: float):
+    heapq.heappush(APPROVAL_HEAP, (due, user_chat_id, ev_id))
+    APPROVAL_WAKE.set()
+
+def recover_auto_approvals():
+    """Re-arm timers for every restored PENDING entry (legacy entries get a fresh window)."""
+    APPROVAL_HEAP.clear()
+    for cid, info in list(PENDING.items()):
+        if not info.due:
+            info.due = time.time() + AUTO_APPROVE_DELAY
+            pending_put(cid, info)
+        schedule_auto_approve(cid, info.event_id, info.due)
+
+async def approval_scheduler(app):
+    while True:
+        APPROVAL_WAKE.clear()
+        while APPROVAL_HEAP and APPROVAL_HEAP[0][0] <= time.time():
+            due, user_chat_id, ev_id = heapq.heappop(APPROVAL_HEAP)
+            info = PENDING.get(user_chat_id)
+            if not info or info.due != due or info.event_id != ev_id: continue   # stale
+            try: await auto_approve(app, user_chat_id, ev_id)
+            except Exception as e: log_event("auto_approve_failed", logging.ERROR, chat_id=user_chat_id, event_id=ev_id, error=e)
+        timeout = max(0, APPROVAL_HEAP[0][0] - time.time()) if APPROVAL_HEAP else None
+        try: await asyncio.wait_for(APPROVAL_WAKE.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+async def _drop_pending(app, user_chat_id: int, info: PendingRegistration):
+    try:
+        if info.admin_msg_id: await app.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=info.admin_msg_id)
+    except Exception as e: log_event("admin_msg_delete_failed", message_id=info.admin_msg_id, error=e)
+    pending_pop(user_chat_id)
 
-    ROSTER.setdefault(ev_id, []).append({
-        "chat_id": user_chat_id, "name": info.get("name","—"), "username": info.get("username"),
-        "phone": info.get("phone","—"), "gender": info.get("gender"), "age": info.get("age"),
-        "when": info.get("when","—"), "event_title": info.get("event_title","—"),
-    })
-    await save_roster_pinned(app)
+@traced("auto_approve")
+async def auto_approve(app, user_chat_id: int, ev_id: str):
+    ev = get_event(ev_id)
+    if not ev: pending_pop(user_chat_id); return
+    info, reason = confirm_seat(user_chat_id, ev_id)
+    if not info: return
+    if reason:
+        try: await app.bot.send_message(chat_id=user_chat_id, text=CAPACITY_CANCEL_MSG if reason == "capacity" else MALE_CAPACITY_FULL_MSG)
+        except Exception as e: log_event("notify_failed", chat_id=user_chat_id, action=reason, error=e)
+        return await _drop_pending(app, user_chat_id, info)
 
     detail = ("🎉 ثبت‌نامت تایید شد!\n\n"
               f"📌 {ev.get('title','')}\n"
@@ -923,18 +2103,113 @@ async def delayed_auto_approve(app, user_chat_id: int, ev_id: str, delay: int =
     link = MEETUP_LINKS.get(ev_id)
     if link: detail += f"\n🔗 لینک هماهنگی:\n{link}"
     try: await app.bot.send_message(chat_id=user_chat_id, text=detail)
-    except: pass
+    except Exception as e: log_event("notify_failed", chat_id=user_chat_id, action="auto_approve", error=e)
+    await _drop_pending(app, user_chat_id, info)
 
-    try:
-        if info.get("admin_msg_id"): await app.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=info["admin_msg_id"])
-    except: pass
-    PENDING.pop(user_chat_id, None)
+# =========================
+#     UPDATE DISPATCHER
+# =========================
+class UpdateDispatcher:
+    """Per-chat ordered, cross-chat concurrent processing of webhook updates.
+
+    Every chat gets its own FIFO lane drained by one short-lived task, so a
+    chat's updates (and its context.user_data) are handled strictly in
+    order. Lanes of different chats run in parallel, capped globally at
+    WEBHOOK_WORKERS handlers at a time; at most WEBHOOK_QUEUE_SIZE updates
+    may be queued or running before submit() starts refusing.
+
+    The last UPDATE_DEDUPE_SIZE accepted update_ids are remembered (and kept
+    in STORE across restarts), so Telegram re-deliveries are acknowledged
+    without being processed again.
+    """
+    def __init__(self, app, concurrency: int = WEBHOOK_WORKERS, maxsize: int = WEBHOOK_QUEUE_SIZE,
+                 dedupe: int = UPDATE_DEDUPE_SIZE):
+        self.app = app
+        self.slots = asyncio.Semaphore(max(1, maxsize))       # queued + running
+        self.running = asyncio.Semaphore(max(1, concurrency))  # global cap
+        self.lanes = {}      # chat key -> deque[(update, enqueued_at)]
+        self.tasks = {}      # chat key -> lane task
+        self.queued = 0; self.inflight = 0
+        self.processed = 0; self.rejected = 0; self.failed = 0; self.duplicates = 0
+        self.seen = set(); self.seen_order = deque(); self.dedupe = dedupe
+        self.waits = deque(maxlen=1024)   # آخرین زمان‌های انتظار (ثانیه)
+        self.wait_max = 0.0
+        self.accepting = False
+        self.idle = asyncio.Event(); self.idle.set()
+
+    @staticmethod
+    def chat_key(update: Update) -> int:
+        chat = update.effective_chat
+        return chat.id if chat else update.update_id
+
+    def depth(self) -> int: return self.queued
+
+    def _remember(self, update_id: int):
+        self.seen.add(update_id); self.seen_order.append(update_id)
+        while len(self.seen_order) > self.dedupe: self.seen.discard(self.seen_order.popleft())
+
+    async def submit(self, update: Update, timeout: float = WEBHOOK_ENQUEUE_TIMEOUT) -> bool:
+        """Queue an update; False means "retry later" (503). Duplicates return True without queueing."""
+        if update.update_id in self.seen: self.duplicates += 1; return True
+        if not self.accepting: self.rejected += 1; return False
+        try: await asyncio.wait_for(self.slots.acquire(), timeout)
+        except asyncio.TimeoutError: self.rejected += 1; return False
+        if update.update_id in self.seen:          # هم‌زمان با انتظار ما پذیرفته شد
+            self.slots.release(); self.duplicates += 1; return True
+        self._remember(update.update_id)
+        key = self.chat_key(update)
+        self.lanes.setdefault(key, deque()).append((update, time.monotonic()))
+        self.queued += 1; self.idle.clear()
+        if key not in self.tasks: self.tasks[key] = asyncio.create_task(self._lane(key))
+        return True
+
+    async def _lane(self, key):
+        lane = self.lanes[key]
+        try:
+            while lane:
+                update, t0 = lane[0]
+                async with self.running:
+                    lane.popleft(); self.queued -= 1; self.inflight += 1
+                    wait = time.monotonic() - t0
+                    self.waits.append(wait); self.wait_max = max(self.wait_max, wait)
+                    try:
+                        await self.app.process_update(update)
+                    except Exception:
+                        self.failed += 1; log.exception("update_failed", extra={"fields": {"update_id": update.update_id}})
+                    finally:
+                        self.inflight -= 1; self.processed += 1; self.slots.release()
+        finally:
+            self.lanes.pop(key, None); self.tasks.pop(key, None)
+            if not self.tasks: self.idle.set()
+
+    def stats(self) -> dict:
+        w = sorted(self.waits)
+        pct = lambda p: round(w[min(len(w) - 1, int(len(w) * p))] * 1000, 1) if w else 0.0
+        return {"lanes": len(self.lanes), "queue_depth": self.queued, "inflight": self.inflight,
+                "processed": self.processed, "rejected": self.rejected, "failed": self.failed, "duplicates": self.duplicates,
+                "wait_ms_p50": pct(.5), "wait_ms_p99": pct(.99), "wait_ms_max": round(self.wait_max * 1000, 1)}
+
+    def start(self):
+        for uid in STORE.get_meta("seen_updates") or []: self._remember(uid)
+        self.accepting = True
+
+    async def stop(self, drain_timeout: float = 10):
+        self.accepting = False
+        try: await asyncio.wait_for(self.idle.wait(), drain_timeout)
+        except asyncio.TimeoutError: log_event("dispatcher_dropping", queued=self.queued)
+        tasks = list(self.tasks.values())
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        STORE.set_meta("seen_updates", list(self.seen_order))
 
 # =========================
 #     PTB + FastAPI APP
 # =========================
 if not BOT_TOKEN: raise RuntimeError("BOT_TOKEN is not set")
-application = ApplicationBuilder().token(BOT_TOKEN).job_queue(None).build()
+_builder = ApplicationBuilder().token(BOT_TOKEN).job_queue(None)
+if BOT_API_BASE_URL: _builder = _builder.base_url(BOT_API_BASE_URL)
+if TRACE: _builder = _builder.request(TracedRequest(connection_pool_size=256)).get_updates_request(TracedRequest())
+application = _builder.build()
 
 # Handlers
 application.add_handler(CommandHandler("start", cmd_start))
@@ -944,6 +2219,8 @@ application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^شروع\
 application.add_handler(CommandHandler("dm",      cmd_dm))
 application.add_handler(CommandHandler("dmevent", cmd_dmevent))
 application.add_handler(CommandHandler("dmall",   cmd_dmall))
+application.add_handler(CommandHandler("bcstatus", cmd_bcstatus))
+application.add_handler(CommandHandler(["bcpause", "bcresume", "bccancel"], cmd_bccontrol))
 
 application.add_handler(CallbackQueryHandler(handle_callback))
 application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
@@ -952,26 +2229,241 @@ application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_m
 application.add_handler(CommandHandler("testpin", cmd_testpin))
 application.add_handler(CommandHandler("roster",  cmd_roster))
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+DISPATCHER = UpdateDispatcher(application)
+
+_background: list[asyncio.Task] = []
+
+async def startup(webhook: bool = True):
+    global STORE
+    STORE = open_store()
     await application.initialize()
-    if WEBHOOK_URL: await application.bot.set_webhook(url=WEBHOOK_URL)
+    if not webhook:
+        # با وبهوک فعال، getUpdates خطای Conflict می‌دهد؛ poll_updates با backoff صبر می‌کند تا وبهوک برداشته شود
+        if POLL_TAKEOVER: await application.bot.delete_webhook()
+        else: log_event("poll_standby", logging.INFO, note="webhook left in place; set POLL_TAKEOVER=1 to take over")
+    elif WEBHOOK_URL: await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
     await application.start()
     # بازیابی
-    await restore_roster_from_pinned(application)  # DC1
-    await restore_users_from_pinned(application)   # DC2
-    yield
+    await restore_state(application)
+    recover_auto_approvals()
+    resume_broadcasts(application)
+    _background[:] = [asyncio.create_task(users_flusher(application)), asyncio.create_task(roster_flusher(application)),
+                      asyncio.create_task(approval_scheduler(application))]
+    DISPATCHER.start()
+
+async def shutdown():
+    global STORE
+    await DISPATCHER.stop()
+    for t in _background: t.cancel()
+    for t in _background:
+        try: await t
+        except asyncio.CancelledError: pass
+    _background.clear()
+    try: await flush_users_pinned(application)     # forced flush قبل از خاموشی
+    except Exception as e: log_event("final_users_flush_failed", logging.ERROR, error=e)
+    try: await flush_roster_pinned(application)
+    except Exception as e: log_event("final_roster_flush_failed", logging.ERROR, error=e)
     await application.stop(); await application.shutdown()
+    STORE.close(); STORE = MemoryStore()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup(webhook=True)
+    yield
+    await shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
+_json_loads = orjson.loads if orjson else json.loads
+_SECRET = WEBHOOK_SECRET.encode()
+WEBHOOK_REJECTED = {"secret": 0, "too_large": 0, "bad_request": 0}
+
+def _reply(status: str, code: int = 200) -> Response:
+    return Response(b'{"status":"%s"}' % status.encode(), status_code=code, media_type="application/json")
+
+async def _read_body(request: Request, limit: int) -> bytes | None:
+    """Request body, or None as soon as it exceeds `limit` bytes (without reading the rest)."""
+    cl = request.headers.get("content-length")
+    if cl and cl.isdigit() and int(cl) > limit: return None
+    chunks, n = [], 0
+    async for chunk in request.stream():
+        n += len(chunk)
+        if n > limit: return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
 @app.post("/")
 async def webhook(request: Request):
-    body = await request.json()
-    update = Update.de_json(body, application.bot)
-    await application.process_update(update)
-    return {"status":"ok"}
+    # ارزان‌ترین بررسی‌ها اول: هدر secret، اندازه، بعد parse؛ Update فقط برای آپدیت تازه ساخته می‌شود
+    if _SECRET and not hmac.compare_digest(request.headers.get("x-telegram-bot-api-secret-token", "").encode(), _SECRET):
+        WEBHOOK_REJECTED["secret"] += 1; return _reply("forbidden", 403)
+    raw = await _read_body(request, WEBHOOK_MAX_BODY)
+    if raw is None: WEBHOOK_REJECTED["too_large"] += 1; return _reply("too large", 413)
+    try: body = _json_loads(raw)
+    except Exception: body = None
+    if not isinstance(body, dict) or not isinstance(body.get("update_id"), int):
+        WEBHOOK_REJECTED["bad_request"] += 1; return _reply("bad request", 400)
+    if body["update_id"] in DISPATCHER.seen: DISPATCHER.duplicates += 1; return _reply("ok")
+    if not await DISPATCHER.submit(Update.de_json(body, application.bot)):
+        return _reply("busy", 503)
+    return _reply("ok")
+
+# =========================
+#        METRICS
+# =========================
+# قالب متنی Prometheus بدون وابستگی اضافه. هیستوگرام‌های span و Bot API فقط با TRACE=1 پر می‌شوند.
+def _prom_labels(labels: dict) -> str:
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+class _PromText:
+    """Collects samples per family so each family is emitted as one contiguous block."""
+    def __init__(self): self.families = {}
+
+    def family(self, name: str, kind: str, help_: str):
+        self.families[name] = [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+
+    def sample(self, name: str, value, **labels):
+        fam = name if name in self.families else name.rsplit("_", 1)[0]   # x_bucket / x_sum / x_count → x
+        self.families[fam].append(f"{name}{_prom_labels(labels)} {value}")
+
+    def histogram(self, name: str, rows: dict, label: str):
+        """rows: label value -> (count, sum_s, bucket counts) as kept by _observe."""
+        for lv, (count, total, buckets) in rows.items():
+            acc = 0
+            for le, n in zip(LATENCY_BUCKETS, buckets):
+                acc += n; self.sample(f"{name}_bucket", acc, **{label: lv, "le": le})
+            self.sample(f"{name}_bucket", count, **{label: lv, "le": "+Inf"})
+            self.sample(f"{name}_sum", round(total, 6), **{label: lv})
+            self.sample(f"{name}_count", count, **{label: lv})
+
+    def text(self) -> str: return "\n".join(l for lines in self.families.values() for l in lines) + "\n"
+
+def render_metrics() -> str:
+    p = _PromText(); d = DISPATCHER
+    p.family("cbot_updates_total", "counter", "Updates by outcome (processed, failed, rejected with 503, duplicate re-deliveries).")
+    for outcome, v in (("processed", d.processed), ("failed", d.failed), ("rejected", d.rejected), ("duplicate", d.duplicates)):
+        p.sample("cbot_updates_total", v, outcome=outcome)
+    p.family("cbot_webhook_rejected_total", "counter", "Webhook requests refused before parsing an Update.")
+    for reason, v in WEBHOOK_REJECTED.items(): p.sample("cbot_webhook_rejected_total", v, reason=reason)
+    p.family("cbot_update_queue_depth", "gauge", "Updates queued and not yet started.")
+    p.sample("cbot_update_queue_depth", d.queued)
+    p.family("cbot_update_inflight", "gauge", "Updates being handled right now.")
+    p.sample("cbot_update_inflight", d.inflight)
+    p.family("cbot_update_lanes", "gauge", "Chats with queued or running updates.")
+    p.sample("cbot_update_lanes", len(d.lanes))
+    st = d.stats()
+    p.family("cbot_update_wait_seconds", "gauge", "Enqueue-to-start wait over the last 1024 updates.")
+    for q, k in (("0.5", "wait_ms_p50"), ("0.99", "wait_ms_p99"), ("1", "wait_ms_max")):
+        p.sample("cbot_update_wait_seconds", st[k] / 1000, quantile=q)
+
+    p.family("cbot_span_duration_seconds", "histogram", "Handler / pinned-save duration (TRACE=1).")
+    p.histogram("cbot_span_duration_seconds", {k: (s[0], s[2], s[4]) for k, s in SPANS.items()}, "span")
+    p.family("cbot_span_errors_total", "counter", "Spans that raised (TRACE=1).")
+    for k, s in SPANS.items(): p.sample("cbot_span_errors_total", s[1], span=k)
+
+    by_method = {}
+    for (m, _), s in API_CALLS.items():
+        c = by_method.setdefault(m, [0, 0.0, [0] * len(s[4])])
+        c[0] += s[0]; c[1] += s[2]; c[2] = [a + b for a, b in zip(c[2], s[4])]
+    p.family("cbot_api_requests_total", "counter", "Bot API calls by method and outcome (HTTP status or exception; TRACE=1).")
+    for (m, o), s in API_CALLS.items(): p.sample("cbot_api_requests_total", s[0], method=m, outcome=o)
+    p.family("cbot_api_request_duration_seconds", "histogram", "Bot API call latency by method (TRACE=1).")
+    p.histogram("cbot_api_request_duration_seconds", {m: tuple(c) for m, c in by_method.items()}, "method")
+
+    p.family("cbot_pinned_save_requests_total", "counter", "Pinned-save requests (before single-flight collapsing).")
+    p.family("cbot_pinned_save_runs_total", "counter", "Pinned saves actually run.")
+    for dc, sf in (("roster", ROSTER_SAVES), ("users", USERS_SAVES)):
+        p.sample("cbot_pinned_save_requests_total", sf.calls, dc=dc)
+        p.sample("cbot_pinned_save_runs_total", sf.runs, dc=dc)
+
+    p.family("cbot_users", "gauge", "Known users (DC2).")
+    p.sample("cbot_users", len(ALL_USERS))
+    p.family("cbot_pending_approvals", "gauge", "Registrations waiting for approval (held seats).")
+    p.sample("cbot_pending_approvals", len(PENDING))
+    p.family("cbot_event_seats", "gauge", "Seats per event by state.")
+    p.family("cbot_event_fill_ratio", "gauge", "(approved + held) / capacity; absent for events without capacity.")
+    for e in EVENTS:
+        eid = e["id"]; approved = approved_count(eid); held = len(HOLDS.get(eid, ())); cap = int(e.get("capacity") or 0)
+        p.sample("cbot_event_seats", approved, event=eid, state="approved")
+        p.sample("cbot_event_seats", held, event=eid, state="held")
+        p.sample("cbot_event_seats", male_count(eid), event=eid, state="approved_male")
+        if cap:
+            p.sample("cbot_event_seats", cap, event=eid, state="capacity")
+            p.sample("cbot_event_fill_ratio", round((approved + held) / cap, 4), event=eid)
+
+    p.family("cbot_broadcast_messages", "gauge", "Running broadcasts: targets, sent, failed, remaining.")
+    for j in BROADCASTS.values():
+        remaining = len(j.targets) - j.pos - len(j.done)
+        for k, v in (("targets", len(j.targets)), ("sent", j.sent), ("failed", j.failed), ("remaining", remaining)):
+            p.sample("cbot_broadcast_messages", v, job=j.id, kind=k)
+    return p.text()
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    return {**DISPATCHER.stats(), **(trace_stats() if TRACE else {})}
 
 @app.get("/")
 async def root():
     return {"status":"ChillChat bot running (DC1+DC2 paged, JSON on separate pages, safe edits, CSV/JSON EVENTS_JSON, cancel register, no jobqueue)."}
+
+# =========================
+#      POLLING RUNNER
+# =========================
+POLL_STATS = {"batches": 0, "updates": 0, "empty": 0, "errors": 0, "offset": None}
+
+async def poll_updates(app, timeout: int = POLL_TIMEOUT, limit: int = POLL_LIMIT):
+    """Long-poll getUpdates and feed DISPATCHER — the polling-mode counterpart of the webhook route.
+
+    The offset only moves past an update once DISPATCHER has taken it, so a
+    full queue simply holds the batch (no 503/redelivery round trip) and a
+    restart resumes from the first unconfirmed update.
+    """
+    backoff = 1.0
+    while True:
+        try:
+            updates = await app.bot.get_updates(offset=POLL_STATS["offset"], timeout=timeout, limit=limit)
+        except RetryAfter as e:
+            POLL_STATS["errors"] += 1; await asyncio.sleep(e.retry_after); continue
+        except (NetworkError, Conflict) as e:           # TimedOut زیرکلاس NetworkError است
+            POLL_STATS["errors"] += 1; log_event("poll_failed", error=e, retry_in=backoff)
+            await asyncio.sleep(backoff); backoff = min(backoff * 2, POLL_RETRY_MAX); continue
+        backoff = 1.0; POLL_STATS["batches"] += 1
+        if not updates: POLL_STATS["empty"] += 1; continue
+        for u in updates:
+            if not await DISPATCHER.submit(u, timeout=None):   # فقط وقتی در حال خاموشی هستیم
+                return
+            POLL_STATS["offset"] = u.update_id + 1; POLL_STATS["updates"] += 1
+
+async def run_polling():
+    await startup(webhook=False)
+    log_event("polling_started", logging.INFO, timeout=POLL_TIMEOUT, limit=POLL_LIMIT)
+    stop = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError): pass
+    poller = asyncio.create_task(poll_updates(application)); stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({poller, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in (poller, stopper): t.cancel()
+        await asyncio.gather(poller, stopper, return_exceptions=True)
+        if POLL_STATS["offset"] is not None:   # تایید آخرین دسته نزد تلگرام تا پس از ری‌استارت دوباره تحویل نشود
+            try: await application.bot.get_updates(offset=POLL_STATS["offset"], timeout=0, limit=1)
+            except Exception: pass
+        await shutdown()
+        log_event("polling_stopped", logging.INFO, **POLL_STATS, **DISPATCHER.stats())
+    if poller.done() and not poller.cancelled() and poller.exception(): raise poller.exception()
+
+if __name__ == "__main__":
+    mode = (sys.argv[1] if len(sys.argv) > 1 else RUN_MODE).lower()
+    if mode == "polling":
+        asyncio.run(run_polling())
+    else:
+        import uvicorn
+        uvicorn.run(app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "10000")))
@@ -0,0 +1,205 @@
+# bench_funnel.py — End-to-end benchmark of the registration funnel against fakebot.py
+# N کاربر شبیه‌سازی‌شده کل مسیر ثبت‌نام را طی می‌کنند و ادمین تایید می‌کند:
+#   /start → list_events → event_<id> → register_<id> → accept_rules → name → gender → age → level → phone → note → approve_
+#
+#   python bench_funnel.py --users 50 --concurrency 25
+#   python bench_funnel.py --users 200 --mode polling --latency 0.03 --group-per-min 20 --json out.json
+#   python bench_funnel.py --set DC_PAGE_RATE=600 --set WEBHOOK_WORKERS=32
+#
+# گزارش: throughput، p50/p95/p99 هر مرحله (از تحویل آپدیت تا دیده‌شدن پاسخ ربات در Bot API جعلی)،
+# تعداد فراخوانی Bot API به ازای هر ثبت‌نام و رشد حافظه (RSS و در صورت --tracemalloc، heap پایتون).
+# Bot API جعلی در همین پروسه اجرا می‌شود، پس CPU آن هم در زمان‌ها هست؛ تاخیر شبکه را با --latency/--jitter مدل کن.
+# تاییدها همه از گروه ادمین می‌آیند (یک lane ترتیب‌دار)؛ DC1 write-behind است و هر ROSTER_SAVE_DELAY ثانیه زیر سقف DC_PAGE_RATE ذخیره می‌شود.
+
+import os, sys, json, time, asyncio, argparse, tempfile, gc
+from collections import Counter
+
+ADMIN_ID = 777
+GROUP_ID = -100          # گروه ادمین = DC1
+DC2_ID = -200
+EVENT_ID = "bench"
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot registration funnel benchmark (offline, fake Bot API)")
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--concurrency", type=int, default=25, help="users going through the funnel at the same time")
+    p.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    p.add_argument("--no-approve", action="store_true", help="stop after the note step (no admin approve_)")
+    p.add_argument("--latency", type=float, default=0.0); p.add_argument("--jitter", type=float, default=0.0)
+    p.add_argument("--p429", type=float, default=0.0)
+    p.add_argument("--group-per-min", type=int, default=0); p.add_argument("--global-per-sec", type=int, default=0)
+    p.add_argument("--port", type=int, default=8091)
+    p.add_argument("--step-timeout", type=float, default=300.0)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--trace", action="store_true", help="TRACE=1: include handler spans and Bot API call counters")
+    p.add_argument("--tracemalloc", action="store_true", help="also report Python heap growth (slower)")
+    p.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="extra CBot env, e.g. DC_PAGE_RATE=600")
+    p.add_argument("--json", metavar="PATH", help="write the full report as JSON")
+    return p.parse_args(argv)
+
+def _configure_env(args):
+    # CBot پیکربندی را هنگام import از env می‌خواند → قبل از import
+    env = {"BOT_TOKEN": "1:bench", "BOT_API_BASE_URL": f"http://127.0.0.1:{args.port}/bot",
+           "WEBHOOK_URL": "https://bench.invalid/" if args.mode == "webhook" else "", "WEBHOOK_SECRET": "bench",
+           "GROUP_CHAT_ID": str(GROUP_ID), "DATACENTER_CHAT_ID": str(GROUP_ID), "DATACENTER2_CHAT_ID": str(DC2_ID),
+           "OWNER_USERNAME": f"user{ADMIN_ID}", "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="cbot-bench-"), "state.db"),
+           "EVENTS_JSON": json.dumps([{"id": EVENT_ID, "title": "Bench night", "when": "—", "place": "—", "capacity": args.users + 10, "desc": "—"}]),
+           "MALE_LIMIT_PER_EVENT": str(args.users + 10), "AUTO_APPROVE_DELAY": str(24 * 3600),
+           "POLL_TIMEOUT": "1", "LOG_LEVEL": "ERROR", "TRACE": "1" if args.trace else ""}
+    env.update(kv.split("=", 1) for kv in args.set)
+    os.environ.update(env)
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def pct(values, p):
+    if not values: return None
+    v = sorted(values); return round(v[min(len(v) - 1, int(len(v) * p))] * 1000, 1)
+
+# =========================
+#          FUNNEL
+# =========================
+def _buttons(m) -> set:
+    return {b.get("callback_data") for row in (m or {}).get("reply_markup", {}).get("inline_keyboard", []) for b in row}
+
+def _has_button(uid, data): return lambda f: data in _buttons(f.last_message(uid))
+def _text_has(uid, s): return lambda f: s in ((f.last_message(uid) or {}).get("text") or "")
+
+def funnel(d, uid):
+    """(step, update factory, "bot has answered" predicate) for one user."""
+    male = uid % 2 == 0
+    return [
+        ("start",        lambda: d.message(uid, "/start"),                 _has_button(uid, "list_events")),
+        ("list_events",  lambda: d.callback(uid, "list_events"),           _has_button(uid, f"event_{EVENT_ID}")),
+        ("event",        lambda: d.callback(uid, f"event_{EVENT_ID}"),     _has_button(uid, f"register_{EVENT_ID}")),
+        ("register",     lambda: d.callback(uid, f"register_{EVENT_ID}"),  _has_button(uid, "accept_rules")),
+        ("rules",        lambda: d.callback(uid, "accept_rules"),          _text_has(uid, "نام و نام خانوادگی")),
+        ("name",         lambda: d.message(uid, f"Bench User {uid}"),      _has_button(uid, "gender_m")),
+        ("gender",       lambda: d.callback(uid, "gender_m" if male else "gender_f"), _has_button(uid, "age_na")),
+        ("age",          lambda: d.message(uid, str(18 + uid % 40)),       _has_button(uid, "lvl_A")),
+        ("level",        lambda: d.callback(uid, "lvl_B"),                 _text_has(uid, "مرحله قبل")),
+        ("phone",        lambda: d.contact(uid, f"+98912{uid:07d}"),       _text_has(uid, "یادداشت")),
+        ("note",         lambda: d.message(uid, "-"),                      None),    # پیام ادمین در گروه
+        ("approve",      None,                                             _text_has(uid, "تایید شد")),
+    ]
+
+class AdminInbox:
+    """approve_/reject_ messages the bot posted in the admin group, indexed by user chat id."""
+    def __init__(self, fake): self.fake = fake; self.seen = 0; self.by_user = {}
+    def get(self, uid):
+        last = self.fake.last.get(GROUP_ID, 0)
+        for mid in range(self.seen + 1, last + 1):
+            m = self.fake.messages.get((GROUP_ID, mid))
+            for data in _buttons(m):
+                if data and data.startswith("approve_"): self.by_user[int(data.split("_")[1])] = m
+        self.seen = max(self.seen, last)
+        return self.by_user.get(uid)
+
+async def run_user(d, fake, admin, uid, lat, failures, approve, timeout):
+    for step, make, done in funnel(d, uid):
+        if step == "approve":
+            if not approve: return True
+            m = admin.get(uid); make = lambda: d.callback(ADMIN_ID, f"approve_{uid}_{EVENT_ID}", message=m)
+        if step == "note": done = lambda f: admin.get(uid) is not None
+        t0 = time.perf_counter()
+        try:
+            status = await d.deliver(make())
+            if status != 200: raise RuntimeError(f"webhook returned {status}")
+            await fake.wait_for(done, timeout)
+        except (asyncio.TimeoutError, RuntimeError) as e:
+            failures[(step, type(e).__name__)] += 1; return False
+        lat[step].append(time.perf_counter() - t0)
+    return True
+
+# =========================
+#           MAIN
+# =========================
+async def bench(args):
+    import uvicorn, httpx, fakebot, CBot
+    fake = fakebot.FakeBotAPI(args.latency, args.jitter, args.p429, 1, args.group_per_min, args.global_per_sec, args.seed)
+    server = uvicorn.Server(uvicorn.Config(fakebot.create_app(fake), host="127.0.0.1", port=args.port, log_level="warning", lifespan="off"))
+    served = asyncio.create_task(server.serve())
+    while not server.started:
+        if served.done(): served.result(); raise SystemExit("fake Bot API failed to start")
+        await asyncio.sleep(0.01)
+
+    await CBot.startup(webhook=args.mode == "webhook")
+    poller = None
+    if args.mode == "webhook":
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=CBot.app), base_url="http://cbot")
+        d = fakebot.Driver(fake, url="http://cbot/", secret=CBot.WEBHOOK_SECRET, client=client)
+    else:
+        poller = asyncio.create_task(CBot.poll_updates(CBot.application)); d = fakebot.Driver(fake)
+
+    gc.collect()
+    if args.tracemalloc:
+        import tracemalloc; tracemalloc.start(); heap0 = tracemalloc.get_traced_memory()[0]
+    rss0 = rss_bytes(); calls0 = Counter(fake.calls)
+    lat = {step: [] for step, *_ in funnel(d, 0)}; failures = Counter(); admin = AdminInbox(fake)
+    sem = asyncio.Semaphore(args.concurrency)
+    async def one(uid):
+        async with sem: return await run_user(d, fake, admin, uid, lat, failures, not args.no_approve, args.step_timeout)
+
+    t0 = time.perf_counter()
+    ok = sum(await asyncio.gather(*(one(1000 + i) for i in range(args.users))))
+    wall = time.perf_counter() - t0
+    await asyncio.wait_for(CBot.DISPATCHER.idle.wait(), args.step_timeout)
+    calls = Counter(fake.calls); calls.subtract(calls0); calls = +calls
+    rss1 = rss_bytes(); gc.collect()
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "users": args.users, "completed": ok, "wall_s": round(wall, 3),
+        "registrations_per_s": round(ok / wall, 2) if wall else None,
+        "updates_delivered": d.delivered, "updates_per_s": round(d.delivered / wall, 1) if wall else None,
+        "steps": {s: {"n": len(v), "p50_ms": pct(v, .5), "p95_ms": pct(v, .95), "p99_ms": pct(v, .99),
+                      "max_ms": round(max(v) * 1000, 1) if v else None} for s, v in lat.items()},
+        "api_calls_total": sum(calls.values()),
+        "api_calls_per_registration": round(sum(calls.values()) / ok, 2) if ok else None,
+        "api_calls": dict(calls.most_common()),
+        "api_errors": fake.stats()["errors"],
+        "failures": {f"{s}:{e}": n for (s, e), n in failures.items()},
+        "memory": {"rss_start_mb": round(rss0 / 2**20, 1), "rss_end_mb": round(rss1 / 2**20, 1),
+                   "rss_growth_kb_per_user": round((rss1 - rss0) / 1024 / args.users, 1)},
+        "dispatcher": CBot.DISPATCHER.stats(),
+        "pinned_saves": {"roster": {"calls": CBot.ROSTER_SAVES.calls, "runs": CBot.ROSTER_SAVES.runs},
+                         "users": {"calls": CBot.USERS_SAVES.calls, "runs": CBot.USERS_SAVES.runs}},
+    }
+    if args.tracemalloc:
+        heap1, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        report["memory"].update(heap_growth_kb=round((heap1 - heap0) / 1024, 1), heap_peak_kb=round(peak / 1024, 1),
+                                heap_growth_kb_per_user=round((heap1 - heap0) / 1024 / args.users, 2))
+    if args.trace: report["trace"] = CBot.trace_stats()
+
+    if poller: poller.cancel(); await asyncio.gather(poller, return_exceptions=True)
+    if args.mode == "webhook": await client.aclose()
+    await CBot.shutdown()
+    server.should_exit = True; await served
+    return report
+
+def print_report(r):
+    print(f"users={r['users']} completed={r['completed']} wall={r['wall_s']}s  "
+          f"{r['registrations_per_s']} reg/s  {r['updates_per_s']} updates/s  mode={r['config']['mode']}")
+    print(f"{'step':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for s, v in r["steps"].items():
+        if v["n"]: print(f"{s:<12}{v['n']:>6}{v['p50_ms']:>10}{v['p95_ms']:>10}{v['p99_ms']:>10}{v['max_ms']:>10}")
+    print(f"Bot API calls: {r['api_calls_total']} ({r['api_calls_per_registration']}/registration)  " +
+          " ".join(f"{k}={n}" for k, n in r["api_calls"].items()))
+    if r["api_errors"]: print("Bot API errors:", r["api_errors"])
+    if r["failures"]: print("FAILURES:", r["failures"])
+    m = r["memory"]
+    print(f"RSS {m['rss_start_mb']} → {m['rss_end_mb']} MB ({m['rss_growth_kb_per_user']} KB/user)" +
+          (f"  heap +{m['heap_growth_kb']} KB ({m['heap_growth_kb_per_user']} KB/user, peak {m['heap_peak_kb']} KB)" if "heap_growth_kb" in m else ""))
+    ps = r["pinned_saves"]
+    print(f"pinned saves: roster {ps['roster']['runs']}/{ps['roster']['calls']} runs/calls, users {ps['users']['runs']}/{ps['users']['calls']}")
+
+if __name__ == "__main__":
+    args = _args(); _configure_env(args)
+    report = asyncio.run(bench(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if report["completed"] == report["users"] else 1)
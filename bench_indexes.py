@@ -0,0 +1,80 @@
+# bench_indexes.py — In-memory index lookups vs the linear scans they replaced (offline, no Bot API)
+# EVENTS_BY_ID، MALES، USERNAMES و MEMBERSHIP در برابر پیمایش خطی EVENTS/ROSTER/ALL_USERS (مثل قبل)،
+# به‌علاوه‌ی بررسی این‌که ایندکس‌ها بعد از تغییرات با داده هم‌خوان می‌مانند.
+#
+#   python bench_indexes.py
+#   python bench_indexes.py --events 500 --users 100000
+
+import os, json, types, random, timeit, argparse
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot index lookup benchmark")
+    p.add_argument("--events", type=int, default=200)
+    p.add_argument("--users", type=int, default=50000, help="users, each approved for one event")
+    p.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    return p.parse_args(argv)
+
+def populate(C, n_events: int, n_users: int):
+    rnd = random.Random(1)
+    C.EVENTS[:] = [{"id": f"ev{i}", "title": f"E{i}", "when": "-", "capacity": n_users} for i in range(n_events)]
+    C.EVENTS_BY_ID.clear(); C.EVENTS_BY_ID.update({e["id"]: e for e in C.EVENTS})
+    C.ALL_USERS.clear(); C.ROSTER.clear(); C.PENDING.clear()
+    for cid in range(1, n_users + 1): C.ALL_USERS[cid] = C.User(cid, cid, f"User{cid}", f"n{cid}")
+    for cid in rnd.sample(range(1, n_users + 1), n_users):
+        ev = f"ev{cid % n_events}"
+        C.ROSTER.setdefault(ev, []).append(C.RosterEntry(cid, ev, username=f"User{cid}", gender=rnd.choice(["male", "female"])))
+    C.rebuild_indexes()
+
+def bench(C, n_events: int, n_users: int) -> list[dict]:
+    EVENTS, ROSTER, ALL_USERS = C.EVENTS, C.ROSTER, C.ALL_USERS
+    last = f"ev{n_events - 1}"
+    # همان پیمایش‌های خطی قبل از ایندکس‌ها
+    def scan_event(eid): return next((e for e in EVENTS if e.get("id") == eid), None)
+    def scan_males(eid): return sum(1 for r in ROSTER.get(eid, []) if r.gender == "male")
+    def scan_username(name):
+        for ppl in ROSTER.values():
+            for r in ppl:
+                if (r.username or "").lower() == name.lower(): return r.chat_id
+        return next((cid for cid, info in ALL_USERS.items() if (info.username or "").lower() == name.lower()), None)
+    def scan_cancel(ev_id, chat_id):
+        lst = ROSTER.get(ev_id, []); return len(lst) - len([r for r in lst if r.chat_id != chat_id])
+    absent = n_users + 1
+    cases = [("get_event (last event)", lambda: scan_event(last), lambda: C.get_event(last), 20000),
+             ("male_count", lambda: scan_males("ev7"), lambda: C.male_count("ev7"), 20000),
+             ("username lookup (hit)", lambda: scan_username(f"User{n_users}"), lambda: C.USERNAMES.get(f"user{n_users}"), 20),
+             ("username lookup (miss)", lambda: scan_username("nobody"), lambda: C.USERNAMES.get("nobody"), 20),
+             ("cancel, not registered", lambda: scan_cancel("ev5", absent), lambda: C.roster_remove("ev5", absent), 20000)]
+    out = []
+    for name, scan, index, n in cases:
+        assert scan() == index(), name
+        ts = min(timeit.repeat(scan, number=n, repeat=3)) / n * 1e6
+        ti = min(timeit.repeat(index, number=n, repeat=3)) / n * 1e6
+        out.append({"case": name, "scan_us": round(ts, 3), "index_us": round(ti, 3), "speedup": round(ts / ti)})
+    return out
+
+def check_consistency(C):
+    """Indexes follow roster_remove / add_user changes."""
+    for ev in ("ev0", "ev7"):
+        assert C.male_count(ev) == sum(1 for r in C.ROSTER[ev] if r.gender == "male")
+    row = C.ROSTER["ev3"][0]; m0 = C.male_count("ev3")
+    assert C.roster_remove("ev3", row.chat_id) == 1
+    assert C.male_count("ev3") == m0 - (row.gender == "male") and "ev3" not in C.MEMBERSHIP.get(row.chat_id, ())
+    C.add_user(types.SimpleNamespace(id=5, username="Renamed", full_name="x"), 5)
+    assert C.USERNAMES.get("renamed") == 5 and "user5" not in C.USERNAMES
+
+def main(argv=None):
+    args = _args(argv)
+    os.environ.update(BOT_TOKEN=os.environ.get("BOT_TOKEN", "1:bench"), STATE_DB_PATH="", LOG_LEVEL="ERROR")
+    import CBot as C
+    populate(C, args.events, args.users)
+    results = bench(C, args.events, args.users)
+    check_consistency(C)
+    print(f"events={args.events} users={args.users}")
+    for r in results: print(f"{r['case']:<26} scan {r['scan_us']:>12} µs   index {r['index_us']:>8} µs   x{r['speedup']:,}")
+    print("index consistency ok")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
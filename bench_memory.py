@@ -0,0 +1,59 @@
+# bench_memory.py — Heap cost of the slotted records vs plain dicts (offline, tracemalloc)
+# همان داده‌ی JSON یک بار به شکل dict (مثل قبل) و یک بار به شکل User/RosterEntry/PendingRegistration بارگذاری می‌شود.
+#
+#   python bench_memory.py
+#   python bench_memory.py --users 200000 --pending 20000
+
+import os, gc, json, random, argparse, tracemalloc
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot record memory benchmark (tracemalloc)")
+    p.add_argument("--users", type=int, default=100000, help="users, and as many roster rows")
+    p.add_argument("--pending", type=int, default=10000)
+    p.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    return p.parse_args(argv)
+
+def payloads(C, n_users: int, n_pending: int) -> tuple[str, str, str]:
+    rnd = random.Random(2); evs = [e["id"] for e in C.EVENTS]
+    users = {str(c): {"id": c, "chat_id": c, "username": f"user{c}", "name": f"Name {c}"} for c in range(1, n_users + 1)}
+    roster = {ev: [{"chat_id": c, "name": f"Name {c}", "username": f"user{c}", "phone": f"+98912{c:07d}",
+                    "gender": rnd.choice(["male", "female"]), "age": 20 + c % 30}
+                   for c in range(i, n_users + 1, len(evs))] for i, ev in enumerate(evs, 1)}
+    pending = {str(c): {"event_id": evs[0], "name": f"Name {c}", "phone": "—", "level": "Beginner (A1–A2)", "note": "—",
+                        "gender": "male", "age": None, "username": f"user{c}", "admin_msg_id": c, "due": 1.0}
+               for c in range(1, n_pending + 1)}
+    return tuple(json.dumps(x, ensure_ascii=False) for x in (users, roster, pending))
+
+def measure(build) -> float:
+    """MiB still allocated after build() (the result is kept alive until the measurement is taken)."""
+    gc.collect(); tracemalloc.start()
+    obj = build(); gc.collect()
+    cur, _ = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    del obj
+    return cur / 2**20
+
+def bench(C, n_users: int, n_pending: int) -> list[dict]:
+    uj, rj, pj = payloads(C, n_users, n_pending)
+    cases = [("users", lambda: {int(k): v for k, v in json.loads(uj).items()},
+                       lambda: {int(k): C.User.from_dict(v, int(k)) for k, v in json.loads(uj).items()}),
+             ("roster rows", lambda: json.loads(rj), lambda: C.roster_from_json(json.loads(rj))),
+             ("pending", lambda: {int(k): v for k, v in json.loads(pj).items()}, lambda: C.pending_from_json(json.loads(pj)))]
+    out = []
+    for name, as_dicts, as_records in cases:
+        a, b = measure(as_dicts), measure(as_records)
+        out.append({"case": name, "dicts_mib": round(a, 1), "records_mib": round(b, 1), "saved_pct": round((1 - b / a) * 100)})
+    return out
+
+def main(argv=None):
+    args = _args(argv)
+    os.environ.update(BOT_TOKEN=os.environ.get("BOT_TOKEN", "1:bench"), STATE_DB_PATH="", LOG_LEVEL="ERROR")
+    import CBot as C
+    results = bench(C, args.users, args.pending)
+    print(f"users={args.users} roster rows≈{args.users} pending={args.pending}")
+    for r in results: print(f"{r['case']:<12} dicts {r['dicts_mib']:>7} MiB   records {r['records_mib']:>7} MiB   ({r['saved_pct']}% less)")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
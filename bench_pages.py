@@ -0,0 +1,127 @@
+# bench_pages.py — DC page building cost (offline, no Bot API)
+# هزینه‌ی کامل _human_users_pages() بعد از اضافه شدن یک کاربر (pager افزایشی + صفحات snapshot + خط شناسه‌ها)
+# در برابر مسیر قدیمی _paginate_lines(_lines_for_users()) + _json_pages؛
+# و _iter_pages در برابر _paginate_lines قدیمی روی همان خطوط: زمان و اوج حافظه (tracemalloc).
+#
+#   python bench_pages.py
+#   python bench_pages.py --users 1000 10000 50000 --rounds 20 --json out.json
+
+import os, json, time, argparse, itertools, tracemalloc
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot DC page building benchmark")
+    p.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 50000])
+    p.add_argument("--rounds", type=int, default=20, help="single-user changes timed per size")
+    p.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    return p.parse_args(argv)
+
+class _TgUser:
+    def __init__(self, i): self.id = i; self.username = f"user{i}"; self.full_name = f"Bench User {i}"
+
+# ---- مسیر قدیمی (همان کد قبل از pager افزایشی؛ ALL_USERS آن زمان dict به dict بود)
+def old_paginate_lines(header: str, lines: list[str], limit: int = 3900) -> list[str]:
+    pages = []
+    cur = header
+    for ln in lines:
+        cand = cur + "\n" + ln
+        if len(cand) > limit:
+            pages.append(cur)
+            cur = header + "\n" + ln
+        else:
+            cur = cand
+    if cur:
+        pages.append(cur)
+    return pages or [header]
+
+def old_json_pages(title: str, obj, limit: int = 3900, chunk_chars: int = 3500) -> list[str]:
+    s = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    chunks = [s[i:i+chunk_chars] for i in range(0, len(s), chunk_chars)] or [""]
+    pages = []
+    for i, ch in enumerate(chunks, 1):
+        body = f"{title} (p{i}/{len(chunks)})\n\n```json\n{ch}\n```"
+        if len(body) > limit:
+            room = max(200, limit - len(title) - 20)
+            body = f"{title} (p{i}/{len(chunks)})\n\n```json\n{ch[:room]}\n```"
+        pages.append(body)
+    return pages
+
+def old_lines_for_users(users: dict, admins=frozenset()) -> list[str]:
+    lines = []
+    for idx, (cid, info) in enumerate(users.items(), 1):
+        u = (info.get("username") or "")
+        n = info.get("name") or "—"
+        uid = info.get("id")
+        uname_disp = u if u and u.lower() in admins else (("@" + u) if u else "")
+        lines.append(f"{idx}. {n} {uname_disp} | chat_id={cid} | id={uid}")
+    return lines
+
+def old_human_users_pages(users: dict) -> list[str]:
+    header = f"👥 همهٔ کاربران (DataCenter #2) — {len(users)} نفر"
+    pages = old_paginate_lines(header, old_lines_for_users(users))
+    pages += old_json_pages("📦 All Users JSON", {"all_users": {str(cid): users[cid] for cid in users}})
+    return pages
+
+def _save_ids(C, pages, ids):
+    """What _sync_pages does to the caches: new pages get message ids, texts follow the pages."""
+    C.USERS_PAGE_MESSAGE_IDS.extend(next(ids) for _ in range(len(pages) - 1 - len(C.USERS_PAGE_MESSAGE_IDS)))
+    C.USERS_PAGE_TEXTS[:] = pages
+
+def bench_users_pages(C, n: int, rounds: int) -> dict:
+    """Per change: add one user, then build every DC2 page (human + data + id line), new vs old path."""
+    C.ALL_USERS.clear(); C.USERS_BOOK.reset(); C._SNAP_CACHE.clear()
+    C.USERS_PAGE_MESSAGE_IDS[:] = []; C.USERS_PAGE_TEXTS[:] = []
+    ids = itertools.count(10000)
+    for i in range(n): C.add_user(_TgUser(i), i)
+    old_users = {cid: info.to_dict() for cid, info in C.ALL_USERS.items()}
+    for _ in range(3):
+        pages, _ = C._human_users_pages(); _save_ids(C, pages, ids)
+    new = old = 0.0; dirty = 0
+    for r in range(rounds):
+        cid = n + r; C.add_user(_TgUser(cid), cid); old_users[cid] = C.ALL_USERS[cid].to_dict()
+        t = time.perf_counter(); pages, d = C._human_users_pages(); new += time.perf_counter() - t
+        dirty += sum(1 for i in d if i >= len(C.USERS_PAGE_TEXTS) or C.USERS_PAGE_TEXTS[i] != pages[i]); _save_ids(C, pages, ids)
+        t = time.perf_counter(); old_pages = old_human_users_pages(old_users); old += time.perf_counter() - t
+    assert C._unpack_users(C._join_data_pages(pages[len(C.USERS_BOOK.pages):], C._parse_ids_line(pages[0])[2])) == C.ALL_USERS
+    return {"users": n, "pages": len(pages), "old_pages": len(old_pages), "new_ms": round(new / rounds * 1000, 2),
+            "old_ms": round(old / rounds * 1000, 2), "changed_pages_per_change": round(dirty / rounds, 2)}
+
+def _peak_kib(fn) -> float:
+    tracemalloc.start(); fn(); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+def bench_iter(C, n: int, rounds: int) -> dict:
+    """n roster-style lines: old _paginate_lines vs _iter_pages (every page, and the first page only, as /roster needs)."""
+    lines = [f"  {i}. Bench User {i} | @user{i} | +98912{i:07d}" for i in range(n)]
+    cases = {"old_all": lambda: old_paginate_lines("📋 roster", lines, C.TELEGRAM_TEXT_LIMIT),
+             "iter_all": lambda: list(C._iter_pages("📋 roster", lines)),
+             "iter_first": lambda: next(C._iter_pages("📋 roster", lines))}
+    assert cases["old_all"]() == cases["iter_all"]() and cases["iter_all"]()[0] == cases["iter_first"]()
+    out = {"lines": n, "pages": len(cases["iter_all"]())}
+    for name, fn in cases.items():
+        t = time.perf_counter()
+        for _ in range(rounds): fn()
+        out[f"{name}_ms"] = round((time.perf_counter() - t) / rounds * 1000, 3)
+        out[f"{name}_peak_kib"] = _peak_kib(fn)
+    return out
+
+def _table(rows: list[dict]):
+    cols = list(rows[0]); w = [max(len(c), 8) + 2 for c in cols]
+    print("".join(f"{c:>{n}}" for c, n in zip(cols, w)))
+    for r in rows: print("".join(f"{r[c]!s:>{n}}" for c, n in zip(cols, w)))
+
+def main(argv=None):
+    args = _args(argv)
+    os.environ.update(BOT_TOKEN=os.environ.get("BOT_TOKEN", "1:bench"), STATE_DB_PATH="", LOG_LEVEL="ERROR")
+    import CBot as C
+    results = {"users_pages": [bench_users_pages(C, n, args.rounds) for n in args.users],
+               "iter_pages": [bench_iter(C, n, args.rounds) for n in args.users]}
+    print("_human_users_pages() after one new user (new) vs _paginate_lines + _json_pages (old):")
+    _table(results["users_pages"])
+    print("\n_iter_pages vs the old _paginate_lines (ms per call, tracemalloc peak):")
+    _table(results["iter_pages"])
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# bench_snapshot.py — size and edit locality of the DC data pages (offline, no Bot API)
+# برای payload کاربران DC2: تعداد صفحه‌ها، زمان encode/decode و این‌که هر نوع تغییر چند صفحه را عوض می‌کند
+# (= چند ویرایش در هر save)؛ snapshot v2 (zlib/lzma) در برابر قالب json.
+#
+#   python bench_snapshot.py
+#   python bench_snapshot.py --users 50000 --json out.json
+
+import os, json, time, random, argparse
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot DC data page benchmark")
+    p.add_argument("--users", type=int, default=12000)
+    p.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    return p.parse_args(argv)
+
+def bench(C, n: int) -> list[dict]:
+    rnd = random.Random(1)
+    rows = [[i, None if i % 3 else i + 7, f"user{i}", f"Name {i} {rnd.random():.5f}"] for i in range(n)]
+    mid = n // 2
+    changes = {"append": rows + [[10**9, None, "new", "New"]],
+               "insert_mid": rows[:mid] + [[10**9, None, "new", "New"]] + rows[mid:],
+               "delete_mid": rows[:mid] + rows[mid + 1:],
+               "edit_mid": rows[:mid] + [[rows[mid][0], None, "renamed", "Renamed"]] + rows[mid + 1:]}
+    out = []
+    for fmt, codec in (("snapshot", "zlib"), ("snapshot", "lzma"), ("json", None)):
+        make = (lambda o: C._json_pages("📦 All Users JSON", o)) if fmt == "json" else \
+               (lambda o, c=codec: C._snapshot_pages("📦 All Users snapshot", o, codec=c))
+        t = time.perf_counter(); pages = make({"u": rows}); enc = time.perf_counter() - t
+        crc = C._data_crc(pages)
+        t = time.perf_counter(); assert C._join_data_pages(pages, crc) == {"u": rows}; dec = time.perf_counter() - t
+        base = set(pages)
+        r = {"format": fmt + (f"/{codec}" if codec else ""), "pages": len(pages), "chars": sum(map(len, pages)),
+             "encode_ms": round(enc * 1000, 1), "decode_ms": round(dec * 1000, 1)}
+        r.update({f"changed_{k}": len(set(make({"u": v})) - base) for k, v in changes.items()})
+        out.append(r)
+    return out
+
+def main(argv=None):
+    args = _args(argv)
+    os.environ.update(BOT_TOKEN=os.environ.get("BOT_TOKEN", "1:bench"), STATE_DB_PATH="", LOG_LEVEL="ERROR")
+    import CBot as C
+    results = bench(C, args.users)
+    cols = list(results[0])
+    print(f"users={args.users}  (changed_* = data pages rewritten by that change)")
+    w = [len(c) + 2 for c in cols]
+    print("".join(f"{c:>{n}}" for c, n in zip(cols, w)))
+    for r in results: print("".join(f"{r[c]!s:>{n}}" for c, n in zip(cols, w)))
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# bench_webhook.py — Webhook load test against fakebot.py (offline)
+# یک رگبار /start از N کاربر به POST / (با هدر secret، مثل تلگرام) در حالی که هر فراخوانی Bot API تاخیر دارد:
+# زمان ACK وبهوک (باید مستقل از کندی هندلرها بماند) در برابر زمان تا پردازش کامل همه‌ی آپدیت‌ها.
+# سپس هزینه‌ی هر درخواست ردشده (secret غلط، بدنه‌ی بزرگ، JSON خراب، update_id تکراری) در برابر آپدیت پذیرفته‌شده،
+# با صدا زدن مستقیم اپ ASGI (بدون HTTP).
+#
+#   python bench_webhook.py
+#   python bench_webhook.py --updates 5000 --chats 500 --latency 0.1 --set WEBHOOK_WORKERS=32
+
+import os, sys, json, time, asyncio, argparse
+from collections import Counter
+
+def _args(argv=None):
+    p = argparse.ArgumentParser(description="CBot webhook load test (offline, fake Bot API)")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--chats", type=int, default=200, help="updates are spread round-robin over this many chats")
+    p.add_argument("--concurrency", type=int, default=64, help="webhook requests in flight")
+    p.add_argument("--latency", type=float, default=0.05, help="fake Bot API latency per call (s)")
+    p.add_argument("--rejects", type=int, default=2000, help="requests per case in the rejection benchmark (0 = skip)")
+    p.add_argument("--port", type=int, default=8097)
+    p.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="extra CBot env, e.g. WEBHOOK_WORKERS=32")
+    p.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    return p.parse_args(argv)
+
+def _configure_env(args):
+    # CBot پیکربندی را هنگام import از env می‌خواند → قبل از import
+    env = {"BOT_TOKEN": "1:bench", "BOT_API_BASE_URL": f"http://127.0.0.1:{args.port}/bot", "WEBHOOK_URL": "https://bench.invalid/",
+           "WEBHOOK_SECRET": "bench", "STATE_DB_PATH": "", "DATACENTER_CHAT_ID": "0", "DATACENTER2_CHAT_ID": "0", "LOG_LEVEL": "ERROR"}
+    env.update(kv.split("=", 1) for kv in args.set)
+    os.environ.update(env)
+
+def pct(values, p):
+    if not values: return None
+    v = sorted(values); return round(v[min(len(v) - 1, int(len(v) * p))] * 1000, 2)
+
+async def asgi_post(app, body: bytes, secret: str) -> int:
+    """One POST / straight into the ASGI app; returns the status code."""
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    if secret: headers.append((b"x-telegram-bot-api-secret-token", secret.encode()))
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": "/", "raw_path": b"/", "root_path": "", "query_string": b"", "headers": headers,
+             "client": ("127.0.0.1", 1), "server": ("cbot", 80)}
+    sent, status = [], []
+    async def receive():
+        if sent: return {"type": "http.disconnect"}
+        sent.append(1); return {"type": "http.request", "body": body, "more_body": False}
+    async def send(msg):
+        if msg["type"] == "http.response.start": status.append(msg["status"])
+    await app(scope, receive, send)
+    return status[0]
+
+async def bench_rejects(CBot, d, n: int, seen_update: dict) -> dict:
+    """µs per request for each kind of rejected request vs an accepted update."""
+    secret = CBot.WEBHOOK_SECRET
+    cases = {"wrong secret": lambda: (b'{"update_id":1}', "nope"),
+             "oversize body": lambda: (b" " * (CBot.WEBHOOK_MAX_BODY + 1), secret),
+             "invalid json": lambda: (b'{"update_id": 1, "message": {', secret),
+             "no update_id": lambda: (b'{"message":{}}', secret),
+             "duplicate update_id": lambda: (json.dumps(seen_update).encode(), secret),
+             "accepted update": lambda: (json.dumps(d.message(next(uids), "/start")).encode(), secret)}
+    out, uids = {}, iter(range(10**6, 10**6 + n))
+    for name, make in cases.items():
+        reqs = [make() for _ in range(n)]; statuses = Counter()
+        t = time.perf_counter()
+        for body, sec in reqs: statuses[await asgi_post(CBot.app, body, sec)] += 1
+        out[name] = {"us": round((time.perf_counter() - t) / n * 1e6, 1), "statuses": dict(statuses)}
+    await asyncio.wait_for(CBot.DISPATCHER.idle.wait(), 600)
+    return out
+
+async def bench(args):
+    import uvicorn, httpx, fakebot, CBot
+    fake = fakebot.FakeBotAPI(latency=args.latency)
+    server = uvicorn.Server(uvicorn.Config(fakebot.create_app(fake), host="127.0.0.1", port=args.port, log_level="warning", lifespan="off"))
+    served = asyncio.create_task(server.serve())
+    while not server.started:
+        if served.done(): served.result(); raise SystemExit("fake Bot API failed to start")
+        await asyncio.sleep(0.01)
+    await CBot.startup(webhook=True)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=CBot.app), base_url="http://cbot")
+    d = fakebot.Driver(fake, url="http://cbot/", secret=CBot.WEBHOOK_SECRET, client=client, retries=0)
+
+    updates = [d.message(1000 + i % args.chats, "/start") for i in range(args.updates)]
+    acks, statuses = [], Counter(); sem = asyncio.Semaphore(args.concurrency)
+    async def one(u):
+        async with sem:
+            t = time.perf_counter(); statuses[await d.deliver(u)] += 1; acks.append(time.perf_counter() - t)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    acked = time.perf_counter() - t0
+    await asyncio.wait_for(CBot.DISPATCHER.idle.wait(), 600)
+    done = time.perf_counter() - t0
+    rejects = await bench_rejects(CBot, d, args.rejects, updates[0]) if args.rejects else None
+    report = {"config": {k: v for k, v in vars(args).items() if k != "json"},
+              "statuses": dict(statuses), "ack_p50_ms": pct(acks, .5), "ack_p99_ms": pct(acks, .99), "ack_max_ms": pct(acks, 1),
+              "all_acked_s": round(acked, 3), "all_processed_s": round(done, 3),
+              "acks_per_s": round(len(acks) / acked, 1), "processed_per_s": round(len(acks) / done, 1),
+              "dispatcher": CBot.DISPATCHER.stats(), "rejects": rejects, "rejected": dict(CBot.WEBHOOK_REJECTED)}
+    await client.aclose(); await CBot.shutdown()
+    server.should_exit = True; await served
+    return report
+
+def print_report(r):
+    c = r["config"]
+    print(f"updates={c['updates']} chats={c['chats']} concurrency={c['concurrency']} api latency={c['latency']}s  statuses={r['statuses']}")
+    print(f"ACK p50 {r['ack_p50_ms']} ms  p99 {r['ack_p99_ms']} ms  max {r['ack_max_ms']} ms  "
+          f"→ all acked in {r['all_acked_s']}s ({r['acks_per_s']}/s)")
+    print(f"all processed in {r['all_processed_s']}s ({r['processed_per_s']}/s)")
+    if r["rejects"]:
+        print(f"per request, ASGI app called directly ({c['rejects']} each):")
+        for name, x in r["rejects"].items(): print(f"  {name:<20} {x['us']:>8} µs   {x['statuses']}")
+
+if __name__ == "__main__":
+    args = _args(); _configure_env(args)
+    report = asyncio.run(bench(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if report["statuses"].get(200) == args.updates else 1)
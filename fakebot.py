@@ -0,0 +1,320 @@
+# fakebot.py — Offline stand-in for the Telegram Bot API (load & regression testing for CBot)
+# سرور جعلی: پیام‌ها را در حافظه نگه می‌دارد و مثل تلگرام جواب می‌دهد (۴۰۰ "not modified"/"not found"، ۴۲۹ با retry_after)
+#
+#   python fakebot.py serve --port 8081 --latency 0.02 --p429 0.01 --group-per-min 20
+#   BOT_API_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=1:fake WEBHOOK_URL= uvicorn CBot:app --port 10000
+#   python fakebot.py replay updates.jsonl --url http://127.0.0.1:10000/ --secret "$WEBHOOK_SECRET"
+#   python fakebot.py replay updates.jsonl --url http://127.0.0.1:8081/_fake/updates   # حالت polling (RUN_MODE=polling)
+#
+# از پایتون: FakeBotAPI + create_app(fake) برای سرور، Driver برای ساخت و تحویل آپدیت‌ها.
+
+import json, time, math, random, asyncio, argparse, itertools
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qsl
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+import httpx
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+# پارامترهایی که PTB بدون JSON-encode می‌فرستد (بقیه JSON هستند)
+STR_PARAMS = {"text", "caption", "parse_mode", "callback_query_id", "url", "secret_token", "inline_message_id"}
+# متدهایی که در سقف نرخ تلگرام حساب می‌شوند
+WRITE_METHODS = {"sendmessage", "editmessagetext", "editmessagereplymarkup", "forwardmessage", "copymessage"}
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, **parameters):
+        super().__init__(description); self.code = code; self.description = description; self.parameters = parameters
+
+def _chat(chat_id) -> dict:
+    return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+# =========================
+#        FAKE BOT API
+# =========================
+class FakeBotAPI:
+    """In-memory Bot API covering the methods CBot calls.
+
+    Every message the bot sends is stored per chat (ids count up per chat,
+    like Telegram), so edits/forwards/pins/getChat behave consistently.
+    latency(+jitter) is slept on every call; p429 injects random 429s on
+    write methods, and group_per_min / global_per_sec emulate Telegram's
+    real flood limits with a sliding window and an honest retry_after.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, p429: float = 0.0, retry_after: int = 1,
+                 group_per_min: int = 0, global_per_sec: int = 0, seed=None):
+        self.latency = latency; self.jitter = jitter
+        self.p429 = p429; self.retry_after = retry_after
+        self.group_per_min = group_per_min; self.global_per_sec = global_per_sec
+        self.rng = random.Random(seed)
+        self.messages = {}                                # (chat_id, message_id) -> message
+        self.last = {}                                    # chat_id -> آخرین message_id ربات در آن چت
+        self.ids = defaultdict(lambda: itertools.count(1))
+        self.pins = {}                                    # chat_id -> message_id
+        self.calls = Counter(); self.errors = Counter()
+        self.webhook = {}
+        self.updates = deque(); self.has_updates = asyncio.Event()   # صندوق getUpdates
+        self._windows = defaultdict(deque)                # rate-limit windows
+        self.changed = asyncio.Condition()
+        self.handlers = {name.lower(): getattr(self, name) for name in (
+            "getMe", "setWebhook", "deleteWebhook", "getUpdates", "sendMessage", "editMessageText",
+            "editMessageReplyMarkup", "pinChatMessage", "getChat", "deleteMessage", "forwardMessage",
+            "copyMessage", "answerCallbackQuery")}
+
+    # ---- plumbing
+    async def call(self, method: str, params: dict):
+        m = method.lower(); self.calls[method] += 1
+        if self.latency or self.jitter: await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+        try:
+            fn = self.handlers.get(m)
+            if not fn: raise ApiError(404, "Not Found: method not found")
+            if m in WRITE_METHODS: self._throttle(params.get("chat_id"))
+            result = fn(**params)
+            if asyncio.iscoroutine(result): result = await result
+        except ApiError as e:
+            self.errors[(method, e.code)] += 1; raise
+        except TypeError as e:                            # پارامتر ناشناخته/جاافتاده
+            self.errors[(method, 400)] += 1; raise ApiError(400, f"Bad Request: {e}")
+        if m in WRITE_METHODS or m in ("pinchatmessage", "deletemessage"):
+            async with self.changed: self.changed.notify_all()
+        return result
+
+    def _throttle(self, chat_id):
+        if self.p429 and self.rng.random() < self.p429:
+            raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+        now = time.monotonic()
+        limits = [("global", self.global_per_sec, 1.0)]
+        if isinstance(chat_id, int) and chat_id < 0: limits.append((chat_id, self.group_per_min, 60.0))
+        for key, limit, span in limits:
+            if not limit: continue
+            w = self._windows[key]
+            while w and now - w[0] >= span: w.popleft()
+            if len(w) >= limit:
+                ra = max(1, math.ceil(w[0] + span - now))
+                raise ApiError(429, f"Too Many Requests: retry after {ra}", retry_after=ra)
+        for key, limit, span in limits:
+            if limit: self._windows[key].append(now)
+
+    def _store(self, chat_id, text=None, reply_markup=None, **extra) -> dict:
+        mid = next(self.ids[chat_id])
+        m = {"message_id": mid, "date": int(time.time()), "chat": _chat(chat_id), "from": BOT_USER, **extra}
+        if text is not None: m["text"] = text
+        if isinstance(reply_markup, dict) and "inline_keyboard" in reply_markup: m["reply_markup"] = reply_markup
+        self.messages[(chat_id, mid)] = m; self.last[chat_id] = mid
+        return m
+
+    def _get(self, chat_id, message_id, what: str) -> dict:
+        m = self.messages.get((chat_id, message_id))
+        if not m: raise ApiError(400, f"Bad Request: message to {what} not found")
+        return m
+
+    # ---- Bot API methods (همان نام‌های تلگرام)
+    def getMe(self, **_): return BOT_USER
+
+    def setWebhook(self, url="", secret_token=None, **_): self.webhook = {"url": url, "secret_token": secret_token}; return True
+
+    def deleteWebhook(self, **_): self.webhook = {}; return True
+
+    async def getUpdates(self, offset=None, limit=100, timeout=0, **_):
+        if self.webhook.get("url"): raise ApiError(409, "Conflict: can't use getUpdates method while webhook is active")
+        if offset:
+            while self.updates and self.updates[0]["update_id"] < offset: self.updates.popleft()
+        if not self.updates and timeout:
+            self.has_updates.clear()
+            try: await asyncio.wait_for(self.has_updates.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        return list(itertools.islice(self.updates, max(1, min(100, limit))))
+
+    def push_update(self, update: dict):
+        self.updates.append(update); self.has_updates.set()
+
+    def sendMessage(self, chat_id, text, reply_markup=None, **_):
+        if not text: raise ApiError(400, "Bad Request: message text is empty")
+        if len(text) > 4096: raise ApiError(400, "Bad Request: message is too long")
+        return self._store(chat_id, text, reply_markup)
+
+    def editMessageText(self, text, chat_id=None, message_id=None, reply_markup=None, **_):
+        m = self._get(chat_id, message_id, "edit")
+        if len(text) > 4096: raise ApiError(400, "Bad Request: message is too long")
+        markup = reply_markup if isinstance(reply_markup, dict) and "inline_keyboard" in reply_markup else None
+        if m.get("text") == text and m.get("reply_markup") == markup:
+            raise ApiError(400, "Bad Request: message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message")
+        m["text"] = text; m["edit_date"] = int(time.time())
+        if markup: m["reply_markup"] = markup
+        else: m.pop("reply_markup", None)
+        return m
+
+    def editMessageReplyMarkup(self, chat_id=None, message_id=None, reply_markup=None, **_):
+        m = self._get(chat_id, message_id, "edit")
+        if reply_markup: m["reply_markup"] = reply_markup
+        else: m.pop("reply_markup", None)
+        return m
+
+    def pinChatMessage(self, chat_id, message_id, **_):
+        self._get(chat_id, message_id, "pin"); self.pins[chat_id] = message_id; return True
+
+    def getChat(self, chat_id, **_):
+        chat = _chat(chat_id); pid = self.pins.get(chat_id)
+        if pid and (chat_id, pid) in self.messages: chat["pinned_message"] = self.messages[(chat_id, pid)]
+        return chat
+
+    def deleteMessage(self, chat_id, message_id, **_):
+        if self.messages.pop((chat_id, message_id), None) is None: raise ApiError(400, "Bad Request: message to delete not found")
+        if self.pins.get(chat_id) == message_id: self.pins.pop(chat_id)
+        return True
+
+    def forwardMessage(self, chat_id, from_chat_id, message_id, **_):
+        src = self._get(from_chat_id, message_id, "forward")
+        return self._store(chat_id, src.get("text"), forward_date=src["date"])
+
+    def copyMessage(self, chat_id, from_chat_id, message_id, **_):
+        src = self._get(from_chat_id, message_id, "copy")
+        return {"message_id": self._store(chat_id, src.get("text"), src.get("reply_markup"))["message_id"]}
+
+    def answerCallbackQuery(self, callback_query_id, **_): return True
+
+    # ---- helpers برای بنچمارک/تست
+    def chat_messages(self, chat_id) -> list[dict]:
+        return [m for (c, _), m in sorted(self.messages.items()) if c == chat_id]
+
+    def last_message(self, chat_id) -> dict | None:
+        mid = self.last.get(chat_id)
+        return self.messages.get((chat_id, mid)) if mid else None
+
+    async def wait_for(self, predicate, timeout: float = 10.0):
+        """Wait until predicate(self) holds; re-checked after every stored change."""
+        async with self.changed: await asyncio.wait_for(self.changed.wait_for(lambda: predicate(self)), timeout)
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "errors": {f"{m}:{c}": n for (m, c), n in self.errors.items()},
+                "messages": len(self.messages), "pending_updates": len(self.updates)}
+
+def _decode(params: dict) -> dict:
+    out = {}
+    for k, v in params.items():
+        if k in STR_PARAMS or not isinstance(v, str): out[k] = v; continue
+        try: out[k] = json.loads(v)
+        except ValueError: out[k] = v               # مثل chat_id="@channel"
+    return out
+
+def create_app(fake: FakeBotAPI) -> FastAPI:
+    api = FastAPI()
+
+    @api.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def bot_method(token: str, method: str, request: Request):
+        params = dict(request.query_params)
+        body = await request.body()
+        if body:
+            if request.headers.get("content-type", "").startswith("application/json"): params.update(json.loads(body))
+            else: params.update(parse_qsl(body.decode()))
+        try:
+            payload, code = {"ok": True, "result": await fake.call(method, _decode(params))}, 200
+        except ApiError as e:
+            payload, code = {"ok": False, "error_code": e.code, "description": e.description}, e.code
+            if e.parameters: payload["parameters"] = e.parameters
+        return Response(json.dumps(payload, ensure_ascii=False), status_code=code, media_type="application/json")   # بدون jsonable_encoder
+
+    @api.post("/_fake/updates")
+    async def push(request: Request):
+        data = json.loads(await request.body())
+        for u in data if isinstance(data, list) else [data]: fake.push_update(u)
+        return {"ok": True}
+
+    @api.get("/_fake/stats")
+    async def stats(): return fake.stats()
+
+    return api
+
+# =========================
+#          DRIVER
+# =========================
+class Driver:
+    """Builds Telegram-shaped updates for synthetic users and delivers them.
+
+    With url set, updates are POSTed like Telegram's webhook does (secret
+    header, retry with backoff on 429/5xx); without it they go to the
+    fake's getUpdates inbox for CBot's polling mode.
+    """
+    def __init__(self, fake: FakeBotAPI | None = None, url: str | None = None, secret: str = "",
+                 client: httpx.AsyncClient | None = None, retries: int = 5):
+        self.fake = fake; self.url = url; self.secret = secret; self.retries = retries
+        self.client = client or (httpx.AsyncClient(timeout=30) if url else None)
+        self.ids = itertools.count(1); self.mids = itertools.count(1)
+        self.delivered = 0; self.retried = 0
+
+    @staticmethod
+    def user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def message(self, uid: int, text: str | None = None, contact: dict | None = None) -> dict:
+        msg = {"message_id": next(self.mids), "date": int(time.time()), "chat": _chat(uid), "from": self.user(uid)}
+        if text is not None: msg["text"] = text
+        if text and text.startswith("/"): msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if contact: msg["contact"] = contact
+        return {"update_id": next(self.ids), "message": msg}
+
+    def contact(self, uid: int, phone: str) -> dict:
+        return self.message(uid, contact={"phone_number": phone, "first_name": f"User{uid}", "user_id": uid})
+
+    def callback(self, uid: int, data: str, message: dict | None = None) -> dict:
+        """Button press on `message` (default: the bot's last message in the user's chat)."""
+        message = message or (self.fake.last_message(uid) if self.fake else None) \
+            or {"message_id": 0, "date": 0, "chat": _chat(uid), "from": BOT_USER, "text": "-"}
+        return {"update_id": next(self.ids), "callback_query": {"id": str(next(self.ids)), "from": self.user(uid),
+                "chat_instance": str(uid), "data": data, "message": message}}
+
+    async def deliver(self, update: dict) -> int:
+        if not self.url: self.fake.push_update(update); self.delivered += 1; return 200
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            r = await self.client.post(self.url, json=update, headers=headers)
+            if r.status_code < 500 and r.status_code != 429 or attempt == self.retries: break
+            self.retried += 1; await asyncio.sleep(delay); delay = min(delay * 2, 8)
+        self.delivered += r.status_code == 200
+        return r.status_code
+
+    async def replay(self, updates, concurrency: int = 16) -> Counter:
+        """Deliver an iterable of update dicts with bounded concurrency; returns a status histogram."""
+        sem = asyncio.Semaphore(concurrency); statuses = Counter()
+        async def one(u):
+            async with sem: statuses[await self.deliver(u)] += 1
+        await asyncio.gather(*(one(u) for u in updates))
+        return statuses
+
+    async def aclose(self):
+        if self.client: await self.client.aclose()
+
+# =========================
+#            CLI
+# =========================
+async def _replay_cli(args):
+    with open(args.file) as f: updates = [json.loads(l) for l in f if l.strip()]
+    d = Driver(url=args.url, secret=args.secret)
+    t0 = time.perf_counter(); statuses = await d.replay(updates, args.concurrency); dt = time.perf_counter() - t0
+    await d.aclose()
+    print(json.dumps({"updates": len(updates), "seconds": round(dt, 3), "per_sec": round(len(updates) / dt, 1) if dt else None,
+                      "statuses": dict(statuses), "retried": d.retried}))
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Offline fake Telegram Bot API for CBot")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("serve", help="run the fake Bot API server")
+    s.add_argument("--host", default="127.0.0.1"); s.add_argument("--port", type=int, default=8081)
+    s.add_argument("--latency", type=float, default=0.0); s.add_argument("--jitter", type=float, default=0.0)
+    s.add_argument("--p429", type=float, default=0.0); s.add_argument("--retry-after", type=int, default=1)
+    s.add_argument("--group-per-min", type=int, default=0); s.add_argument("--global-per-sec", type=int, default=0)
+    s.add_argument("--seed", type=int)
+    r = sub.add_parser("replay", help="POST a JSONL file of updates to a webhook (or /_fake/updates)")
+    r.add_argument("file"); r.add_argument("--url", required=True); r.add_argument("--secret", default="")
+    r.add_argument("--concurrency", type=int, default=16)
+    args = p.parse_args(argv)
+    if args.cmd == "serve":
+        import uvicorn
+        fake = FakeBotAPI(args.latency, args.jitter, args.p429, args.retry_after, args.group_per_min, args.global_per_sec, args.seed)
+        uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+    else:
+        asyncio.run(_replay_cli(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,5 @@
 #!/bin/bash
+# RUN_MODE=polling → long-poll getUpdates (بدون وبهوک/HTTP)؛ پیش‌فرض: وبهوک با uvicorn
+# POLL_TAKEOVER=1 → وبهوک فعلی حذف می‌شود؛ بدون آن، polling در حالت standby تا برداشته شدن وبهوک منتظر می‌ماند
+if [ "${RUN_MODE:-webhook}" = "polling" ]; then exec python -m CBot polling; fi
 uvicorn CBot:app --host 0.0.0.0 --port ${PORT:-10000}
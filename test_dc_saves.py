@@ -0,0 +1,160 @@
+# test_dc_saves.py — DC1/DC2 saves against fakebot.py (offline): writes per save, retry on failed edits,
+# حذف صفحات اضافه فقط برای صفحاتی که خود پروسه فرستاده، write-behind DC1،
+# و زمان واقعی بازنویسی 1/10/50 صفحه با تأخیر شبکه‌ی ساختگی (LATENCY ثانیه برای هر فراخوانی).
+#
+#   python -m pytest -q test_dc_saves.py
+#   python test_dc_saves.py
+
+import os, math, time, asyncio, tempfile
+import pytest
+PORT = 8098
+LATENCY = 0.05
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.update(BOT_API_BASE_URL=f"http://127.0.0.1:{PORT}/bot", STATE_DB_PATH="", LOG_LEVEL="ERROR",
+                  DATACENTER_CHAT_ID="-100", DATACENTER2_CHAT_ID="-200", DC_PAGE_RATE="60000", DC_PAGE_BURST="60000")
+import uvicorn, fakebot, CBot as C
+
+DC1, DC2 = C.DATACENTER_CHAT_ID, C.DATACENTER2_CHAT_ID
+
+class _U:
+    def __init__(self, i): self.id = i; self.username = f"user{i}"; self.full_name = f"Name {i}"
+
+def _reset():
+    """Fresh DC state (and loop-bound primitives) for each asyncio.run."""
+    C.ALL_USERS = {}; C.ROSTER = {}; C.PENDING.clear(); C.rebuild_indexes()
+    C.USERS_MESSAGE_ID = C.ROSTER_MESSAGE_ID = None
+    C.USERS_PAGE_MESSAGE_IDS, C.USERS_PAGE_TEXTS, C.ROSTER_PAGE_MESSAGE_IDS, C.ROSTER_PAGE_TEXTS = [], [], [], []
+    C.USERS_BOOK.reset(); C.ROSTER_BOOK.reset(); C._OWN_PAGES.clear()
+    C.USERS_DIRTY, C.ROSTER_DIRTY = asyncio.Event(), asyncio.Event()
+    C.USERS_SAVES, C.ROSTER_SAVES = C.SingleFlight(C._save_users_pinned), C.SingleFlight(C._save_roster_pinned)
+    C.LIMITER = C.ChatLimiter(); C.STORE = C.MemoryStore()
+
+def _run(scenario, latency: float = 0.0):
+    async def main():
+        fake = fakebot.FakeBotAPI(latency)
+        srv = uvicorn.Server(uvicorn.Config(fakebot.create_app(fake), host="127.0.0.1", port=PORT, log_level="warning", lifespan="off"))
+        served = asyncio.create_task(srv.serve())
+        while not srv.started:
+            if served.done(): served.result(); raise RuntimeError("fake Bot API failed to start")
+            await asyncio.sleep(0.01)
+        _reset(); await C.application.initialize()
+        try: return await scenario(fake)
+        finally:
+            await C.application.shutdown()
+            srv.should_exit = True; await served
+    return asyncio.run(main())
+
+def _writes(fake) -> int:
+    return fake.calls["sendMessage"] + fake.calls["editMessageText"] + fake.calls["deleteMessage"]
+
+def _add_users(ids):
+    for i in ids: C.add_user(_U(i), i)
+
+def test_one_new_user_costs_few_writes():
+    async def scenario(fake):
+        _add_users(range(1, 3001)); await C.save_users_pinned(C.application)
+        assert C.USERS_SAVED_VERSION == C.USERS_VERSION and len(C.USERS_PAGE_MESSAGE_IDS) > 5
+        for i in range(3001, 3006):
+            w = _writes(fake)
+            _add_users([i]); await C.save_users_pinned(C.application)
+            assert _writes(fake) - w <= 3, i                    # pin + صفحه‌ی انسانی آخر + یک صفحه‌ی داده
+        w = _writes(fake); await C.save_users_pinned(C.application)
+        assert _writes(fake) == w                               # نسخه عوض نشده → هیچ نوشتنی
+        r = await C._read_pinned(C.application, DC2)
+        assert C._unpack_users(r[3]) == C.ALL_USERS
+    _run(scenario)
+
+def test_failed_edits_leave_save_dirty():
+    async def scenario(fake):
+        _add_users(range(1, 2001)); await C.save_users_pinned(C.application)
+        for mid in C.USERS_PAGE_MESSAGE_IDS: fake.messages.pop((DC2, mid), None)   # ویرایش‌ها "not found" می‌گیرند
+        C.USERS_DIRTY.clear(); _add_users([5000])
+        await C.flush_users_pinned(C.application)
+        assert C.USERS_DIRTY.is_set() and C.USERS_SAVED_VERSION != C.USERS_VERSION
+    _run(scenario)
+
+def test_surplus_pages_deleted_only_when_own():
+    async def scenario(fake):
+        _add_users(range(1, 3001)); await C.save_users_pinned(C.application)
+        n0 = len(C.USERS_PAGE_MESSAGE_IDS)
+        for i in range(1, 2801): C.ALL_USERS.pop(i)
+        C._rebuild_users_book(); C.USERS_VERSION += 1; await C.save_users_pinned(C.application)
+        deleted = fake.calls["deleteMessage"]
+        assert deleted > 0 and len(C.USERS_PAGE_MESSAGE_IDS) < n0
+        assert all((DC2, mid) in fake.messages for mid in C.USERS_PAGE_MESSAGE_IDS)
+
+        # restart: صفحات از DC خوانده می‌شوند و مال این پروسه نیستند → فقط خالی می‌شوند
+        _add_users(range(10000, 13000)); await C.save_users_pinned(C.application)
+        n1 = len(C.USERS_PAGE_MESSAGE_IDS)
+        C._OWN_PAGES.clear(); C.ALL_USERS = {}; C.USERS_BOOK.reset(); C.USERS_MESSAGE_ID = None
+        await C.restore_users_from_pinned(C.application)
+        assert len(C.ALL_USERS) == 3200
+        adopted = list(C.USERS_PAGE_MESSAGE_IDS)
+        C.ALL_USERS = {}; C._rebuild_users_book(); _add_users([99999]); await C.save_users_pinned(C.application)
+        assert sorted(C.USERS_PAGE_MESSAGE_IDS) == sorted(adopted) and len(adopted) == n1
+        assert all((DC2, mid) in fake.messages for mid in adopted)      # restore فقط forward+delete نسخه‌ی موقت دارد
+        assert sum(fake.messages[(DC2, mid)]["text"] == C.BLANK_PAGE for mid in C.USERS_PAGE_MESSAGE_IDS) >= n1 - 2
+    _run(scenario)
+
+def test_page_ownership_survives_restart():
+    async def scenario(fake):
+        C.STORE = C.SqliteStore(os.path.join(tempfile.mkdtemp(prefix="cbot-test-"), "state.db"))
+        _add_users(range(1, 3001)); C.STORE.seed(C.ALL_USERS, C.ROSTER, C.PENDING)
+        await C.save_users_pinned(C.application)
+        n0 = len(C.USERS_PAGE_MESSAGE_IDS)
+        # restart: حافظه خالی، همه چیز از STORE (از جمله مالکیت صفحات)
+        C._OWN_PAGES.clear(); C.ALL_USERS = {}; C.USERS_BOOK.reset(); C.USERS_MESSAGE_ID = None
+        assert C.load_state_from_store() and len(C.ALL_USERS) == 3000
+        assert {(DC2, mid) for mid in C.USERS_PAGE_MESSAGE_IDS} <= C._OWN_PAGES
+        for i in range(1, 2801): C.ALL_USERS.pop(i)
+        C._rebuild_users_book(); C.USERS_VERSION += 1; await C.save_users_pinned(C.application)
+        assert fake.calls["deleteMessage"] > 0 and len(C.USERS_PAGE_MESSAGE_IDS) < n0
+        assert C.STORE.get_meta("dc2")["pages"] == C.USERS_PAGE_MESSAGE_IDS
+    _run(scenario)
+
+def test_roster_changes_are_written_behind():
+    async def scenario(fake):
+        ev = C.EVENTS[0]["id"]
+        C.roster_add(ev, C.RosterEntry(7, ev, "Sara", "sara", "0912", "female", 25))
+        assert C.ROSTER_DIRTY.is_set() and fake.calls["sendMessage"] == 0   # فقط dirty، هنوز نوشتنی نیست
+        C.roster_add(ev, C.RosterEntry(8, ev, "Reza", "reza", "0935", "male", 30))
+        flusher = asyncio.create_task(C.roster_flusher(C.application, delay=0.05))
+        try:
+            await fake.wait_for(lambda f: "Reza" in (fake.messages.get((DC1, fake.pins.get(DC1)), {}).get("text") or ""))
+            await asyncio.sleep(0.2)
+            assert not C.ROSTER_DIRTY.is_set() and fake.calls["pinChatMessage"] == 1
+            w = _writes(fake)
+            assert C.roster_remove(ev, 7) == 1 and C.ROSTER_DIRTY.is_set()
+            await fake.wait_for(lambda f: "Sara" not in fake.messages[(DC1, fake.pins[DC1])]["text"])
+            assert 0 < _writes(fake) - w <= 3                   # یک save تجمیعی
+        finally:
+            flusher.cancel(); await asyncio.gather(flusher, return_exceptions=True)
+        r = await C._read_pinned(C.application, DC1)
+        roster, pending = C._unpack_roster(r[3])
+        assert [row.chat_id for row in roster[ev]] == [8] and not pending
+    _run(scenario)
+
+@pytest.mark.parametrize("n", [1, 10, 50])
+def test_rewrite_wall_clock(n):
+    async def scenario(fake):
+        ids, texts = [], []
+        first, failed = await C._sync_pages(C.application, DC2, None, ids, texts, [f"p{i} v1" for i in range(n)], set(range(n)))
+        pages = [f"p{i} v2" for i in range(n)]
+        t = time.perf_counter()
+        first, failed = await C._sync_pages(C.application, DC2, first, ids, texts, pages, set(range(n)))
+        dt = time.perf_counter() - t
+        assert not failed and texts == pages
+        assert [fake.messages[(DC2, mid)]["text"] for mid in [first] + ids] == pages
+        return dt
+    dt = _run(scenario, LATENCY)
+    print(f"rewrite {n:2d} pages @ {LATENCY * 1000:.0f} ms/call: {dt * 1000:.0f} ms")
+    # ویرایش‌ها همزمان‌اند (DC_PAGE_CONCURRENCY) و فقط باکت سراسری (BROADCAST_RATE/s) آن‌ها را کند می‌کند؛
+    # حالت ترتیبی قدیمی n × LATENCY بود
+    bound = LATENCY * math.ceil(n / C.DC_PAGE_CONCURRENCY) + max(0, n - C.BROADCAST_RATE) / C.BROADCAST_RATE + 0.25
+    assert dt < bound and (n == 1 or dt < n * LATENCY), (dt, bound)
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if not name.startswith("test_"): continue
+        for args in ([(n,) for n in (1, 10, 50)] if fn.__code__.co_argcount else [()]): fn(*args)
+        print("ok", name)
@@ -0,0 +1,116 @@
+# test_snapshot.py — round-trip and corruption checks for the DC data pages (offline, no Bot API)
+#
+#   python -m pytest -q test_snapshot.py
+#   python test_snapshot.py
+
+import os, json, zlib, types, random, itertools
+os.environ.setdefault("BOT_TOKEN", "1:test"); os.environ.update(STATE_DB_PATH="", LOG_LEVEL="ERROR")
+import CBot as C
+
+def _users(n: int, seed: int = 1) -> dict:
+    rnd = random.Random(seed)
+    return {"u": [[i, None if i % 3 else i + 7, f"user{i}" if i % 5 else None, f"Name {i} {rnd.random():.5f}"] for i in range(n)]}
+
+def _pages(obj, fmt="snapshot", codec="zlib") -> list[str]:
+    if fmt == "json": return C._json_pages("📦 T JSON", obj)
+    return C._snapshot_pages("📦 T snapshot", obj, codec=codec)
+
+def test_round_trip():
+    for fmt, codec in (("snapshot", "zlib"), ("snapshot", "lzma"), ("json", None)):
+        for obj in (_users(0), _users(1), _users(5000), {"e": [], "r": [["ev", 1, "a", None, "0", "male", 22]], "p": []}):
+            pages = _pages(obj, fmt, codec)
+            assert all(len(p) <= C.TELEGRAM_TEXT_LIMIT for p in pages)
+            assert C._join_data_pages(pages, C._data_crc(pages)) == obj, (fmt, codec)
+
+def test_roster_payload_round_trip():
+    ev = C.EVENTS[0]["id"]
+    roster = {ev: [C.RosterEntry(i, ev, f"N{i}", f"u{i}" if i % 2 else None, f"09{i}", "male" if i % 3 else "female", 20 + i % 9)
+                   for i in range(300)]}
+    pending = {10000 + i: C.PendingRegistration(10000 + i, ev, f"P{i}", "1", "A", "—", "female", None, None, 55, 1.5e9 + i)
+               for i in range(40)}
+    saved = C.ROSTER, dict(C.PENDING), C.PINNED_FORMAT
+    try:
+        C.ROSTER = roster; C.PENDING.clear(); C.PENDING.update(pending)
+        for fmt in ("snapshot", "json"):
+            C.PINNED_FORMAT = fmt
+            pages = C._data_pages("📦 Roster", C._pack_roster())
+            assert C._unpack_roster(C._join_data_pages(pages, C._data_crc(pages))) == (roster, pending), fmt
+    finally:
+        C.ROSTER, C.PINNED_FORMAT = saved[0], saved[2]; C.PENDING.clear(); C.PENDING.update(saved[1])
+
+def test_corruption_is_rejected():
+    for fmt in ("snapshot", "json"):
+        pages = _pages(_users(3000), fmt); crc = C._data_crc(pages)
+        assert len(pages) > 2
+        flipped = list(pages); body = flipped[1]; flipped[1] = body[:-8] + ("A" if body[-8] != "A" else "B") + body[-7:]
+        assert C._join_data_pages(flipped, crc) is None, fmt               # crc همان صفحه
+        assert C._join_data_pages(pages[:-1], crc) is None, fmt            # صفحه‌ی گمشده
+        assert C._join_data_pages(pages[::-1], crc) is None, fmt           # ترتیب اشتباه
+        assert C._join_data_pages(pages, "00000000") is None, fmt          # crc کل سند
+        assert C._join_data_pages(pages + [None], crc) is None, fmt        # صفحه‌ای خوانده نشد
+
+def test_legacy_pages_still_decode():
+    obj = _users(2000)
+    s = json.dumps(obj, separators=(",", ":")); crc = zlib.crc32(s.encode())
+    ch = [s[i:i+1500] for i in range(0, len(s), 1500)]
+    legacy_json = [f"T (p{i}/{len(ch)}) crc={crc:08x}\n\n```json\n{c}\n```" for i, c in enumerate(ch, 1)]
+    assert C._join_data_pages(legacy_json[::-1]) == obj                  # (pI/N): هر ترتیبی
+    e = C.snapshot_encode(obj); crc = zlib.crc32(e.encode())
+    ch = [e[i:i+3600] for i in range(0, len(e), 3600)]
+    assert C._join_data_pages([f"T v1 (p{i}/{len(ch)}) crc={crc:08x}\n{c}" for i, c in enumerate(ch, 1)]) == obj
+    assert C._join_data_pages([f"T v1 crc={zlib.crc32(c.encode()):08x}\n{c}" for c in ch], f"{crc:08x}") == obj
+
+def test_changes_touch_few_pages():
+    rows = _users(12000)["u"]; base = set(_pages({"u": rows}))
+    for new in (rows + [[99999, None, "x", "y"]],                                    # append
+                rows[:6000] + [[99999, None, "x", "y"]] + rows[6000:],               # insert وسط
+                rows[:6000] + rows[6001:],                                           # delete وسط
+                rows[:6000] + [[6000, None, "renamed", "Z"]] + rows[6001:]):         # edit وسط
+        assert len(set(_pages({"u": new})) - base) <= 2
+
+def test_cached_encoding_matches_fresh():
+    """Pages built on top of the previous call's row/block cache equal a cold encode."""
+    rows = _users(8000)["u"]; u = {"u": rows}
+    for old, new in ((u, {"u": rows + [[99999, None, "x", "y"]]}), (u, {"u": rows[:10] + rows[11:]}),
+                     (u, {"u": rows[:4000] + [[4000, 5, "e", "E"]] + rows[4001:]}), (u, {"u": []}), (u, {"u": rows, "v": 3}),
+                     ({"u": [[1, 1.0, True, None]]}, {"u": [[1, 1, 1, None]]})):   # برابر در == ولی JSON متفاوت
+        _pages(old); warm = _pages(new)
+        C._SNAP_CACHE.clear(); assert warm == _pages(new)
+        assert C._join_data_pages(warm, C._data_crc(warm)) == new
+
+def test_data_pages_keep_their_messages():
+    """A human page more (or a block inserted mid-payload) must not move the other data pages."""
+    old = _pages({"u": _users(6000)["u"]})
+    ids = list(range(100, 102 + len(old))); texts = [None, "h1", "h2"] + old      # pin + دو صفحه‌ی انسانی + داده
+    rows = _users(6000)["u"]; new = _pages({"u": rows[:3000] + [[99999, None, "x", "y"]] + rows[3000:]})
+    data, data_ids = C._place_data_pages(ids, texts, 4, new)                       # حالا سه صفحه‌ی انسانی
+    texts += [None] * (len(data) - len(data_ids))                                   # صفحاتی که پیام تازه می‌خواهند
+    moved = sum(texts[1 + 3 + j] != p for j, p in enumerate(data))
+    assert moved <= 3 and sorted(data) == sorted(new) and len(data_ids) >= len(new) - 1
+    placed = set(data[:len(data_ids)])                                              # خط شناسه‌ها ترتیب payload را نگه می‌دارد
+    assert [data[ids.index(mid) - 3] for mid in data_ids] == [p for p in new if p in placed]
+
+def test_id_line_fits_at_50k_users():
+    """Page 0 lists every page id; with 5-digit ids and 50k users it must still fit in one message."""
+    saved = C.ALL_USERS, C.USERS_PAGE_MESSAGE_IDS, C.USERS_PAGE_TEXTS
+    C.ALL_USERS, C.USERS_PAGE_MESSAGE_IDS, C.USERS_PAGE_TEXTS = {}, [], []; C.USERS_BOOK.reset()
+    next_id = itertools.count(10000)
+    try:
+        for step in range(10):                                     # رشد تدریجی: صفحات داده بین صفحات انسانی جابه‌جا می‌شوند
+            for cid in range(step * 5000 + 1, (step + 1) * 5000 + 1):
+                C.add_user(types.SimpleNamespace(id=cid, username=f"user{cid}", full_name=f"Name {cid}"), cid)
+            for _ in range(4):                                     # مثل _save_users_pinned: صفحه‌ی تازه → خط شناسه‌ها دوباره
+                pages, _ = C._human_users_pages(); ids = C.USERS_PAGE_MESSAGE_IDS; n = len(ids)
+                ids += [next(next_id) for _ in range(len(pages) - 1 - n)]
+                C.USERS_PAGE_TEXTS[:] = pages
+                if len(ids) == n: break
+        assert all(len(p) <= C.TELEGRAM_HARD_LIMIT for p in pages), len(pages[0])
+        human, data, crc = C._parse_ids_line(pages[0])
+        assert sorted(human + data) == sorted(ids) and len(ids) == len(pages) - 1
+        assert C._join_data_pages([pages[1 + ids.index(mid)] for mid in data], crc) == C._pack_users()
+    finally:
+        C.ALL_USERS, C.USERS_PAGE_MESSAGE_IDS, C.USERS_PAGE_TEXTS = saved; C._rebuild_users_book()
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"): fn(); print("ok", name)